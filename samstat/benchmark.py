@@ -0,0 +1,218 @@
+""" Benchmarks
+This file contains the benchmark suite for the GFF loader, the alignment
+maps and the qstat/truedir calculators. Inputs are generated by
+samstat.synthetic and every stage runs in a freshly forked process so it's
+peak RSS can be measured on it's own. Results are written as JSON
+
+    python -m samstat.benchmark --reads 100000 -o results.json
+    python -m samstat.benchmark -o new.json --compare results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+from samstat import index
+from samstat import synthetic
+from samstat.maps import AlignmentMap
+from samstat.maps import CompactAlignmentMap
+from samstat.maps import RegionMap
+from samstat.samstat import calculate_qstats
+from samstat.samstat import calculate_reference_truedirs
+from samstat.samstat import calculate_truedirs
+
+def load_gff(paths):
+    RegionMap(paths['gff'])
+    return paths['gff_records']
+
+def load_index(paths):
+    region_map = index.load_region_index(paths['index'])
+    for region in region_map.rmap.values():
+        pass
+    return paths['gff_records']
+
+def load_alignments(paths):
+    CompactAlignmentMap(paths['sam'])
+    return paths['sam_records']
+
+def load_alignments_dict(paths):
+    AlignmentMap(paths['sam'])
+    return paths['sam_records']
+
+def load_inputs(paths):
+    return index.load_region_index(paths['index']), CompactAlignmentMap(paths['sam'])
+
+def classify(paths, inputs):
+    region_map, alignment_map = inputs
+    for _ in calculate_qstats(alignment_map, region_map):
+        pass
+    return paths['sam_records']
+
+def truedir(paths, inputs):
+    region_map, alignment_map = inputs
+    for _ in calculate_truedirs(alignment_map, region_map):
+        pass
+    return paths['sam_records']
+
+def truedir_by_reference(paths, region_map):
+    for _ in calculate_reference_truedirs(paths['bam'], region_map):
+        pass
+    return paths['sam_records']
+
+# name: (setup, timed function), setup output is passed to the timed function
+STAGES = (('gff_load', (None, load_gff)),
+          ('index_load', (None, load_index)),
+          ('alignment_load', (None, load_alignments)),
+          ('alignment_load_dict', (None, load_alignments_dict)),
+          ('classification', (load_inputs, classify)),
+          ('truedir', (load_inputs, truedir)),
+          ('truedir_by_reference', (lambda paths: index.load_region_index(paths['index']),
+                                    truedir_by_reference)))
+STAGE_NAMES = tuple(name for name, _ in STAGES)
+
+def run_stage(name, paths):
+    """Runs one stage and returns it's timings, must run in it's own process
+
+    peak_rss_kb is the peak resident set size of the process, which includes
+    the untimed setup (the inputs the stage works on). Worker processes
+    started by a stage are not included
+    """
+    setup, function = dict(STAGES)[name]
+    args = (paths,) if setup is None else (paths, setup(paths))
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    records = function(*args)
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    return {'seconds': seconds,
+            'cpu_seconds': cpu_seconds,
+            'records': records,
+            'records_per_second': records / seconds if seconds else None,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def send_stage(connection, name, paths):
+    connection.send(run_stage(name, paths))
+    connection.close()
+
+def measure_stage(name, paths, repeat=1):
+    """Runs a stage repeat times in forked processes, keeping the fastest run"""
+    context = multiprocessing.get_context('fork')
+    runs = []
+    for _ in range(repeat):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=send_stage, args=(sender, name, paths))
+        process.start()
+        runs.append(receiver.recv())
+        process.join()
+    return min(runs, key=lambda result: result['seconds'])
+
+def generate_inputs(data_dir, args):
+    """Writes the synthetic inputs into data_dir and returns their paths"""
+    paths = {'gff': os.path.join(data_dir, 'synthetic.gff'),
+             'sam': os.path.join(data_dir, 'synthetic.sam'),
+             'bam': os.path.join(data_dir, 'synthetic.bam')}
+    contig_lengths = synthetic.write_gff(paths['gff'],
+                                         contigs=args.contigs,
+                                         genes_per_contig=args.genes_per_contig,
+                                         overlap=args.overlap,
+                                         exons_per_gene=args.exons_per_gene,
+                                         seed=args.seed)
+    paths['sam_records'] = synthetic.write_sam(paths['sam'], contig_lengths,
+                                               reads=args.reads,
+                                               multimap=args.multimap,
+                                               spliced=args.spliced,
+                                               seed=args.seed)
+    synthetic.write_sorted_bam(paths['sam'], paths['bam'])
+    with open(paths['gff']) as gff:
+        paths['gff_records'] = sum(1 for line in gff if not line.startswith('#'))
+    paths['index'] = paths['gff'] + index.INDEX_SUFFIX
+    index.write_region_index(RegionMap(paths['gff']), paths['gff'], paths['index'])
+    return paths
+
+def git_revision():
+    """Returns the commit of the samstat checkout or None"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(args, data_dir):
+    """Generates the inputs and measures every selected stage"""
+    parameters = {key: getattr(args, key) for key in ('contigs', 'genes_per_contig',
+                                                      'overlap', 'exons_per_gene',
+                                                      'reads', 'multimap', 'spliced',
+                                                      'seed', 'repeat')}
+    paths = generate_inputs(data_dir, args)
+    stages = {}
+    for name in STAGE_NAMES:
+        if args.stages and name not in args.stages:
+            continue
+        stages[name] = measure_stage(name, paths, args.repeat)
+        print('{:<22} {:>9.3f} s {:>12.0f} records/s {:>9} KB'.format(
+            name, stages[name]['seconds'], stages[name]['records_per_second'] or 0,
+            stages[name]['peak_rss_kb']))
+    return {'revision': git_revision(),
+            'python': platform.python_version(),
+            'parameters': parameters,
+            'stages': stages}
+
+def compare(results, baseline):
+    """Prints the time and peak RSS of each stage relative to a baseline"""
+    if results['parameters'] != baseline['parameters']:
+        print('Warning: baseline was run with different parameters')
+    print('{:<22} {:>10} {:>10}'.format('stage', 'time', 'peak_rss'))
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        base = baseline['stages'][name]
+        print('{:<22} {:>9.2f}x {:>9.2f}x'.format(name,
+                                                  stage['seconds'] / base['seconds'],
+                                                  stage['peak_rss_kb'] / base['peak_rss_kb']))
+
+def main():
+    """Command line interface for the benchmark suite"""
+    parser = argparse.ArgumentParser(description='Benchmarks samstat on synthetic data')
+    parser.add_argument('--contigs', type=int, default=10)
+    parser.add_argument('--genes-per-contig', type=int, default=1000)
+    parser.add_argument('--overlap', type=float, default=0.1,
+                        help='Fraction of genes nested in the previous gene')
+    parser.add_argument('--exons-per-gene', type=int, default=4)
+    parser.add_argument('--reads', type=int, default=100000)
+    parser.add_argument('--multimap', type=int, default=2,
+                        help='Average number of alignments per read')
+    parser.add_argument('--spliced', type=float, default=0.1,
+                        help='Fraction of alignments with a skipped region')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per stage, the fastest is kept')
+    parser.add_argument('--stages', nargs='+', choices=STAGE_NAMES,
+                        help='Stages to run (default: all)')
+    parser.add_argument('--data-dir', type=str,
+                        help='Keep the synthetic inputs in this directory')
+    parser.add_argument('-o', '--out-path', type=str, default='benchmark.json')
+    parser.add_argument('--compare', type=str,
+                        help='Results JSON of an earlier run to compare against')
+    args = parser.parse_args()
+
+    if args.data_dir is not None:
+        os.makedirs(args.data_dir, exist_ok=True)
+        results = run_benchmarks(args, args.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = run_benchmarks(args, data_dir)
+
+    with open(args.out_path, 'w') as out_file:
+        json.dump(results, out_file, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline_file:
+            compare(results, json.load(baseline_file))
+
+if __name__ == '__main__':
+    main()
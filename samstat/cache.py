@@ -0,0 +1,80 @@
+""" Classification Cache
+This file contains a bounded LRU cache for sequence classifications that
+counts hits, misses and evictions and can be saved to and warmed from disk
+"""
+import collections
+import json
+import warnings
+
+DEFAULT_CACHE_SIZE = 100000
+
+class ClassificationCache(object):
+    """Bounded least recently used cache of classifications
+
+    A maxsize of 0 disables caching. Keys must be tuples of JSON types and
+    values namedtuples so the cache can be saved with save() and pre-warmed
+    with load()
+    """
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the cached value of key or None"""
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Caches value, evicting the least recently used entry when full"""
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """Returns the size and hit/miss/eviction counters"""
+        return {'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def save(self, path, tag=None):
+        """Writes the cached entries to path, least recently used first
+        tag identifies what the entries were computed from
+        """
+        with open(path, 'w') as cache_file:
+            json.dump({'tag': tag,
+                       'entries': [[list(key), list(value)]
+                                   for key, value in self.entries.items()]},
+                      cache_file)
+
+    def load(self, path, value_type, tag=None):
+        """Pre-warms the cache with entries written by save()
+
+        value_type is the namedtuple the values are rebuilt as. Entries saved
+        with a different tag are ignored with a warning
+        """
+        with open(path, 'r') as cache_file:
+            saved = json.load(cache_file)
+        if saved['tag'] != tag:
+            warnings.warn('Classification cache {} was saved for a different '
+                          'annotation, ignoring it'.format(path))
+            return
+        for key, value in saved['entries']:
+            self.put(tuple(key), value_type(*value))
@@ -0,0 +1,173 @@
+""" Checkpoint
+This file contains the code for checkpointed qstat/truedir runs. QNAME
+groups are processed in chunks, each chunk is written to it's own part file
+in the checkpoint directory and recorded in a manifest once it is complete.
+A restarted run with the same inputs and options skips the recorded chunks,
+streamed input is resumed from the position (BGZF virtual offset for BAM)
+of the next chunk, and the parts are joined into the output at the end
+"""
+import glob
+import itertools
+import json
+import os
+import warnings
+
+from samstat import output
+from samstat import parallel
+from samstat.maps import AlignmentStream
+
+MANIFEST_NAME = 'checkpoint.json'
+PART_NAME = 'part-{:06d}{}'
+# QNAME groups per chunk
+DEFAULT_CHECKPOINT_SIZE = 1000000
+
+class Checkpoint(object):
+    """Manifest of the completed chunks of a run
+
+    key identifies the run (inputs, operation and output options), parts
+    are (file name, rows) in order, groups is the number of QNAME groups
+    done and offset the reading position of the next chunk, if known.
+    finished is set once every chunk is written
+    """
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.key = key
+        self.parts = []
+        self.groups = 0
+        self.offset = None
+        self.finished = False
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    @classmethod
+    def load(cls, directory, key):
+        """Returns the checkpoint saved in directory for key, or an empty one
+
+        A checkpoint saved for a different run is discarded with a warning
+        """
+        checkpoint = cls(directory, key)
+        if not os.path.exists(checkpoint.path):
+            return checkpoint
+        with open(checkpoint.path, 'r') as manifest:
+            saved = json.load(manifest)
+        if saved['key'] != key:
+            warnings.warn('Checkpoint {} was saved for a different run, starting over'.format(
+                checkpoint.path))
+            stale = cls(directory, saved['key'])
+            stale.parts = [tuple(part) for part in saved['parts']]
+            stale.clear()
+            return checkpoint
+        checkpoint.parts = [tuple(part) for part in saved['parts']]
+        checkpoint.groups = saved['groups']
+        checkpoint.offset = saved['offset']
+        checkpoint.finished = saved['finished']
+        return checkpoint
+
+    def save(self):
+        """Replaces the manifest, so an interrupted save keeps the last one"""
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as manifest:
+            json.dump({'key': self.key,
+                       'parts': self.parts,
+                       'groups': self.groups,
+                       'offset': self.offset,
+                       'finished': self.finished}, manifest)
+        os.replace(temp_path, self.path)
+
+    def part_paths(self):
+        return [os.path.join(self.directory, name) for name, _ in self.parts]
+
+    def add_part(self, name, rows, groups, offset):
+        """Records a written chunk"""
+        self.parts.append((name, rows))
+        self.groups += groups
+        self.offset = offset
+        self.save()
+
+    def finish(self):
+        self.finished = True
+        self.save()
+
+    def clear(self):
+        """Removes the manifest, part files and the part of an interrupted chunk"""
+        unfinished = os.path.join(self.directory, PART_NAME.format(len(self.parts), '') + '*.tmp')
+        for path in self.part_paths() + [self.path] + glob.glob(unfinished):
+            if os.path.exists(path):
+                os.remove(path)
+        self.parts = []
+
+class Chunk(object):
+    """At most size QNAME groups read lazily from a shared iterator of
+    (qname, qdata, offset), with the items() interface of AlignmentMap
+
+    Once items() is exhausted next_group holds the first group after the
+    chunk, None at the end of the input
+    """
+    def __init__(self, first_group, groups, size):
+        self.first_group = first_group
+        self.groups = groups
+        self.size = size
+        self.count = 0
+        self.next_group = None
+
+    def items(self):
+        group = self.first_group
+        while group is not None and self.count < self.size:
+            yield group[0], group[1]
+            self.count += 1
+            group = next(self.groups, None)
+        self.next_group = group
+
+def resumed_groups(qname_data, checkpoint):
+    """Yields (qname, qdata, offset) for the QNAME groups after the
+    checkpoint, streamed input is read from the checkpoint's offset
+    """
+    if isinstance(qname_data, AlignmentStream):
+        groups = qname_data.offset_items(checkpoint.offset)
+        if checkpoint.offset is not None:
+            return groups
+    else:
+        groups = ((qname, qdata, None) for qname, qdata in qname_data.items())
+    return itertools.islice(groups, checkpoint.groups, None)
+
+def run_checkpointed(qname_data, region_map, run_function, outpath, fields, directory,
+                     key, checkpoint_size=DEFAULT_CHECKPOINT_SIZE, output_format=None,
+                     string_fields=(), workers=1):
+    """Computes the rows of qname_data in chunks of checkpoint_size QNAME
+    groups, saving a checkpoint in directory after each one, then joins the
+    parts into outpath and removes them
+
+    The output is identical to an uninterrupted run. key must identify
+    everything the rows depend on, a checkpoint saved with another key is
+    discarded.
+    Returns the number of rows written
+    """
+    os.makedirs(directory, exist_ok=True)
+    if output_format is None:
+        output_format = output.infer_format(outpath)
+    extension = output.OUTPUT_EXTENSIONS[output_format]
+    checkpoint = Checkpoint.load(directory, key)
+    if not checkpoint.finished:
+        groups = resumed_groups(qname_data, checkpoint)
+        group = next(groups, None)
+        while group is not None:
+            chunk = Chunk(group, groups, checkpoint_size)
+            name = PART_NAME.format(len(checkpoint.parts), extension)
+            temp_path = os.path.join(directory, name + '.tmp')
+            with output.open_writer(temp_path, fields, output_format, string_fields) as writer:
+                if workers > 1:
+                    writer.write(parallel.imap_qname_batches(chunk, region_map, run_function,
+                                                             writer.format, workers))
+                else:
+                    writer.write(writer.format(row) for row in run_function(chunk, region_map))
+            os.replace(temp_path, os.path.join(directory, name))
+            group = chunk.next_group
+            checkpoint.add_part(name, writer.lines_written, chunk.count,
+                                group[2] if group is not None else None)
+        checkpoint.finish()
+    rows = output.concatenate_outputs(checkpoint.part_paths(), outpath, fields,
+                                      output_format, string_fields)
+    checkpoint.clear()
+    return rows
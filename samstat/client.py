@@ -0,0 +1,110 @@
+""" Query Client
+This file contains the client of the query server (see server), with the
+RegionMap query methods, so code written against a RegionMap can use a
+server holding one instead. Only the standard library is needed
+"""
+import json
+import socket
+import warnings
+from collections import namedtuple
+
+Classification = namedtuple('Classification', ['intergene', 'exons', 'introns', 'combos'])
+Directions = namedtuple('Directions', ['forwards', 'reverses'])
+# Flags of GFF3 strands, as RegionMap.get_true_directions accepts them
+STRAND_FLAGS = {'+': 0, '-': 0x10}
+
+class ServerError(Exception):
+    """Raised when the server answers a request with an error"""
+
+class RegionMapClient(object):
+    """Connection to a query server
+
+    address is the path of the server's Unix socket or a (host, port) pair.
+    One connection is kept open, use a client per thread
+    """
+    def __init__(self, address, timeout=None):
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = tuple(address)
+        self.socket.settimeout(timeout)
+        self.socket.connect(address)
+        self.rfile = self.socket.makefile('rb')
+
+    def request(self, request):
+        """Sends one request and returns it's response"""
+        self.socket.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = self.rfile.readline()
+        if not line:
+            raise ServerError('Connection closed by the server')
+        response = json.loads(line)
+        if 'error' in response:
+            raise ServerError(response['error'])
+        return response
+
+    def classify_batch(self, region_names, location_starts, location_stops):
+        """Classifies a batch of sequence locations, see RegionMap.classify_batch
+        Returns a Classification of lists with one count per sequence
+        """
+        response = self.request({'op': 'classify',
+                                 'regions': list(region_names),
+                                 'starts': list(location_starts),
+                                 'stops': list(location_stops)})
+        for region_name in response['missing']:
+            warnings.warn('Region name {} not found in the region map'.format(region_name))
+        return Classification(response['intergenes'], response['exons'],
+                              response['introns'], response['combos'])
+
+    def get_location_clasification(self,
+                                   region_name,
+                                   location_start,
+                                   location_stop):
+        """Gets location classification from the server's region map,
+        0 if the region is not in it
+        """
+        response = self.request({'op': 'classify',
+                                 'regions': [region_name],
+                                 'starts': [location_start],
+                                 'stops': [location_stop]})
+        if response['missing']:
+            warnings.warn('Region name {} not found in the region map'.format(region_name))
+            return 0
+        return Classification(response['intergenes'][0], response['exons'][0],
+                              response['introns'][0], response['combos'][0])
+
+    def count_true_directions_batch(self, region_names, location_starts, location_stops, flags):
+        """Gets the true directions of a batch of sequence locations, the
+        strand of each comes from the reverse bit of it's flag
+        Returns a Directions of lists
+        """
+        response = self.request({'op': 'truedir',
+                                 'regions': list(region_names),
+                                 'starts': list(location_starts),
+                                 'stops': list(location_stops),
+                                 'flags': list(flags)})
+        if response['missing']:
+            raise KeyError(response['missing'][0])
+        return Directions(response['forwards'], response['reverses'])
+
+    def get_true_directions(self, region_name, sequence_location, sequence_direction):
+        """Gets the true direction of a sequence, see RegionMap.get_true_directions"""
+        sequence_direction = STRAND_FLAGS.get(sequence_direction, sequence_direction)
+        directions = self.count_true_directions_batch([region_name], [sequence_location[0]],
+                                                      [sequence_location[1]],
+                                                      [sequence_direction])
+        return Directions(directions.forwards[0], directions.reverses[0])
+
+    def stats(self):
+        """Returns the server's request, latency and throughput counters"""
+        return self.request({'op': 'stats'})
+
+    def close(self):
+        self.rfile.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,89 @@
+""" Collapse
+This file contains the code for collapsing QNAMEs with identical alignments,
+so qstat/truedir are computed once per alignment signature instead of once
+per duplicate read
+"""
+import itertools
+from collections import namedtuple
+from operator import attrgetter
+
+from samstat.maps import AlignmentMap
+from samstat.maps import CompactAlignmentMap
+from samstat.maps import REVERSE_FLAG
+
+COLLAPSE_MODES = ('expand', 'count')
+
+def alignment_signature(qdata):
+    """Returns the (rname, blocks, strand) of every alignment of a QNAME in
+    order, which is all qstat and truedir read from it
+    """
+    return tuple((rname, blocks, flag & REVERSE_FLAG)
+                 for (rname, _, flag), blocks in zip(qdata.reference_names, qdata.blocks))
+
+def signature_qdata(signature):
+    """Builds the AlignmentMap.SamIn value of an alignment signature"""
+    return AlignmentMap.SamIn([len(signature)],
+                              signature[0][2] if signature else 0,
+                              [],
+                              [(rname, blocks[0][0]-1 if blocks else -1, strand)
+                               for rname, blocks, strand in signature],
+                              [blocks for _, blocks, _ in signature])
+
+class CollapsedQnames(object):
+    """QNAMEs grouped by alignment signature
+
+    items() yields the first QNAME of every signature with it's qdata, in
+    input order. members maps that QNAME to all the QNAMEs with it's
+    signature. A CompactAlignmentMap is grouped by the signatures of it's
+    columns and only the first QNAMEs are built, other inputs keep only
+    signatures instead of their qdata
+    """
+    def __init__(self, qname_data):
+        self.signatures = {}
+        if isinstance(qname_data, CompactAlignmentMap):
+            self.alignment_map = qname_data
+            for qname_id in range(len(qname_data)):
+                self.signatures.setdefault(qname_data.signature(qname_id), []).append(qname_id)
+            self.members = {qname_data.qname(qname_ids[0]): [qname_data.qname(qname_id)
+                                                             for qname_id in qname_ids]
+                            for qname_ids in self.signatures.values()}
+        else:
+            self.alignment_map = None
+            for qname, qdata in qname_data.items():
+                self.signatures.setdefault(alignment_signature(qdata), []).append(qname)
+            self.members = {qnames[0]: qnames for qnames in self.signatures.values()}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def items(self):
+        if self.alignment_map is not None:
+            for qname_ids in self.signatures.values():
+                yield (self.alignment_map.qname(qname_ids[0]),
+                       self.alignment_map.qdata(qname_ids[0]))
+        else:
+            for signature, qnames in self.signatures.items():
+                yield qnames[0], signature_qdata(signature)
+
+def expand_rows(run_function, collapsed):
+    """Wraps run_function to repeat the rows of every signature for each of
+    it's QNAMEs, rows of one QNAME stay together
+    """
+    def run_expanded(qname_data, region_map):
+        rows = run_function(qname_data, region_map)
+        for qname, qname_rows in itertools.groupby(rows, key=attrgetter('qname')):
+            qname_rows = list(qname_rows)
+            for member in collapsed.members[qname]:
+                for row in qname_rows:
+                    yield row._replace(qname=member)
+    return run_expanded
+
+def count_rows(run_function, collapsed, out_values):
+    """Wraps run_function to add the number of QNAMEs of each signature to
+    it's rows as a count column
+    """
+    CountedRow = namedtuple('CountedRow', list(out_values) + ['count'])
+    def run_counted(qname_data, region_map):
+        for row in run_function(qname_data, region_map):
+            yield CountedRow(*row, len(collapsed.members[row.qname]))
+    return run_counted
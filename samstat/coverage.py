@@ -0,0 +1,239 @@
+""" Coverage
+This file contains the code for the coverage operation, which counts in one
+pass over an alignment file the covered and aligned bases of every contig
+and gene, and how many aligned bases fall in exons, introns and intergenic
+space
+
+Read depth is kept as a sparse difference array ({position: delta}). For
+coordinate sorted input the positions before the current alignment are
+final, they are folded into the counters every chunk_size positions, so
+memory is bounded by the alignments overlapping one chunk. Other inputs
+keep the difference arrays of every contig until the end of the file
+"""
+import bisect
+import collections
+import warnings
+from collections import namedtuple
+
+import pysam
+
+from samstat.maps import read_records
+from samstat.maps import reference_blocks
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+UNMAPPED_FLAG = 0x4
+UNSORTED_ERROR = 'Alignment file header is coordinate sorted but records are not: {}'
+# gene_id of contig rows
+CONTIG_ROW = '.'
+
+EXON, INTRON, INTERGENIC = 0, 1, 2
+
+coverage_out_values = ['rname',
+                       'gene_id',
+                       'start',
+                       'stop',
+                       'length',
+                       'covered_bases',
+                       'aligned_bases',
+                       'exon_bases',
+                       'intron_bases',
+                       'intergenic_bases',
+                       'exon_length',
+                       'intron_length',
+                       'intergenic_length']
+CoverageOutValues = namedtuple('CoverageOutValues', coverage_out_values)
+string_out_values = {'rname', 'gene_id'}
+
+class ContigCoverage(object):
+    """Coverage counters of one contig and it's genes
+
+    Bases are classified by the segments of the region: exon if a feature
+    covers them, otherwise intron if a gene covers them, otherwise
+    intergenic. covered_bases have a depth of at least 1, aligned_bases and
+    the *_bases counters sum the depth of every position
+    """
+    def __init__(self, name, length, region=None):
+        self.name = name
+        self.length = length
+        self.region = region
+        self.events = collections.defaultdict(int)
+        self.position = 1
+        self.depth = 0
+        self.covered = 0
+        self.aligned = [0, 0, 0]
+        self.gene_ids = []
+        self.gene_locations = []
+        self.gene_covered = []
+        self.gene_aligned = []
+        self.gene_lengths = []
+        self.lengths = [0, 0, 0]
+        self.segment_genes = (None, ())
+        self.gene_rows = {}
+        if region is not None:
+            if region.gene_index is None:
+                region.build_interval_index()
+            if region.boundaries is None:
+                region.build_segments()
+            self.gene_ids = [gene.gene_id for gene in region.gene_index.items]
+            self.gene_locations = [gene.location for gene in region.gene_index.items]
+            self.gene_rows = {gene.slot: row for row, gene in enumerate(region.gene_index.items)}
+            self.gene_covered = [0]*len(self.gene_ids)
+            self.gene_aligned = [[0, 0, 0] for _ in self.gene_ids]
+            self.gene_lengths = [[0, 0, 0] for _ in self.gene_ids]
+            self.count_lengths()
+
+    def segment_class(self, segment):
+        if segment < 0:
+            return INTERGENIC
+        if self.region.segment_exons[segment]:
+            return EXON
+        if self.region.segment_introns[segment]:
+            return INTRON
+        return INTERGENIC
+
+    def genes(self, segment):
+        """Returns the rows of the genes covering a segment, the genes of the
+        last segment are kept since segments are visited in order
+        """
+        if self.region is None:
+            return ()
+        if self.segment_genes[0] != segment:
+            region = self.region
+            if segment < 0 or not region.segment_genes[segment]:
+                genes = ()
+            else:
+                offsets = region.segment_gene_offsets
+                genes = [self.gene_rows[slot] for slot in
+                         region.segment_gene_slots[offsets[segment]:offsets[segment+1]]]
+            self.segment_genes = (segment, genes)
+        return self.segment_genes[1]
+
+    def segments(self, start, stop):
+        """Yields (segment, length) for the segments covering start-stop,
+        segment -1 is before the first boundary
+        """
+        if self.region is None:
+            yield -1, stop - start + 1
+            return
+        boundaries = self.region.boundaries
+        segment = bisect.bisect_right(boundaries, start) - 1
+        while start <= stop:
+            end = stop
+            if segment + 1 < len(boundaries):
+                end = min(stop, boundaries[segment+1]-1)
+            yield segment, end - start + 1
+            start = end + 1
+            segment += 1
+
+    def count_lengths(self):
+        """Counts the exon and intron lengths of the contig and it's genes"""
+        boundaries = self.region.boundaries
+        for segment in range(len(boundaries) - 1):
+            segment_class = self.segment_class(segment)
+            if segment_class == INTERGENIC:
+                continue
+            length = boundaries[segment+1] - boundaries[segment]
+            self.lengths[segment_class] += length
+            for gene in self.genes(segment):
+                self.gene_lengths[gene][segment_class] += length
+        self.segment_genes = (None, ())
+
+    def add_blocks(self, blocks):
+        """Adds the reference blocks of an alignment, clipped to the contig"""
+        for start, stop in blocks:
+            stop = min(stop, self.length)
+            if start <= stop:
+                self.events[start] += 1
+                self.events[stop+1] -= 1
+
+    def flush(self, bound=None):
+        """Adds the depth of every position before bound to the counters,
+        all positions if bound is None
+        """
+        positions = sorted(position for position in self.events
+                           if bound is None or position < bound)
+        for position in positions:
+            if self.depth:
+                self.add_depth(self.position, position-1, self.depth)
+            self.depth += self.events.pop(position)
+            self.position = position
+
+    def add_depth(self, start, stop, depth):
+        for segment, length in self.segments(start, stop):
+            segment_class = self.segment_class(segment)
+            self.covered += length
+            self.aligned[segment_class] += length*depth
+            for gene in self.genes(segment):
+                self.gene_covered[gene] += length
+                self.gene_aligned[gene][segment_class] += length*depth
+
+    def rows(self):
+        """Yields the contig row followed by a row per gene in start order"""
+        intergenic_length = self.length - self.lengths[EXON] - self.lengths[INTRON]
+        yield CoverageOutValues(self.name, CONTIG_ROW, 1, self.length, self.length,
+                                self.covered, sum(self.aligned), *self.aligned,
+                                self.lengths[EXON], self.lengths[INTRON], intergenic_length)
+        for gene, gene_id in enumerate(self.gene_ids):
+            start, stop = self.gene_locations[gene]
+            aligned, lengths = self.gene_aligned[gene], self.gene_lengths[gene]
+            yield CoverageOutValues(self.name, gene_id, start, stop, stop - start + 1,
+                                    self.gene_covered[gene], sum(aligned), *aligned,
+                                    lengths[EXON], lengths[INTRON],
+                                    stop - start + 1 - lengths[EXON] - lengths[INTRON])
+
+def is_coordinate_sorted(header):
+    if hasattr(header, 'to_dict'):
+        header = header.to_dict()
+    return header.get('HD', {}).get('SO') == 'coordinate'
+
+def contig_lengths(samfile, region_map):
+    """Returns the length of every contig of the alignment file header and
+    the region map, header lengths are used over region lengths
+    """
+    lengths = collections.OrderedDict(zip(samfile.references, samfile.lengths))
+    for name in region_map.rmap:
+        if name not in lengths:
+            lengths[name] = region_map.rmap[name].length or 0
+    return lengths
+
+def calculate_coverage(in_sam, region_map, chunk_size=DEFAULT_CHUNK_SIZE, threads=1,
+                       alignment_filter=None):
+    """Yields the coverage rows of every contig, in header order followed by
+    the contigs only in the region map
+
+    Every mapped record accepted by alignment_filter is counted, including
+    secondary alignments unless filtered. Contigs missing from the region map
+    are counted as intergenic with a warning
+    """
+    with pysam.AlignmentFile(in_sam, 'r', threads=threads) as samfile:
+        lengths = contig_lengths(samfile, region_map)
+        contigs = {}
+        for name, length in lengths.items():
+            region = region_map.rmap[name] if name in region_map.rmap else None
+            contigs[name] = ContigCoverage(name, length, region)
+        sorted_input = is_coordinate_sorted(samfile.header)
+        contig, flushed, finished = None, 0, set()
+        for read in read_records(samfile, alignment_filter):
+            if read.flag & UNMAPPED_FLAG:
+                continue
+            if contig is None or read.reference_name != contig.name:
+                if sorted_input and contig is not None:
+                    contig.flush()
+                    finished.add(contig.name)
+                contig, flushed = contigs[read.reference_name], 0
+                if contig.name in finished:
+                    raise ValueError(UNSORTED_ERROR.format(read.query_name))
+                if contig.region is None and contig.name not in region_map.unmatched_regions:
+                    warnings.warn('Region name {} not found in the region map'.format(contig.name))
+                    region_map.unmatched_regions[contig.name] += 1
+            blocks = reference_blocks(read.reference_start, read.cigartuples)
+            if sorted_input and blocks:
+                if blocks[0][0] < flushed:
+                    raise ValueError(UNSORTED_ERROR.format(read.query_name))
+                if blocks[0][0] - flushed >= chunk_size:
+                    contig.flush(blocks[0][0])
+                    flushed = blocks[0][0]
+            contig.add_blocks(blocks)
+    for contig in contigs.values():
+        contig.flush()
+        yield from contig.rows()
@@ -0,0 +1,160 @@
+""" Alignment Filters
+This file contains the code for skipping SAM/BAM records by flag, MAPQ and
+region while the alignment file is decoded, so skipped records are never
+grouped by QNAME or classified
+
+Regions are read from BED files (0-based, half open) and a record overlaps a
+region if it's span from reference_start to reference_end does, the overlap
+test of samtools and pysam's fetch. Records without a reference are outside
+every region
+"""
+import bisect
+import warnings
+import zlib
+
+# samtools flag names
+FLAG_NAMES = {'PAIRED': 0x1,
+              'PROPER_PAIR': 0x2,
+              'UNMAP': 0x4,
+              'MUNMAP': 0x8,
+              'REVERSE': 0x10,
+              'MREVERSE': 0x20,
+              'READ1': 0x40,
+              'READ2': 0x80,
+              'SECONDARY': 0x100,
+              'QCFAIL': 0x200,
+              'DUP': 0x400,
+              'SUPPLEMENTARY': 0x800}
+BED_HEADERS = ('#', 'track', 'browser')
+
+def parse_flags(value):
+    """Parses a flag mask, a number (0x904) or comma separated samtools flag
+    names (UNMAP,SECONDARY,SUPPLEMENTARY)
+    """
+    try:
+        return int(value, 0)
+    except ValueError:
+        pass
+    flags = 0
+    for name in value.split(','):
+        name = name.strip().upper()
+        if name not in FLAG_NAMES:
+            raise ValueError('Unknown flag {}, use a number or one of {}'.format(
+                name, ', '.join(FLAG_NAMES)))
+        flags |= FLAG_NAMES[name]
+    return flags
+
+def merge_intervals(intervals):
+    """Sorts (start, stop) intervals and merges the overlapping or adjacent ones"""
+    merged = []
+    for start, stop in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def read_bed(path):
+    """Reads the regions of a BED file into {contig: [(start, stop), ...]},
+    merged and in start order. Empty regions are skipped
+    """
+    regions = {}
+    with open(path, 'r') as bed:
+        for number, line in enumerate(bed, 1):
+            if not line.strip() or line.startswith(BED_HEADERS):
+                continue
+            columns = line.split()
+            try:
+                start, stop = int(columns[1]), int(columns[2])
+            except (IndexError, ValueError):
+                raise ValueError('Invalid BED line {} of {}: {}'.format(number, path,
+                                                                          line.rstrip()))
+            if start < stop:
+                regions.setdefault(columns[0], []).append((start, stop))
+    return {contig: merge_intervals(intervals) for contig, intervals in regions.items()}
+
+class AlignmentFilter(object):
+    """Accepts the records of an alignment file with none of exclude_flags,
+    a MAPQ of at least min_mapq and, if regions is set, overlapping one of
+    it's regions ({contig: [(start, stop), ...]} as returned by read_bed)
+    """
+    def __init__(self, min_mapq=0, exclude_flags=0, regions=None):
+        self.min_mapq = min_mapq
+        self.exclude_flags = exclude_flags
+        self.regions = None
+        if regions is not None:
+            self.regions = {contig: merge_intervals(intervals)
+                            for contig, intervals in regions.items()}
+            self.region_stops = {contig: [stop for _, stop in intervals]
+                                 for contig, intervals in self.regions.items()}
+
+    @classmethod
+    def from_options(cls, min_mapq=0, exclude_flags=0, regions_path=None):
+        """Returns the filter of the command line options, None if they
+        accept every record
+        """
+        if not min_mapq and not exclude_flags and regions_path is None:
+            return None
+        regions = read_bed(regions_path) if regions_path is not None else None
+        return cls(min_mapq, exclude_flags, regions)
+
+    def key(self):
+        """Identifies the records the filter accepts, for checkpoints"""
+        regions = None
+        if self.regions is not None:
+            regions = zlib.crc32(repr(sorted(self.regions.items())).encode('utf-8'))
+        return {'min_mapq': self.min_mapq,
+                'exclude_flags': self.exclude_flags,
+                'regions': regions}
+
+    def overlaps(self, contig, start, stop):
+        """True if start-stop (0-based, half open) overlaps a region of contig"""
+        stops = self.region_stops.get(contig)
+        if stops is None:
+            return False
+        i = bisect.bisect_right(stops, start)
+        return i < len(stops) and self.regions[contig][i][0] < stop
+
+    def accepts(self, seq_line):
+        if seq_line.flag & self.exclude_flags:
+            return False
+        if seq_line.mapping_quality < self.min_mapq:
+            return False
+        if self.regions is None:
+            return True
+        if seq_line.reference_id < 0:
+            return False
+        start, stop = seq_line.reference_start, seq_line.reference_end
+        if stop is None or stop <= start:
+            # Like htslib, records without reference bases span one base
+            stop = start + 1
+        return self.overlaps(seq_line.reference_name, start, stop)
+
+    def records(self, samfile):
+        """Yields the accepted records of an open alignment file
+
+        Indexed BAM/CRAM files with regions are read with fetch, so records
+        outside the regions are not decoded. Contigs are read in header
+        order and records overlapping several regions are yielded once
+        """
+        if self.regions is not None:
+            for contig in self.regions:
+                if contig not in samfile.references:
+                    warnings.warn('Region contig {} not found in the alignment file'.format(
+                        contig))
+        if self.regions is None or not samfile.has_index():
+            return (seq_line for seq_line in samfile if self.accepts(seq_line))
+        return self.fetch_records(samfile)
+
+    def fetch_records(self, samfile):
+        for contig in samfile.references:
+            previous_stop = None
+            for start, stop in self.regions.get(contig, ()):
+                for seq_line in samfile.fetch(contig, start, stop):
+                    # Records starting before the last region overlapped it
+                    if previous_stop is not None and seq_line.reference_start < previous_stop:
+                        continue
+                    if (not seq_line.flag & self.exclude_flags and
+                            seq_line.mapping_quality >= self.min_mapq):
+                        yield seq_line
+                previous_stop = stop
@@ -0,0 +1,94 @@
+""" GFF3 Reader
+This file contains the code for tokenizing GFF3 files. Columns are split on
+tabs and attribute columns are only searched for the keys that are needed
+"""
+import gzip
+import io
+import warnings
+from collections import namedtuple
+
+BUFFER_SIZE = 1 << 20
+GZIP_MAGIC = b'\x1f\x8b'
+SEQUENCE_REGION = '##sequence-region'
+
+GffRecord = namedtuple('GffRecord', ['seqid',
+                                     'source',
+                                     'type',
+                                     'start',
+                                     'end',
+                                     'score',
+                                     'strand',
+                                     'phase',
+                                     'attributes'])
+
+def open_gff(path):
+    """Opens a plain, gzip or bgzip GFF3 file for reading text in large blocks"""
+    with open(path, 'rb') as gff:
+        compressed = gff.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    if compressed:
+        return io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(path),
+                                                  buffer_size=BUFFER_SIZE))
+    return open(path, 'r', buffering=BUFFER_SIZE)
+
+def read_records(path, sequence_regions=None):
+    """Yields a GffRecord for every feature line of a GFF3 file
+
+    The attributes column is left as a string for get_attribute.
+    If sequence_regions is a dict the (start, end) of every
+    ##sequence-region directive is added to it by seqid.
+    Reading stops at a ##FASTA directive
+    """
+    with open_gff(path) as gff:
+        for count, line in enumerate(gff):
+            if line.startswith('#'):
+                if line.startswith('##FASTA'):
+                    return
+                if sequence_regions is not None and line.startswith(SEQUENCE_REGION):
+                    add_sequence_region(sequence_regions, line, count)
+                continue
+            columns = line.rstrip('\r\n').split('\t')
+            if len(columns) != 9:
+                if line.strip():
+                    warnings.warn('Invalid line: {} ... skipped'.format(count))
+                continue
+            try:
+                columns[3] = int(columns[3])
+                columns[4] = int(columns[4])
+            except ValueError:
+                warnings.warn('Invalid line: {} ... skipped'.format(count))
+                continue
+            yield GffRecord(*columns)
+
+def add_sequence_region(sequence_regions, line, count):
+    """Parses a "##sequence-region seqid start end" directive"""
+    columns = line.split()
+    try:
+        sequence_regions[columns[1]] = (int(columns[2]), int(columns[3]))
+    except (IndexError, ValueError):
+        warnings.warn('Invalid sequence-region directive: {} ... skipped'.format(count))
+
+def get_attribute(attributes, key):
+    """Returns the value of key in a GFF3 attributes column or None"""
+    prefix = key + '='
+    if attributes.startswith(prefix):
+        start = len(prefix)
+    else:
+        start = attributes.find(';' + prefix)
+        if start < 0:
+            return None
+        start += len(prefix) + 1
+    stop = attributes.find(';', start)
+    if stop < 0:
+        return attributes[start:].rstrip()
+    return attributes[start:stop]
+
+def get_dbxref(attributes, database):
+    """Returns the identifier of database in the Dbxref attribute or None"""
+    dbxref = get_attribute(attributes, 'Dbxref')
+    if dbxref is None:
+        return None
+    for reference in dbxref.split(','):
+        name, _, identifier = reference.partition(':')
+        if name == database:
+            return identifier
+    return None
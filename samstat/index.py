@@ -0,0 +1,268 @@
+""" Region Index
+This file contains the code for compiling region maps into a flat binary
+index file that can be opened with mmap instead of re-parsing the GFF3 file
+
+Index Layout:
+    magic (8 bytes), header length (8 bytes), JSON header, padded arrays
+    The header holds the source key, feature types and, per region, it's
+    gene ids and the (offset, length, typecode) of every array
+"""
+import collections.abc
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import warnings
+from array import array
+
+from samstat.maps import Genes
+from samstat.maps import Region
+from samstat.maps import RegionMap
+
+INDEX_MAGIC = b'SSIDX\x00\x01\x00'
+INDEX_SUFFIX = '.ssidx'
+HEADER_LENGTH = struct.Struct('<Q')
+HASH_BLOCK_SIZE = 1 << 20
+
+def source_key(gff_path, with_hash=True):
+    """Returns the size, mtime and (optionally) sha1 hash of a source file"""
+    stat = os.stat(gff_path)
+    key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': None}
+    if with_hash:
+        sha1 = hashlib.sha1()
+        with open(gff_path, 'rb') as source:
+            for block in iter(lambda: source.read(HASH_BLOCK_SIZE), b''):
+                sha1.update(block)
+        key['sha1'] = sha1.hexdigest()
+    return key
+
+def is_index(path):
+    """Checks if a file starts with the region index magic bytes"""
+    with open(path, 'rb') as index_file:
+        return index_file.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+def parse_header(buffer):
+    """Parses the JSON header of a region index buffer
+    Returns the header and the offset of the first array
+    """
+    if bytes(buffer[:len(INDEX_MAGIC)]) != INDEX_MAGIC:
+        raise ValueError('Not a region index file')
+    header_length, = HEADER_LENGTH.unpack_from(buffer, len(INDEX_MAGIC))
+    data_offset = len(INDEX_MAGIC) + HEADER_LENGTH.size + header_length
+    header = json.loads(bytes(buffer[data_offset-header_length:data_offset]).decode('utf-8'))
+    return header, data_offset
+
+def open_index(index_path):
+    """Maps a region index file into memory read only"""
+    with open(index_path, 'rb') as index_file:
+        return mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_header(index_path):
+    """Reads the JSON header of a region index file"""
+    with open_index(index_path) as buffer:
+        return parse_header(buffer)[0]
+
+def index_is_current(index_path, gff_path, feature_types):
+    """Checks if an index was compiled from the current version of gff_path
+
+    Size and mtime are checked first, the hash is only computed when the
+    size matches but the mtime has changed
+    """
+    try:
+        header = read_header(index_path)
+    except (OSError, ValueError):
+        return False
+    if tuple(header['feature_types']) != tuple(feature_types):
+        return False
+    indexed, current = header['source'], source_key(gff_path, with_hash=False)
+    if indexed['size'] != current['size']:
+        return False
+    if indexed['mtime_ns'] == current['mtime_ns']:
+        return True
+    return indexed['sha1'] == source_key(gff_path)['sha1']
+
+def region_arrays(region):
+    """Flattens a region into coordinate, strand and segment arrays, genes
+    are written in (start, -stop) order
+    """
+    if region.boundaries is None:
+        region.build_segments()
+    genes = region.genes
+    genes.sort_features()
+    slots = sorted(range(len(genes)), key=lambda slot: (genes.gene_starts[slot],
+                                                        -genes.gene_stops[slot]))
+    arrays = collections.OrderedDict((name, array(typecode)) for name, typecode in (
+        ('gene_starts', 'q'), ('gene_stops', 'q'), ('gene_strands', 'b'),
+        ('gene_feature_offsets', 'q'),
+        ('feature_starts', 'q'), ('feature_stops', 'q'), ('feature_strands', 'b'),
+        ('feature_type_ids', 'b')))
+    arrays['gene_feature_offsets'].append(0)
+    # Index positions of the region's gene slots and feature positions
+    gene_positions = array('q', bytes(8*len(slots)))
+    feature_positions = array('q', bytes(8*len(genes.feature_starts)))
+    for position, slot in enumerate(slots):
+        gene_positions[slot] = position
+        arrays['gene_starts'].append(genes.gene_starts[slot])
+        arrays['gene_stops'].append(genes.gene_stops[slot])
+        arrays['gene_strands'].append(genes.gene_strands[slot])
+        for j in genes.feature_range(slot):
+            feature_positions[j] = len(arrays['feature_starts'])
+            arrays['feature_starts'].append(genes.feature_starts[j])
+            arrays['feature_stops'].append(genes.feature_stops[j])
+            arrays['feature_strands'].append(genes.feature_strands[j])
+            arrays['feature_type_ids'].append(genes.feature_type_ids[j])
+        arrays['gene_feature_offsets'].append(len(arrays['feature_starts']))
+    arrays['boundaries'] = array('q', region.boundaries)
+    arrays['segment_genes'] = array('q', region.segment_genes)
+    arrays['segment_exons'] = array('q', region.segment_exons)
+    arrays['segment_introns'] = array('q', region.segment_introns)
+    arrays['segment_types'] = array('q', region.segment_types)
+    arrays['segment_gene_offsets'] = array('q', region.segment_gene_offsets)
+    arrays['segment_gene_slots'] = array('q', map(gene_positions.__getitem__,
+                                                  region.segment_gene_slots))
+    arrays['segment_feature_offsets'] = array('q', region.segment_feature_offsets)
+    arrays['segment_features'] = array('q', map(feature_positions.__getitem__,
+                                                region.segment_features))
+    arrays['segment_forwards'] = array('q', region.segment_forwards)
+    arrays['segment_reverses'] = array('q', region.segment_reverses)
+    return [genes.gene_ids[slot] for slot in slots], arrays
+
+def write_region_index(region_map, gff_path, index_path):
+    """Writes a region map compiled from gff_path to index_path"""
+    header = {'source': dict(source_key(gff_path), path=os.path.abspath(gff_path)),
+              'feature_types': list(region_map.feature_types),
+              'byteorder': sys.byteorder,
+              'primary_type_segments': True,
+              'regions': []}
+    blocks, offset = [], 0
+    for name, region in region_map.rmap.items():
+        gene_ids, arrays = region_arrays(region)
+        region_header = {'name': name,
+                         'length': region.length,
+                         'direction': region.direction,
+                         'gene_ids': gene_ids,
+                         'arrays': {}}
+        for array_name, values in arrays.items():
+            data = values.tobytes()
+            region_header['arrays'][array_name] = (offset, len(values), values.typecode)
+            data += bytes(-len(data) % 8)
+            blocks.append(data)
+            offset += len(data)
+        header['regions'].append(region_header)
+
+    header_data = json.dumps(header).encode('utf-8')
+    header_data += b' ' * (-(len(INDEX_MAGIC) + HEADER_LENGTH.size + len(header_data)) % 8)
+    with open(index_path, 'wb') as index_file:
+        index_file.write(INDEX_MAGIC)
+        index_file.write(HEADER_LENGTH.pack(len(header_data)))
+        index_file.write(header_data)
+        for data in blocks:
+            index_file.write(data)
+
+class IndexedRegions(collections.abc.Mapping):
+    """Read only mapping of region names to Regions backed by an mmap
+
+    Regions are only built when they are first looked up. Their segment
+    arrays are memoryviews into the mapped file, so the pages are shared by
+    every process that opens the same index
+    """
+    def __init__(self, index_path):
+        self.mmap = open_index(index_path)
+        self.header, self.data_offset = parse_header(self.mmap)
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError('Region index was written with {} byte order'.format(
+                self.header['byteorder']))
+        self.region_headers = {region['name']: region for region in self.header['regions']}
+        self.regions = {}
+
+    def __getitem__(self, name):
+        try:
+            return self.regions[name]
+        except KeyError:
+            region = self.regions[name] = self.build_region(self.region_headers[name])
+            return region
+
+    def __iter__(self):
+        return iter(self.region_headers)
+
+    def __len__(self):
+        return len(self.region_headers)
+
+    def view(self, array_header):
+        """Returns a memoryview of an array in the mapped file"""
+        offset, length, typecode = array_header
+        start = self.data_offset + offset
+        size = length * array(typecode).itemsize
+        return memoryview(self.mmap)[start:start+size].cast(typecode)
+
+    def build_region(self, region_header):
+        """Builds a Region from it's arrays in the mapped file"""
+        views = {name: self.view(array_header)
+                 for name, array_header in region_header['arrays'].items()}
+        region = Region(region_header['length'], region_header['direction'],
+                        self.header['feature_types'])
+        region.genes = Genes.from_arrays(region_header['gene_ids'],
+                                         views['gene_starts'], views['gene_stops'],
+                                         views['gene_strands'], views['gene_feature_offsets'],
+                                         views['feature_starts'], views['feature_stops'],
+                                         views['feature_strands'],
+                                         views.get('feature_type_ids'))
+        if len(region.feature_types) > 1 and not self.header.get('primary_type_segments'):
+            # Older indexes counted every feature type as exons
+            region.build_segments()
+            return region
+        region.boundaries = views['boundaries']
+        region.segment_genes = views['segment_genes']
+        region.segment_exons = views['segment_exons']
+        region.segment_introns = views['segment_introns']
+        if 'segment_types' in views:
+            region.segment_types = views['segment_types']
+        else:
+            # Indexes without feature types have the first type only
+            region.segment_types = array('q', map(bool, region.segment_exons))
+        if 'segment_gene_slots' in views:
+            region.segment_gene_offsets = views['segment_gene_offsets']
+            region.segment_gene_slots = views['segment_gene_slots']
+            region.segment_feature_offsets = views['segment_feature_offsets']
+            region.segment_features = views['segment_features']
+        else:
+            region.build_segment_members()
+        if 'segment_forwards' in views:
+            region.segment_forwards = views['segment_forwards']
+            region.segment_reverses = views['segment_reverses']
+        else:
+            region.build_direction_segments()
+        return region
+
+def load_region_index(index_path):
+    """Opens a region index file as a RegionMap"""
+    rmap = IndexedRegions(index_path)
+    region_map = RegionMap(accepted_features=tuple(rmap.header['feature_types']))
+    region_map.rmap = rmap
+    return region_map
+
+def load_region_map(path, accepted_features=None):
+    """Loads a RegionMap from a region index or a GFF3 file
+
+    A GFF3 file is replaced by it's sibling index (path + '.ssidx') when that
+    index was compiled from the current version of the file. accepted_features
+    defaults to exon for GFF3 files and to the compiled types for an index
+    """
+    if isinstance(accepted_features, str):
+        accepted_features = tuple([accepted_features])
+    if is_index(path):
+        region_map = load_region_index(path)
+        if accepted_features is not None and tuple(accepted_features) != region_map.feature_types:
+            warnings.warn('Region index {} was compiled with feature types {}'.format(
+                path, ','.join(region_map.feature_types)))
+        return region_map
+    if accepted_features is None:
+        accepted_features = ('exon',)
+    index_path = path + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        if index_is_current(index_path, path, accepted_features):
+            return load_region_index(index_path)
+        warnings.warn('Region index {} is out of date, parsing {}'.format(index_path, path))
+    return RegionMap(path, accepted_features=accepted_features)
@@ -2,53 +2,340 @@
 This file contains the code for reading GFF3 files into region maps
 """
 import bisect
+import collections.abc
+import itertools
 import os
+import sys
+from array import array
 import warnings
 import pysam
-import timeit
 from collections import namedtuple
-from functools import lru_cache
+
+from samstat import gff
+from samstat.cache import ClassificationCache
+
+REFERENCE_OPS = frozenset((0, 2, 7, 8)) # M, D, =, X
+SKIP_OP = 3 # N
+REVERSE_FLAG = 0x10
+
+STRAND_SIGNS = {'+': 1, '-': -1}
+STRAND_NAMES = {1: '+', -1: '-', 0: '.'}
+# Features with the same location are sorted by the names of their strands
+STRAND_ORDER = {1: 0, -1: 1, 0: 2}
+
+def flag_strand(flag):
+    """Returns the strand of an alignment flag, 1 forward or -1 reverse"""
+    return -1 if flag & REVERSE_FLAG else 1
+
+def direction_flag(direction):
+    """Returns the flag of a SAM flag or GFF3 strand ('+' or '-') direction
+
+    Raises TypeError for other directions
+    """
+    forward = RegionMap.convert_direction(direction)
+    if forward is None:
+        raise TypeError('Invalid direction {!r}, use a SAM flag, + or -'.format(direction))
+    if isinstance(direction, int):
+        return direction
+    return 0 if forward else REVERSE_FLAG
+
+def reference_blocks(reference_start, cigartuples):
+    """Returns the reference blocks of an alignment as 1-based inclusive
+    (start, stop) pairs, the coordinate system of GFF3 files
+
+    Like pysam's get_blocks but blocks are only split at skipped regions (N),
+    so deletions and insertions don't break a block in two
+    """
+    if not cigartuples or reference_start < 0:
+        return ()
+    if len(cigartuples) == 1:
+        return ((reference_start+1, reference_start+cigartuples[0][1]),)
+    blocks = []
+    start = position = reference_start
+    for operation, length in cigartuples:
+        if operation in REFERENCE_OPS:
+            position += length
+        elif operation == SKIP_OP:
+            if position > start:
+                blocks.append((start+1, position))
+            position += length
+            start = position
+    if position > start:
+        blocks.append((start+1, position))
+    return tuple(blocks)
+
+def read_records(samfile, alignment_filter=None):
+    """Returns the records of an open alignment file accepted by alignment_filter"""
+    if alignment_filter is None:
+        return samfile
+    return alignment_filter.records(samfile)
 
 class AlignmentMap(dict):
     SamIn = namedtuple('InLine',
                        ['alignment_number',
                         'flag',
                         'cigar',
-                        'reference_names'])
+                        'reference_names',
+                        'blocks'])
 
-    def __init__(self, path):
-        self.update(self.read_alignment_map(path))
+    def __init__(self, path, alignment_filter=None):
+        self.update(self.read_alignment_map(path, alignment_filter))
 
     @classmethod
-    def read_alignment_map(cls, path):
-        """Reads Alignment map SAM/BAM file into dictionary"""
+    def read_alignment_map(cls, path, alignment_filter=None):
+        """Reads Alignment map SAM/BAM file into dictionary, only the records
+        accepted by alignment_filter (see filters.AlignmentFilter) if set
+        """
         amap = {}
         samfile = pysam.AlignmentFile(path, 'r')
-        for count, seq_line in enumerate(samfile):
+        for count, seq_line in enumerate(read_records(samfile, alignment_filter)):
             qname = seq_line.query_name
             amap.setdefault(qname, cls.SamIn([0],
                                              seq_line.flag,
                                              seq_line.cigar,
+                                             [],
                                              []))
-            amap[qname].alignment_number[0] += 1
-            try:
-                amap[qname].reference_names.append((seq_line.reference_name,
-                                                             seq_line.reference_start,
-                                                             seq_line.flag))
-            except ValueError:
-                #warnings.warn('Reference Name is -1, Line #: {}'.format(count))
-                pass
+            cls.add_alignment(amap[qname], seq_line)
 
         return amap
 
-def split_gen(s, delims):
-    """iterates a delimited line"""
-    start = 0
-    for i, c in enumerate(s):
-        if c in delims:
-            yield s[start:i]
-            start = i+1
-    yield s[start:]
+    @staticmethod
+    def add_alignment(qdata, seq_line):
+        """Adds a SAM/BAM record to the data of it's QNAME"""
+        qdata.alignment_number[0] += 1
+        try:
+            qdata.reference_names.append((seq_line.reference_name,
+                                          seq_line.reference_start,
+                                          seq_line.flag))
+            qdata.blocks.append(reference_blocks(seq_line.reference_start,
+                                                 seq_line.cigartuples))
+        except ValueError:
+            #warnings.warn('Reference Name is -1, Line #: {}'.format(count))
+            pass
+
+
+class AlignmentStream(object):
+    """Streams QNAME groups from a queryname sorted (or collated) SAM/BAM file
+
+    Only the records of the current QNAME are held in memory so peak memory
+    depends on the largest QNAME group instead of the file size.
+    Provides the same items() interface as AlignmentMap. threads is the
+    number of BGZF decompression threads used by pysam for BAM input, only
+    records accepted by alignment_filter are read if it is set
+    """
+    grouped_sort_orders = ('queryname',)
+    grouped_group_orders = ('query',)
+
+    def __init__(self, path, threads=1, alignment_filter=None):
+        self.path = path
+        self.threads = threads
+        self.alignment_filter = alignment_filter
+
+    def items(self):
+        """Yields (qname, SamIn) pairs for each group of consecutive records"""
+        samfile = pysam.AlignmentFile(self.path, 'r', threads=self.threads)
+        self.check_grouping(samfile.header)
+        return self.group_alignments(read_records(samfile, self.alignment_filter))
+
+    def offset_items(self, offset=None):
+        """Yields (qname, SamIn, offset) for each group of consecutive
+        records, offset is the position (AlignmentFile.tell, a BGZF virtual
+        offset for BAM) of the group's first record or None if the file can't
+        tell it. Reading starts at offset if given. Filtered records are read
+        and skipped instead of fetched, so offsets stay in file order
+        """
+        samfile = pysam.AlignmentFile(self.path, 'r', threads=self.threads)
+        self.check_grouping(samfile.header)
+        if offset is not None:
+            samfile.seek(offset)
+        return self.group_positioned(self.positioned_records(samfile, self.alignment_filter))
+
+    @staticmethod
+    def positioned_records(samfile, alignment_filter=None):
+        """Yields (position, record) for the records of samfile accepted by
+        alignment_filter
+        """
+        while True:
+            try:
+                position = samfile.tell()
+            except (OSError, NotImplementedError):
+                position = None
+            try:
+                seq_line = next(samfile)
+            except StopIteration:
+                return
+            if alignment_filter is None or alignment_filter.accepts(seq_line):
+                yield position, seq_line
+
+    @staticmethod
+    def group_positioned(positioned_records):
+        """Groups consecutive (position, record) pairs with the same QNAME
+        with the position of the first record
+        """
+        for qname, records in itertools.groupby(positioned_records,
+                                                key=lambda record: record[1].query_name):
+            position, seq_line = next(records)
+            qdata = AlignmentMap.SamIn([0], seq_line.flag, seq_line.cigar, [], [])
+            AlignmentMap.add_alignment(qdata, seq_line)
+            for _, seq_line in records:
+                AlignmentMap.add_alignment(qdata, seq_line)
+            yield qname, qdata, position
+
+    @classmethod
+    def check_grouping(cls, header):
+        """Warns if the SAM/BAM header doesn't declare QNAME grouped records"""
+        if hasattr(header, 'to_dict'):
+            header = header.to_dict()
+        hd = header.get('HD', {})
+        if (hd.get('SO') not in cls.grouped_sort_orders and
+                hd.get('GO') not in cls.grouped_group_orders):
+            warnings.warn(('Alignment file header is not queryname sorted or '
+                           'grouped, QNAMEs that are not consecutive will be '
+                           'reported more than once'))
+
+    @classmethod
+    def group_alignments(cls, seq_lines):
+        """Groups consecutive records with the same QNAME"""
+        for qname, qdata, _ in cls.group_positioned(zip(itertools.repeat(None), seq_lines)):
+            yield qname, qdata
+
+class CompactAlignmentMap(collections.abc.Mapping):
+    """Columnar, read only version of AlignmentMap
+
+    Alignments are stored grouped by QNAME in typed arrays:
+        reference_ids, reference_starts, flags: one entry per alignment
+        offsets: the alignments of QNAME i are offsets[i]:offsets[i+1]
+        block_offsets: the reference blocks of alignment j are
+            block_offsets[j]:block_offsets[j+1] in block_starts, block_stops
+        first_flags, cigar_ops, cigar_lengths: the flag and first CIGAR
+            operation of the first record of each QNAME
+    Reference names are kept once in self.references and QNAMEs are packed
+    into a single string. Values are built as AlignmentMap.SamIn on access.
+    threads is the number of BGZF decompression threads used for BAM input,
+    only records accepted by alignment_filter are stored if it is set
+    """
+    def __init__(self, path, threads=1, alignment_filter=None):
+        self.read_alignment_map(path, threads, alignment_filter)
+        self.qname_index = None
+
+    def read_alignment_map(self, path, threads=1, alignment_filter=None):
+        """Reads Alignment map SAM/BAM file into columns"""
+        samfile = pysam.AlignmentFile(path, 'r', threads=threads)
+        self.references = samfile.references
+        qname_ids = {}
+        record_qnames = array('i')
+        self.reference_ids = array('i')
+        self.reference_starts = array('i')
+        self.flags = array('H')
+        self.block_offsets = array('q', [0])
+        self.block_starts = array('i')
+        self.block_stops = array('i')
+        self.first_flags = array('H')
+        self.cigar_ops = array('b')
+        self.cigar_lengths = array('i')
+        for seq_line in read_records(samfile, alignment_filter):
+            qname_id = qname_ids.setdefault(seq_line.query_name, len(qname_ids))
+            if qname_id == len(self.first_flags):
+                cigar = seq_line.cigartuples or [(-1, 0)]
+                self.first_flags.append(seq_line.flag)
+                self.cigar_ops.append(cigar[0][0])
+                self.cigar_lengths.append(cigar[0][1])
+            record_qnames.append(qname_id)
+            self.reference_ids.append(seq_line.reference_id)
+            self.reference_starts.append(seq_line.reference_start)
+            self.flags.append(seq_line.flag)
+            for start, stop in reference_blocks(seq_line.reference_start,
+                                                seq_line.cigartuples):
+                self.block_starts.append(start)
+                self.block_stops.append(stop)
+            self.block_offsets.append(len(self.block_starts))
+
+        self.offsets = array('q', [0])*(len(qname_ids)+1)
+        for qname_id in record_qnames:
+            self.offsets[qname_id+1] += 1
+        for i in range(len(qname_ids)):
+            self.offsets[i+1] += self.offsets[i]
+        self.group_records(record_qnames)
+
+        qnames = list(qname_ids)
+        del qname_ids
+        self.qname_offsets = array('q', [0])
+        for qname in qnames:
+            self.qname_offsets.append(self.qname_offsets[-1] + len(qname))
+        self.packed_qnames = ''.join(qnames)
+
+    def group_records(self, record_qnames):
+        """Reorders the alignment columns so each QNAME is contiguous"""
+        if all(record_qnames[i] <= record_qnames[i+1] for i in range(len(record_qnames)-1)):
+            return
+        positions = array('q', self.offsets)
+        order = array('q', [0])*len(record_qnames)
+        for record, qname_id in enumerate(record_qnames):
+            order[positions[qname_id]] = record
+            positions[qname_id] += 1
+        for name in ('reference_ids', 'reference_starts', 'flags'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (column[i] for i in order)))
+
+        block_offsets = array('q', [0])
+        block_starts, block_stops = array('i'), array('i')
+        for record in order:
+            for block in range(self.block_offsets[record], self.block_offsets[record+1]):
+                block_starts.append(self.block_starts[block])
+                block_stops.append(self.block_stops[block])
+            block_offsets.append(len(block_starts))
+        self.block_offsets = block_offsets
+        self.block_starts, self.block_stops = block_starts, block_stops
+
+    def qname(self, qname_id):
+        """Returns the QNAME with id qname_id"""
+        return self.packed_qnames[self.qname_offsets[qname_id]:self.qname_offsets[qname_id+1]]
+
+    def qdata(self, qname_id):
+        """Builds the AlignmentMap.SamIn value of the QNAME with id qname_id"""
+        start, stop = self.offsets[qname_id], self.offsets[qname_id+1]
+        cigar = [] if self.cigar_ops[qname_id] < 0 else [(self.cigar_ops[qname_id],
+                                                           self.cigar_lengths[qname_id])]
+        reference_names = [(self.references[self.reference_ids[i]] if self.reference_ids[i] >= 0 else None,
+                            self.reference_starts[i],
+                            self.flags[i]) for i in range(start, stop)]
+        blocks = [tuple(zip(self.block_starts[self.block_offsets[i]:self.block_offsets[i+1]],
+                            self.block_stops[self.block_offsets[i]:self.block_offsets[i+1]]))
+                  for i in range(start, stop)]
+        return AlignmentMap.SamIn([stop-start],
+                                  self.first_flags[qname_id],
+                                  cigar,
+                                  reference_names,
+                                  blocks)
+
+    def signature(self, qname_id):
+        """Returns the references, strands and blocks of the alignments of a
+        QNAME as bytes, equal for QNAMEs with identical alignments
+        """
+        start, stop = self.offsets[qname_id], self.offsets[qname_id+1]
+        block_offsets = self.block_offsets[start:stop+1]
+        first_block, last_block = block_offsets[0], block_offsets[-1]
+        return (self.reference_ids[start:stop].tobytes(),
+                bytes([flag & REVERSE_FLAG for flag in self.flags[start:stop]]),
+                array('l', [stop_offset - start_offset for start_offset, stop_offset
+                            in zip(block_offsets, block_offsets[1:])]).tobytes(),
+                self.block_starts[first_block:last_block].tobytes(),
+                self.block_stops[first_block:last_block].tobytes())
+
+    def __len__(self):
+        return len(self.first_flags)
+
+    def __iter__(self):
+        return (self.qname(qname_id) for qname_id in range(len(self)))
+
+    def __getitem__(self, qname):
+        if self.qname_index is None:
+            self.qname_index = {name: qname_id for qname_id, name in enumerate(self)}
+        return self.qdata(self.qname_index[qname])
+
+    def items(self):
+        """Yields (qname, SamIn) pairs in the order QNAMEs were first seen"""
+        return ((self.qname(qname_id), self.qdata(qname_id)) for qname_id in range(len(self)))
 
 def eqiv(values):
     """Recursive function that does eqivalent boolean operations
@@ -70,29 +357,477 @@ def eqiv(values):
     except IndexError:
         return outcome
 
+class IntervalIndex(object):
+    """Nested containment list (NCList) over items with a location pair
+
+    Items are sorted once by (start, -stop) and every item is placed in the
+    sublist of the closest item that contains it. Within a sublist both
+    starts and stops are increasing, so all items overlapping a query are
+    found in O(log n + k) with one binary search per visited sublist
+    """
+    def __init__(self, items):
+        self.items = sorted(items, key=lambda item: (item.location[0],
+                                                     -item.location[1]))
+        self.starts = [item.location[0] for item in self.items]
+        self.stops = [item.location[1] for item in self.items]
+
+        members = {-1: []}
+        parents = []
+        for index, stop in enumerate(self.stops):
+            while parents and self.stops[parents[-1]] < stop:
+                parents.pop()
+            members.setdefault(parents[-1] if parents else -1, []).append(index)
+            parents.append(index)
+        self.sublists = {parent: (children, [self.stops[i] for i in children])
+                         for parent, children in members.items()}
+
+    def __len__(self):
+        return len(self.items)
+
+    def overlapping(self, coordinate_pair):
+        """Returns the sorted indices of all items overlapping coordinate_pair"""
+        low, high = coordinate_pair
+        found = []
+        pending = [-1]
+        while pending:
+            children, stops = self.sublists[pending.pop()]
+            for position in range(bisect.bisect_left(stops, low), len(children)):
+                index = children[position]
+                if self.starts[index] > high:
+                    break
+                found.append(index)
+                if index in self.sublists:
+                    pending.append(index)
+        found.sort()
+        return found
+
+def count_covering(boundaries, starts, stops):
+    """Returns the number of start-stop intervals covering each segment that
+    starts at a boundary, every start and stop+1 must be a boundary
+    """
+    opened = collections.Counter(starts)
+    closed = collections.Counter(stop + 1 for stop in stops)
+    changes = (opened.get(boundary, 0) - closed.get(boundary, 0) for boundary in boundaries)
+    return array('l', itertools.accumulate(changes))
+
+def segment_members(segment_of, counts, starts, stops):
+    """Lists the start-stop intervals covering each segment, segment_of maps
+    every boundary to it's segment and counts are the count_covering of the
+    intervals
+    Returns (offsets, members), the positions in starts and stops of the
+    intervals covering segment i are members[offsets[i]:offsets[i+1]]
+    """
+    offsets = array('l', [0])
+    offsets.extend(itertools.accumulate(counts))
+    members = array('l', [0])*offsets[-1]
+    # Next free position of every segment in members
+    filled = offsets[:-1]
+    for position, (start, stop) in enumerate(zip(starts, stops)):
+        for segment in range(segment_of[start], segment_of[stop+1]):
+            members[filled[segment]] = position
+            filled[segment] += 1
+    return offsets, members
+
+FEATURE_COLUMNS = ('feature_genes', 'feature_starts', 'feature_stops', 'feature_strands',
+                   'feature_type_ids')
+# Feature types are bits of the segment_types masks
+MAX_FEATURE_TYPES = 63
+# Exons, introns, combos and true directions only count features of the
+# first (primary) type, the others are only counted by their type masks
+PRIMARY_TYPE = 0
+
+class GeneView(object):
+    """A gene of a Genes table, with the location, direction and features of
+    Region.Gene. Views only hold the table and the gene's slot in it
+    """
+    __slots__ = ('table', 'slot')
+    def __init__(self, table, slot):
+        self.table = table
+        self.slot = slot
+
+    @property
+    def gene_id(self):
+        return self.table.gene_ids[self.slot]
+
+    @property
+    def location(self):
+        return (self.table.gene_starts[self.slot], self.table.gene_stops[self.slot])
+
+    @property
+    def direction(self):
+        return STRAND_NAMES[self.table.gene_strands[self.slot]]
+
+    @property
+    def features(self):
+        """The gene's features as a sorted list of Region.Feature"""
+        table = self.table
+        table.sort_features()
+        return [Region.Feature((table.feature_starts[j], table.feature_stops[j]),
+                               STRAND_NAMES[table.feature_strands[j]],
+                               table.feature_type_ids[j])
+                for j in table.feature_range(self.slot)]
+
+    def __repr__(self):
+        return 'GeneView({!r}, {!r}, {!r})'.format(self.gene_id, self.location, self.direction)
+
+class Genes(collections.abc.Mapping):
+    """Mapping of gene ids to the GeneViews of a region, stored in columns
+
+    Genes are kept in insertion order in gene_ids (interned) and the
+    gene_starts, gene_stops and gene_strands (1, -1 or 0) arrays. Features
+    are appended to the feature_genes (gene slot), feature_starts,
+    feature_stops, feature_strands and feature_type_ids (position in the
+    region's feature types) arrays and sorted by gene and location once
+    when they are read, then the features of the gene in slot i are
+    feature_offsets[i]:feature_offsets[i+1]
+    """
+    def __init__(self):
+        self.gene_ids = []
+        self.slots = {}
+        self.gene_starts = array('l')
+        self.gene_stops = array('l')
+        self.gene_strands = array('b')
+        self.feature_genes = array('l')
+        self.feature_starts = array('l')
+        self.feature_stops = array('l')
+        self.feature_strands = array('b')
+        self.feature_type_ids = array('b')
+        self.feature_offsets = array('l', [0])
+        self.sorted = True
+
+    @classmethod
+    def from_arrays(cls, gene_ids, gene_starts, gene_stops, gene_strands, feature_offsets,
+                    feature_starts, feature_stops, feature_strands, feature_type_ids=None):
+        """Builds a table from sorted columns, such as the memoryviews of a
+        region index. They are only copied if genes or features are added.
+        Without feature_type_ids every feature has the first type
+        """
+        genes = cls.__new__(cls)
+        genes.gene_ids = [sys.intern(gene_id) for gene_id in gene_ids]
+        genes.slots = {gene_id: slot for slot, gene_id in enumerate(genes.gene_ids)}
+        genes.gene_starts = gene_starts
+        genes.gene_stops = gene_stops
+        genes.gene_strands = gene_strands
+        genes.feature_genes = None
+        genes.feature_starts = feature_starts
+        genes.feature_stops = feature_stops
+        genes.feature_strands = feature_strands
+        if feature_type_ids is None:
+            feature_type_ids = array('b', bytes(len(feature_starts)))
+        genes.feature_type_ids = feature_type_ids
+        genes.feature_offsets = feature_offsets
+        genes.sorted = True
+        return genes
+
+    def __getitem__(self, gene_id):
+        return GeneView(self, self.slots[gene_id])
+
+    def __iter__(self):
+        return iter(self.gene_ids)
+
+    def __len__(self):
+        return len(self.gene_ids)
+
+    def __setitem__(self, gene_id, gene):
+        """Adds or replaces a gene with a Region.Gene"""
+        slot = self.slots.get(gene_id)
+        if slot is None:
+            slot = self.add_gene(gene_id, gene.location, gene.direction)
+        else:
+            self.make_writable()
+            self.gene_starts[slot], self.gene_stops[slot] = gene.location
+            self.gene_strands[slot] = STRAND_SIGNS.get(gene.direction, 0)
+            self.remove_features(slot)
+        for feature in gene.features:
+            self.add_feature(slot, feature.location, feature.direction, feature.type)
+
+    def make_writable(self):
+        """Copies columns that are not arrays into arrays"""
+        if self.feature_genes is not None:
+            return
+        for name, typecode in (('gene_starts', 'l'), ('gene_stops', 'l'), ('gene_strands', 'b'),
+                               ('feature_starts', 'l'), ('feature_stops', 'l'),
+                               ('feature_strands', 'b'), ('feature_type_ids', 'b'),
+                               ('feature_offsets', 'l')):
+            setattr(self, name, array(typecode, getattr(self, name)))
+        self.feature_genes = self.feature_slots()
+
+    def add_gene(self, gene_id, location, direction):
+        """Adds a gene unless gene_id exists, returns the gene's slot"""
+        slot = self.slots.get(gene_id)
+        if slot is None:
+            self.make_writable()
+            if isinstance(gene_id, str):
+                gene_id = sys.intern(gene_id)
+            slot = self.slots[gene_id] = len(self.gene_ids)
+            self.gene_ids.append(gene_id)
+            self.gene_starts.append(location[0])
+            self.gene_stops.append(location[1])
+            self.gene_strands.append(STRAND_SIGNS.get(direction, 0))
+            self.feature_offsets.append(self.feature_offsets[-1])
+        return slot
+
+    def add_feature(self, slot, location, direction, type_id=0):
+        """Appends a feature of the gene in slot, features are sorted later"""
+        self.make_writable()
+        self.feature_genes.append(slot)
+        self.feature_starts.append(location[0])
+        self.feature_stops.append(location[1])
+        self.feature_strands.append(STRAND_SIGNS.get(direction, 0))
+        self.feature_type_ids.append(type_id)
+        self.sorted = False
+
+    def remove_features(self, slot):
+        keep = [j for j, gene in enumerate(self.feature_genes) if gene != slot]
+        for name in FEATURE_COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, [column[j] for j in keep]))
+        self.sorted = False
+
+    def sort_features(self):
+        """Sorts the appended features by gene, location, strand and type
+        once and rebuilds feature_offsets
+        """
+        if self.sorted:
+            return
+        order = [feature[-1] for feature in sorted(zip(self.feature_genes,
+                                                       self.feature_starts,
+                                                       self.feature_stops,
+                                                       map(STRAND_ORDER.__getitem__,
+                                                           self.feature_strands),
+                                                       self.feature_type_ids,
+                                                       itertools.count()))]
+        for name in FEATURE_COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, [column[j] for j in order]))
+        counts = collections.Counter(self.feature_genes)
+        self.feature_offsets = array('l', [0])
+        self.feature_offsets.extend(itertools.accumulate([counts.get(slot, 0)
+                                                          for slot in range(len(self.gene_ids))]))
+        self.sorted = True
+
+    def feature_slots(self):
+        """Returns the gene slot of every sorted feature"""
+        self.sort_features()
+        if self.feature_genes is not None:
+            return self.feature_genes
+        return array('l', itertools.chain.from_iterable(
+            itertools.repeat(slot, self.feature_offsets[slot+1] - self.feature_offsets[slot])
+            for slot in range(len(self.gene_ids))))
+
+    def intron_columns(self):
+        """Returns the gene slots, starts and stops of the introns of every gene"""
+        self.sort_features()
+        slots, starts, stops = array('l'), array('l'), array('l')
+        for slot in range(len(self.gene_ids)):
+            for start, stop in self.introns(slot):
+                slots.append(slot)
+                starts.append(start)
+                stops.append(stop)
+        return slots, starts, stops
+
+    def feature_range(self, slot):
+        return range(self.feature_offsets[slot], self.feature_offsets[slot+1])
+
+    def primary_columns(self, *columns):
+        """Returns the positions of the sorted features of the primary type
+        followed by the feature columns restricted to them
+        """
+        self.sort_features()
+        if not any(self.feature_type_ids):
+            return (range(len(self.feature_starts)),) + columns
+        positions = array('l', [position for position, type_id
+                                in enumerate(self.feature_type_ids)
+                                if type_id == PRIMARY_TYPE])
+        return (positions,) + tuple([column[position] for position in positions]
+                                    for column in columns)
+
+    def introns(self, slot):
+        """Yields the parts of the gene in slot that are not covered by it's
+        own features of the primary type, features must be sorted
+        """
+        position, stop = self.gene_starts[slot], self.gene_stops[slot]
+        for j in self.feature_range(slot):
+            if self.feature_type_ids[j] != PRIMARY_TYPE:
+                continue
+            if self.feature_starts[j] > position:
+                yield (position, self.feature_starts[j]-1)
+            position = max(position, self.feature_stops[j]+1)
+        if position <= stop:
+            yield (position, stop)
+
 class Region(object):
     """Class that handels the region information in GFF3 files"""
 
     Gene = namedtuple('Gene', ['location', 'direction', 'features'])
-    Feature = namedtuple('Feature', ['location', 'direction'])
-    def __init__(self, length, direction):
+    # type is the position of the feature's type in the region's feature types
+    Feature = namedtuple('Feature', ['location', 'direction', 'type'], defaults=(0,))
+    def __init__(self, length, direction, feature_types=('exon',)):
         self.length = length
         self.direction = direction
-        self.genes = dict()
+        self.feature_types = tuple(feature_types)
+        self.genes = Genes()
+        self.gene_index = None
+        self.feature_indices = None
+        self.gene_strands = None
+        self.feature_strands = None
+        self.boundaries = None
+        self.segment_genes = None
+        self.segment_exons = None
+        self.segment_introns = None
+        self.segment_types = None
+        self.segment_gene_offsets = None
+        self.segment_gene_slots = None
+        self.segment_feature_offsets = None
+        self.segment_features = None
+        self.segment_forwards = None
+        self.segment_reverses = None
 
-    def add_feature(self, feature, location, direction, semicolon_params):
-        """Adds either gene to self.genes or exon to a gene in self.genes
+    def add_feature(self, feature, location, direction, gene_id):
+        """Adds either gene to self.genes or a feature of one of
+        self.feature_types to a gene in self.genes, other features are ignored
         """
-        split_semi = split_gen(semicolon_params, ',:;=')
-        if feature == 'exon':
-            try:
-                for i in range(6): next(split_semi)
-                bisect.insort_left(self.genes[next(split_semi)].features, self.Feature(location, direction))
-            except KeyError:
-                warnings.warn('Exon found that doesnt match a gene') #TODO elaborate more
-        elif feature == 'gene':
-            for i in range(4): next(split_semi)
-            self.genes.setdefault(next(split_semi), self.Gene(location, direction, []))
+        self.gene_index = None
+        self.boundaries = None
+        if feature == 'gene':
+            self.genes.add_gene(gene_id, location, direction)
+        elif feature == 'region':
+            self.length = max(self.length or 0, location[1])
+        elif feature in self.feature_types:
+            slot = self.genes.slots.get(gene_id)
+            if slot is None:
+                warnings.warn('{} found that doesnt match a gene: {}'.format(feature, gene_id))
+            else:
+                self.genes.add_feature(slot, location, direction,
+                                       self.feature_types.index(feature))
+
+    def build_index(self):
+        """Builds the overlap indices and segments of the region
+        Loaded regions only build segments, their interval index is built
+        when it is first needed
+        """
+        self.build_interval_index()
+        self.build_segments()
+
+    def build_interval_index(self):
+        """Builds the overlap indices of the genes and their features of the
+        primary type and their strands as 1, -1 or 0 (unstranded) in index order
+        """
+        self.genes.sort_features()
+        self.gene_index = IntervalIndex(self.genes.values())
+        self.feature_indices = [IntervalIndex([feature for feature in gene.features
+                                               if feature.type == PRIMARY_TYPE])
+                                for gene in self.gene_index.items]
+        self.gene_strands = array('b', [self.genes.gene_strands[gene.slot]
+                                        for gene in self.gene_index.items])
+        self.feature_strands = [array('b', [STRAND_SIGNS.get(feature.direction, 0)
+                                            for feature in feature_index.items])
+                                for feature_index in self.feature_indices]
+
+    def build_segments(self):
+        """Splits the region at every gene and feature boundary
+
+        self.boundaries holds the sorted start of every segment. Within a
+        segment the overlapping genes and features don't change, so the
+        classification of any sequence inside one segment is precomputed:
+            segment_genes: number of genes covering the segment
+            segment_exons: number of primary type features covering the
+                           segment
+            segment_introns: number of genes covering the segment without
+                             one of their own primary features covering it
+            segment_types: bit i is set if a feature of feature_types[i]
+                           covers the segment
+        and the genes and features covering it (see build_segment_members).
+        Intron starts and stops are feature or gene boundaries already
+        """
+        genes = self.genes
+        genes.sort_features()
+        introns = genes.intron_columns()
+        boundaries = set(genes.gene_starts)
+        boundaries.update(genes.feature_starts)
+        boundaries.update(stop + 1 for stop in genes.gene_stops)
+        boundaries.update(stop + 1 for stop in genes.feature_stops)
+        self.boundaries = array('l', sorted(boundaries))
+        self.segment_genes = count_covering(self.boundaries, genes.gene_starts, genes.gene_stops)
+        _, primary_starts, primary_stops = genes.primary_columns(genes.feature_starts,
+                                                                 genes.feature_stops)
+        self.segment_exons = count_covering(self.boundaries, primary_starts, primary_stops)
+        self.segment_introns = count_covering(self.boundaries, introns[1], introns[2])
+        self.segment_types = array('l', [0])*len(self.boundaries)
+        for type_id in range(len(self.feature_types)):
+            chosen = [j for j, feature_type in enumerate(genes.feature_type_ids)
+                      if feature_type == type_id]
+            covering = count_covering(self.boundaries,
+                                      [genes.feature_starts[j] for j in chosen],
+                                      [genes.feature_stops[j] for j in chosen])
+            for segment, count in enumerate(covering):
+                if count:
+                    self.segment_types[segment] |= 1 << type_id
+        self.build_segment_members()
+        self.build_direction_segments(introns)
+
+    def build_segment_members(self):
+        """Lists the genes and features covering every segment:
+            segment_gene_slots[segment_gene_offsets[i]:segment_gene_offsets[i+1]]
+                are the slots of the genes covering segment i
+            segment_features[segment_feature_offsets[i]:segment_feature_offsets[i+1]]
+                are the positions of the primary features covering it in the
+                sorted feature columns
+        Segments past the last boundary are covered by nothing
+        """
+        genes = self.genes
+        genes.sort_features()
+        segment_of = dict(zip(self.boundaries, itertools.count()))
+        self.segment_gene_offsets, self.segment_gene_slots = segment_members(
+            segment_of, self.segment_genes, genes.gene_starts, genes.gene_stops)
+        positions, starts, stops = genes.primary_columns(genes.feature_starts,
+                                                         genes.feature_stops)
+        self.segment_feature_offsets, self.segment_features = segment_members(
+            segment_of, self.segment_exons, starts, stops)
+        if not isinstance(positions, range):
+            self.segment_features = array('l', [positions[feature]
+                                                for feature in self.segment_features])
+
+    def build_direction_segments(self, introns=None):
+        """Precomputes the true directions of a forward sequence inside each
+        segment, a reverse sequence swaps them:
+            segment_forwards: primary features (and genes without one of
+                              their own) covering the segment with a strand product
+                              of 1 with their gene and the region
+            segment_reverses: the same with a strand product of -1
+        Features are clipped to their gene, so every start and stop is a
+        boundary. introns are the genes' intron_columns if already known
+        """
+        genes = self.genes
+        if introns is None:
+            introns = genes.intron_columns()
+        region_strand = STRAND_SIGNS.get(self.direction, 0)
+        gene_strands = [region_strand*strand for strand in genes.gene_strands]
+        _, feature_genes, feature_starts, feature_stops, feature_strands = genes.primary_columns(
+            genes.feature_slots(), genes.feature_starts, genes.feature_stops,
+            genes.feature_strands)
+        forward_starts, forward_stops = [], []
+        reverse_starts, reverse_stops = [], []
+
+        def add(start, stop, strand):
+            if strand > 0:
+                forward_starts.append(start)
+                forward_stops.append(stop)
+            elif strand < 0:
+                reverse_starts.append(start)
+                reverse_stops.append(stop)
+
+        for gene, start, stop, strand in zip(feature_genes, feature_starts, feature_stops,
+                                             feature_strands):
+            start = max(start, genes.gene_starts[gene])
+            stop = min(stop, genes.gene_stops[gene])
+            # Features entirely outside of their gene have no strand
+            if start <= stop:
+                add(start, stop, gene_strands[gene]*strand)
+        for gene, start, stop in zip(*introns):
+            add(start, stop, gene_strands[gene])
+        self.segment_forwards = count_covering(self.boundaries, forward_starts, forward_stops)
+        self.segment_reverses = count_covering(self.boundaries, reverse_starts, reverse_stops)
 
     Classification = namedtuple('Classification',
                                 ['intergene', 'exons', 'introns', 'combos'])
@@ -100,31 +835,96 @@ class Region(object):
         """Determines in read sequence is:
               exonic, intronic, intergenic, or a combination
         """
-        exons, introns, combos = 0, 0, 0
+        if self.boundaries is None:
+            self.build_segments()
+        first_segment = bisect.bisect_right(self.boundaries, sequence_location[0]) - 1
+        last_segment = bisect.bisect_right(self.boundaries, sequence_location[1]) - 1
+        return self.classify_segments(first_segment, last_segment)
+
+    def classify_segments(self, first_segment, last_segment):
+        """Classifies a sequence from the segments it touches, segment -1 is
+        before the first boundary
 
-        matching_genes = self.gene_location_match(sequence_location)
-        if len(matching_genes) is 0:
+        Every gene covering one of the segments counts an intron if none of
+        it's primary features do, every primary feature of those genes
+        covering one of the segments an exon if it covers all of them (so it contains the
+        sequence) or a combo otherwise
+        """
+        first = max(first_segment, 0)
+        gene_offsets = self.segment_gene_offsets
+        genes = set(self.segment_gene_slots[gene_offsets[first]:gene_offsets[last_segment+1]])
+        if not genes:
             return self.Classification(1, 0, 0, 0)
 
-        for match in matching_genes:
-            feature_matches = self.overlapping_coordinate_match(match.value.features, sequence_location)
-            if len(feature_matches) is 0:
-                introns += 1
+        touched = last_segment - first_segment + 1
+        feature_offsets = self.segment_feature_offsets
+        features = collections.Counter(
+            self.segment_features[feature_offsets[first]:feature_offsets[last_segment+1]])
+        exons, combos, exon_genes = 0, 0, set()
+        for feature, segments in features.items():
+            gene = bisect.bisect_right(self.genes.feature_offsets, feature) - 1
+            if gene not in genes:
+                continue
+            exon_genes.add(gene)
+            if segments == touched:
+                exons += 1
+            else:
+                combos += 1
+        return self.Classification(False, exons, len(genes - exon_genes), combos)
 
-            for feature_match in feature_matches:
-                if feature_match.lower != feature_match.upper:
-                    combos += 1
-                elif feature_match.lower and feature_match.upper:
-                    exons += 1
+    def type_mask(self, first_segment, last_segment):
+        """Returns the feature types of the segments as a bitmask"""
+        mask = 0
+        for segment in range(max(first_segment, 0), last_segment + 1):
+            mask |= self.segment_types[segment]
+        return mask
 
-        return self.Classification(False, exons, introns, combos)
+    def count_directions(self, sequence_location, strand):
+        """Counts the true directions of a sequence on strand (1 or -1)
+
+        Every overlapping primary feature counts the product of the region,
+        gene, feature and sequence strands, a gene without an overlapping
+        primary feature of it's own the product of the region, gene and sequence strands and
+        a sequence outside of every gene the region and sequence strands.
+        Returns (forwards, reverses), the number of products of 1 and -1
+        """
+        if self.gene_index is None:
+            self.build_interval_index()
+        strand *= STRAND_SIGNS.get(self.direction, 0)
+        genes = self.gene_index.overlapping(sequence_location)
+        if not genes:
+            return (1, 0) if strand > 0 else (0, 1) if strand < 0 else (0, 0)
+        forwards, reverses = 0, 0
+        for gene in genes:
+            gene_strand = strand * self.gene_strands[gene]
+            if not gene_strand:
+                continue
+            features = self.feature_indices[gene].overlapping(sequence_location)
+            if not features:
+                if gene_strand > 0:
+                    forwards += 1
+                else:
+                    reverses += 1
+                continue
+            feature_strands = self.feature_strands[gene]
+            for feature in features:
+                feature_strand = gene_strand * feature_strands[feature]
+                if feature_strand > 0:
+                    forwards += 1
+                elif feature_strand < 0:
+                    reverses += 1
+        return forwards, reverses
 
     def gene_location_match(self, sequence_location):
-        """Finds the gene(s) that a sequence aligns too
-        Walks up or down from a binary coordinate match"""
-        sorted_genes = sorted(self.genes.values())
-        return self.overlapping_coordinate_match(sorted_genes,
-                                                 sequence_location)
+        """Finds all the genes that a sequence overlaps"""
+        if self.gene_index is None:
+            self.build_interval_index()
+        return self.index_match(self.gene_index, sequence_location)
+
+    def feature_location_match(self, gene_match, sequence_location):
+        """Finds all the features of a matched gene that a sequence overlaps"""
+        return self.index_match(self.feature_indices[gene_match.index],
+                                sequence_location)
 
     @staticmethod
     def coordinate_relations(coordinate_pair, relation_coordinate_pair):
@@ -136,64 +936,17 @@ class Region(object):
 
     Match = namedtuple('Match', ['index', 'lower', 'upper', 'value'])
     @classmethod
-    def overlapping_coordinate_match(cls, sorted_coordinates, coordinate_pair):
-        """Gets all matches in a sorted list of (possibly) overlapping
-        coordinate pairs"""
-        match1 = cls.binary_coordinate_match(sorted_coordinates,
-                                             coordinate_pair)
-        try:
-            matches_upper = cls.sequential_coordinate_match(sorted_coordinates,
-                                                            coordinate_pair,
-                                                            start=match1.index+1)
-            matches_lower = cls.sequential_coordinate_match(sorted_coordinates,
-                                                            coordinate_pair,
-                                                            start=match1.index-1,
-                                                            step=-1)
-            return [match1] + matches_lower + matches_upper
-        except TypeError:
-            return []
-
-    @classmethod
-    def binary_coordinate_match(cls, sorted_coordinates, coordinate_pair):
-        """Trys to figure out if the coordinate_pair is in an ordered list of
-        coordinate pairs using binary search
-        Returns the coordinate_pair
-        TODO:
-            match overlapping genes
+    def index_match(cls, interval_index, coordinate_pair):
+        """Gets all matches of coordinate_pair in an IntervalIndex
+        lower and upper are both False when coordinate_pair contains the match
         """
-        pair_average = (coordinate_pair[0]+coordinate_pair[1])/2
-        high = len(sorted_coordinates)
-        low = 0
-        while low < high:
-            mid = (low+high)//2
-            midval = sorted_coordinates[mid]
-            lower, upper = cls.coordinate_relations(midval.location, coordinate_pair)
-            if upper or lower:
-                return cls.Match(mid, lower, upper, midval)
-            elif midval.location[0] > pair_average:
-                high = mid
-            elif midval.location[0] < pair_average:
-                low = mid+1
-            else:
-                raise Exception('Unknown behavior') #TODO test
-        return cls.Match(None, None, None, None)
-
-    @classmethod
-    def sequential_coordinate_match(cls, sorted_coordinates, coordinate_pair, start=0, step=1):
-        """Searches for matches until none are found"""
         matches = []
-        while True:
-            try:
-                current = sorted_coordinates[start]
-            except IndexError:
-                return matches
-
-            lower, upper = cls.coordinate_relations(current.location, coordinate_pair)
-            if lower or upper:
-                matches.append(cls.Match(start, lower, upper, current))
-                start += step
-            else:
-                return matches
+        for index in interval_index.overlapping(coordinate_pair):
+            value = interval_index.items[index]
+            lower, upper = cls.coordinate_relations(value.location, coordinate_pair)
+            matches.append(cls.Match(index, lower, upper, value))
+        return matches
+
 
 class RegionMap(object):
     """Reads creates a feature location map from a gff file that can be
@@ -202,91 +955,182 @@ class RegionMap(object):
     Region Map Structure:
         {'RNAME': [gene: (([Features: (location, direction),], (coordinates: 0, 1))], Length}
     """
-    Region = namedtuple('Region', ['genes', 'length'])
     def __init__(self, gff_path=None, accepted_features='exon'):
         if isinstance(accepted_features, str):
             accepted_features = tuple([accepted_features])
-        self.feature_types = accepted_features
-        print(accepted_features)
+        self.feature_types = tuple(accepted_features)
+        if not self.feature_types or len(self.feature_types) > MAX_FEATURE_TYPES:
+            raise ValueError('Between 1 and {} feature types are supported: {}'.format(
+                MAX_FEATURE_TYPES, ','.join(self.feature_types)))
+        self.classification_cache = ClassificationCache()
+        self.unmatched_regions = collections.Counter()
         if gff_path is None:
             self.rmap = dict()
         else:
             self.rmap = self.read_gff(gff_path, feature_types=self.feature_types)
 
+    def build_indices(self):
+        """Builds every region and it's interval index, so processes forked
+        afterwards share them instead of building their own
+        """
+        for region in self.rmap.values():
+            if region.boundaries is None:
+                region.build_segments()
+            if region.gene_index is None:
+                region.build_interval_index()
+
     @classmethod
     def read_gff(cls, gff_path, feature_types):
         """Reads a gff file into a region map hash"""
         region_map = {}
-        feature_temp = {key: [] for key in feature_types}
-        with open(gff_path, 'r') as gff:
-            for count, line in enumerate(gff):
-                try:
-                    if line.startswith('#'):
-                        continue
-                    line_gen = split_gen(line, '\t ')
-                    region = next(line_gen)
-                    next(line_gen)
-                    feature = next(line_gen)
-                    location = (int(next(line_gen)), int(next(line_gen)))
-                    next(line_gen)
-                    direction = next(line_gen)
-                    next(line_gen)
-                    semicolon_params = next(line_gen)
-                    region_map = cls.add_feature(region_map, region, feature, location, direction, semicolon_params)
-                except StopIteration:
-                    warnings.warn('Invalid line: {} ... skipped'.format(count))
-        #return cls.calc_missing_region_lengths(region_map)
-        return region_map
+        gene_keys = {}
+        sequence_regions = {}
+        for record in gff.read_records(gff_path, sequence_regions):
+            gene_id = cls.resolve_gene_id(record, gene_keys, feature_types)
+            region_map = cls.add_feature(region_map,
+                                         record.seqid,
+                                         record.type,
+                                         (record.start, record.end),
+                                         record.strand,
+                                         gene_id,
+                                         feature_types)
+        for region in region_map.values():
+            region.build_segments()
+        return cls.calc_missing_region_lengths(region_map, sequence_regions)
 
     @staticmethod
-    def add_feature(region_map, region, feature, location, direction, semicolon_params):
-        try:
-            region_map[region].add_feature(feature,
-                                           location,
-                                           direction,
-                                           semicolon_params)
-        except KeyError:
-                try:
-                    region_map.setdefault(region, Region(location[1], direction))
-                except Exception as e:
-                    print(e)
-                    region_map.setdefault(region, Region(None, direction))
-
-                try:
-                    region_map[region].add_feature(feature,
-                                                   location,
-                                                   direction,
-                                                   semicolon_params)
-                except KeyError:
-                    pass
+    def resolve_gene_id(record, gene_keys, feature_types):
+        """Finds the id of the gene a GFF record belongs to
+
+        The Dbxref GeneID is used when present. Otherwise genes are keyed by
+        their ID and other features by the gene of their Parent. gene_keys
+        maps the IDs of genes and transcripts to gene ids for later children
+        """
+        gene_id = gff.get_dbxref(record.attributes, 'GeneID')
+        if gene_id is None:
+            if record.type == 'gene':
+                gene_id = gff.get_attribute(record.attributes, 'ID')
+            else:
+                parent = gff.get_attribute(record.attributes, 'Parent')
+                if parent is not None:
+                    gene_id = gene_keys.get(parent.partition(',')[0])
+        if gene_id is not None and record.type not in feature_types:
+            feature_id = gff.get_attribute(record.attributes, 'ID')
+            if feature_id is not None:
+                gene_keys[feature_id] = gene_id
+        return gene_id
+
+    @staticmethod
+    def add_feature(region_map, region, feature, location, direction, gene_id,
+                    feature_types=('exon',)):
+        if region not in region_map:
+            region_map[region] = Region(None, direction, feature_types)
+        region_map[region].add_feature(feature, location, direction, gene_id)
         return region_map
 
-    @classmethod
-    def calc_missing_region_lengths(cls, region_map):
-        """Calculates region lengths for regions without a region line
-        TODO: fix feature gathering
+    @staticmethod
+    def calc_missing_region_lengths(region_map, sequence_regions=None):
+        """Sets the length of every region to the end of it's
+        ##sequence-region directive, otherwise keeps the end of it's region
+        line, otherwise uses the largest stop of it's genes and features
         """
-        for key, region in region_map.items():
-            if region.length is None:
-                features = iter(region.features)
-                largest = next(features)
-                for feat in features:
-                    if largest < feat.location[1]: largest = feat.location[1]
-                region_map[key] = cls.Region(region.features, largest)
+        for name, region in region_map.items():
+            if sequence_regions and name in sequence_regions:
+                region.length = sequence_regions[name][1]
+            elif region.length is None:
+                region.length = max(itertools.chain(region.genes.gene_stops,
+                                                    region.genes.feature_stops), default=0)
         return region_map
 
-    @lru_cache(maxsize=None)
     def get_location_clasification(self,
                                    region_name,
                                    location_start,
                                    location_stop):
         """Gets location classification from region_map"""
         try:
-            return self.rmap[region_name].classify_sequence((location_start,
-                                                             location_stop))
+            region = self.rmap[region_name]
         except KeyError:
             warnings.warn('Region name {} not found in the region map'.format(region_name))
+            self.unmatched_regions[region_name] += 1
             return 0
+        if region.boundaries is None:
+            region.build_segments()
+        first_segment = bisect.bisect_right(region.boundaries, location_start) - 1
+        last_segment = bisect.bisect_right(region.boundaries, location_stop) - 1
+        if first_segment == last_segment:
+            if first_segment < 0 or region.segment_genes[first_segment] == 0:
+                return Region.Classification(1, 0, 0, 0)
+            return Region.Classification(False,
+                                         region.segment_exons[first_segment],
+                                         region.segment_introns[first_segment],
+                                         0)
+        return self.classify_segments(region_name, region, first_segment, last_segment,
+                                      location_start, location_stop)
+
+    def classify_segments(self, region_name, region, first_segment, last_segment,
+                          location_start, location_stop):
+        """Classifies a sequence that spans more than one segment of a region
+
+        The classification only depends on the segments the sequence touches,
+        so results are cached by (region_name, first_segment, last_segment)
+        """
+        key = (region_name, first_segment, last_segment)
+        classification = self.classification_cache.get(key)
+        if classification is None:
+            classification = region.classify_segments(first_segment, last_segment)
+            self.classification_cache.put(key, classification)
+        return classification
+
+    def classify_batch(self, region_names, location_starts, location_stops, type_masks=None):
+        """Classifies a batch of sequence locations
+
+        Sequences that fall inside one segment of their region are classified
+        with a single binary search on the region's boundaries, others fall
+        back to the cached Region.classify_sequence. If type_masks is given
+        it is filled with the feature types overlapping every sequence as a
+        bitmask of the region's segment_types.
+        Returns a Classification of arrays with one count per sequence
+        """
+        size = len(location_starts)
+        classification = Region.Classification(array('l', [0])*size,
+                                                array('l', [0])*size,
+                                                array('l', [0])*size,
+                                                array('l', [0])*size)
+        intergenes, exons, introns, combos = classification
+        missing = collections.Counter()
+        region_name, region = None, None
+        for i in range(size):
+            if region_names[i] != region_name:
+                region_name = region_names[i]
+                region = self.rmap.get(region_name)
+                if region is not None and region.boundaries is None:
+                    region.build_segments()
+            if region is None:
+                missing[region_name] += 1
+                continue
+
+            start, stop = location_starts[i], location_stops[i]
+            segment = bisect.bisect_right(region.boundaries, start) - 1
+            last_segment = bisect.bisect_right(region.boundaries, stop) - 1
+            if segment == last_segment:
+                if segment < 0 or region.segment_genes[segment] == 0:
+                    intergenes[i] = 1
+                else:
+                    exons[i] = region.segment_exons[segment]
+                    introns[i] = region.segment_introns[segment]
+                    if type_masks is not None:
+                        type_masks[i] = region.segment_types[segment]
+            else:
+                intergenes[i], exons[i], introns[i], combos[i] = \
+                    self.classify_segments(region_name, region, segment, last_segment,
+                                           start, stop)
+                if type_masks is not None:
+                    type_masks[i] = region.type_mask(segment, last_segment)
+
+        for region_name in missing:
+            warnings.warn('Region name {} not found in the region map'.format(region_name))
+        self.unmatched_regions.update(missing)
+        return classification
 
     @staticmethod
     def convert_direction(direction):
@@ -295,61 +1139,94 @@ class RegionMap(object):
         True is forward
         False is revers
         """
-        if direction is 0 or direction is '+':
+        if direction == '+':
             return True
-        elif direction is 16 or direction is '-':
+        elif direction == '-':
             return False
+        elif isinstance(direction, int):
+            return not direction & REVERSE_FLAG
         else:
             return None
 
+    Directions = namedtuple('Directions', ['forwards', 'reverses'])
     def get_true_directions(self, region_name, sequence_location, sequence_direction):
         """Gets the true direction of a sequence by the directions of it's
         parent sequences in the region map
+
+        sequence_direction is a SAM flag or a GFF3 strand, '+' or '-'
+        """
+        return self.Directions(*self.count_true_directions(region_name,
+                                                           (sequence_location,),
+                                                           direction_flag(sequence_direction)))
+
+    def count_true_directions(self, region_name, blocks, flag):
+        """Counts the true directions of the reference blocks of an alignment
+
+        The strand comes from the reverse bit of flag. Blocks inside one
+        segment of the region are a single binary search on it's boundaries,
+        others fall back to Region.count_directions.
+        Returns (forwards, reverses) summed over the blocks
+        """
+        region = self.rmap[region_name]
+        if region.boundaries is None:
+            region.build_segments()
+        segment = bisect.bisect_right(region.boundaries, blocks[0][0]) - 1 if blocks else -1
+        return self.count_block_directions(region, blocks, flag, segment)
+
+    @staticmethod
+    def count_block_directions(region, blocks, flag, segment):
+        """count_true_directions of blocks on region, segment is the segment
+        of the first block's start. Later blocks are searched from it
+        """
+        strand = -1 if flag & REVERSE_FLAG else 1
+        outside_strand = strand * STRAND_SIGNS.get(region.direction, 0)
+        boundaries = region.boundaries
+        last_segment = len(boundaries) - 1
+        forwards, reverses = 0, 0
+        for i, (start, stop) in enumerate(blocks):
+            if i:
+                segment = bisect.bisect_right(boundaries, start, max(segment, 0)) - 1
+            if segment < last_segment and stop >= boundaries[segment+1]:
+                block_forwards, block_reverses = region.count_directions((start, stop), strand)
+                forwards += block_forwards
+                reverses += block_reverses
+            elif segment < 0 or region.segment_genes[segment] == 0:
+                if outside_strand > 0:
+                    forwards += 1
+                elif outside_strand < 0:
+                    reverses += 1
+            elif strand > 0:
+                forwards += region.segment_forwards[segment]
+                reverses += region.segment_reverses[segment]
+            else:
+                forwards += region.segment_reverses[segment]
+                reverses += region.segment_forwards[segment]
+        return forwards, reverses
+
+    def sweep_true_directions(self, region_name, alignments):
+        """Gets the true directions of alignments on one region in a single
+        sweep over the region's segments
+
+        alignments is an iterable of (qname, blocks, flag) sorted by the
+        start of their first block, as fetched from a coordinate sorted BAM
+        file. A segment cursor moves forward over the boundaries, so the
+        first block of an alignment needs no search, only the later blocks
+        of spliced alignments are searched from it. Alignments out of order
+        fall back to a search. Yields (qname, Directions) summed over the
+        blocks of every alignment
         """
-        Directions = namedtuple('Directions', ['forwards', 'reverses'])
         region = self.rmap[region_name]
-        region_direction = self.convert_direction(region.direction)
-        sequence_direction = self.convert_direction(sequence_direction)
-
-        raw_directions = []
-        matching_genes = region.gene_location_match(sequence_location)
-        for match in matching_genes:
-            match_direction = self.convert_direction(match.value.direction)
-            feature_matches = region.overlapping_coordinate_match(match.value.features, sequence_location)
-            if len(feature_matches) is 0:
-                raw_directions.append((region_direction, match_direction, sequence_direction))
-            for feature_match in feature_matches:
-                feature_direction = self.convert_direction(feature_match.value.direction)
-                raw_directions.append((region_direction, match_direction, feature_direction, sequence_direction))
-
-        if len(matching_genes) is 0:
-            raw_directions = (region_direction, sequence_direction)
-
-        directions = [eqiv(match) for match in raw_directions]
-        return Directions(forwards=directions.count(True), reverses=directions.count(False))
-
-IN_GFF = '/disk/bioscratch/Will/Drop_Box/GCF_001266775.1_Austrofundulus_limnaeus-1.0_genomic_andMITO.gff'
-IN_SAM = '/disk/bioscratch/Will/Drop_Box/HPF_small_RNA_022216.sam'
-OUT_CSV = '/disk/bioscratch/Will/Drop_Box/SamStat_output.v2.csv'
-
-if __name__ == '__main__':
-    test_start = timeit.default_timer()
-    rm = RegionMap(IN_GFF)
-    rm_end = timeit.default_timer()
-    print('Region map load Time: {} seconds'.format(rm_end-test_start))
-
-    am_start = timeit.default_timer()
-    am = AlignmentMap(IN_SAM)
-    am_end = timeit.default_timer()
-    print('Alignment map load Time: {} seconds'.format(am_end-am_start))
-
-    print('Total Run Time {} seconds'.format(am_end-test_start))
-
-    rm_list = list(rm.rmap.items())
-    cur = None
-    genes = None
-    for i in range(10000):
-        cur = rm_list[i]
-        genes = list(rm_list[i][1].genes.items())
-        if len(genes) > 100:
-            break
+        if region.boundaries is None:
+            region.build_segments()
+        boundaries = region.boundaries
+        last_segment = len(boundaries) - 1
+        segment = -1
+        for qname, blocks, flag in alignments:
+            if blocks:
+                start = blocks[0][0]
+                if segment >= 0 and start < boundaries[segment]:
+                    segment = bisect.bisect_right(boundaries, start) - 1
+                while segment < last_segment and boundaries[segment+1] <= start:
+                    segment += 1
+            yield qname, self.Directions(*self.count_block_directions(region, blocks, flag,
+                                                                      segment))
@@ -0,0 +1,204 @@
+""" Output
+This file contains the writers for samstat output rows. Rows are formatted
+as they are produced and written in large blocks, as delimited text (plain
+or gzip) or as Parquet row groups
+"""
+import gzip
+import io
+
+WRITE_BUFFER_SIZE = 1 << 20
+LINES_PER_WRITE = 10000
+ROWS_PER_GROUP = 1000000
+
+OUTPUT_FORMATS = ('tsv', 'gzip', 'parquet')
+OUTPUT_EXTENSIONS = {'tsv': '.tsv', 'gzip': '.tsv.gz', 'parquet': '.parquet'}
+
+def format_field(value):
+    """Formats one output field"""
+    if isinstance(value, str):
+        return value
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return str(int(value))
+    return str(value)
+
+def format_row(row, fields, delimiter='\t'):
+    """Formats the fields of a row into a delimited string
+    Raises AttributeError if the row is missing one of the fields
+    """
+    return delimiter.join([format_field(getattr(row, field)) for field in fields])
+
+def infer_format(path):
+    """Guesses the output format from the extension of path"""
+    if path.endswith('.parquet'):
+        return 'parquet'
+    if path.endswith('.gz'):
+        return 'gzip'
+    return 'tsv'
+
+class TsvWriter(object):
+    """Writes rows as delimited lines through a large write buffer
+
+    format() turns a row into a line, write() takes an iterable of lines.
+    Lines are separated by newlines with no trailing newline
+    """
+    def __init__(self, path, fields, compress=False, delimiter='\t'):
+        self.fields = fields
+        self.delimiter = delimiter
+        if compress:
+            self.ofile = io.TextIOWrapper(io.BufferedWriter(gzip.GzipFile(path, 'wb'),
+                                                            buffer_size=WRITE_BUFFER_SIZE))
+        else:
+            self.ofile = open(path, 'w', buffering=WRITE_BUFFER_SIZE)
+        self.lines_written = 0
+
+    def format(self, row):
+        return format_row(row, self.fields, self.delimiter)
+
+    def write(self, lines):
+        """Writes lines in blocks of LINES_PER_WRITE"""
+        block = []
+        for line in lines:
+            block.append(line)
+            if len(block) >= LINES_PER_WRITE:
+                self.write_block(block)
+                block = []
+        if block:
+            self.write_block(block)
+
+    def write_block(self, block):
+        if self.lines_written:
+            self.ofile.write('\n')
+        self.ofile.write('\n'.join(block))
+        self.lines_written += len(block)
+
+    def close(self):
+        self.ofile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ParquetWriter(object):
+    """Writes rows as Parquet row groups, requires pyarrow
+
+    format() turns a row into a tuple of typed values, write() takes an
+    iterable of those tuples. Fields in string_fields are written as strings,
+    all other fields as 64 bit integers. Rows are buffered across write()
+    calls, so callers writing small blocks still get full row groups
+    """
+    def __init__(self, path, fields, string_fields=()):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Parquet output requires pyarrow (pip install pyarrow)')
+        self.pyarrow = pyarrow
+        self.fields = fields
+        self.converters = [str if field in string_fields else int for field in fields]
+        self.schema = pyarrow.schema([(field, pyarrow.string() if field in string_fields
+                                       else pyarrow.int64()) for field in fields])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.group = []
+        self.lines_written = 0
+
+    def format(self, row):
+        return tuple([convert(getattr(row, field))
+                      for field, convert in zip(self.fields, self.converters)])
+
+    def write(self, rows):
+        """Writes rows in row groups of ROWS_PER_GROUP, the last group is
+        written by close()
+        """
+        group = self.group
+        for row in rows:
+            group.append(row)
+            self.lines_written += 1
+            if len(group) >= ROWS_PER_GROUP:
+                self.write_group(group)
+                group = self.group = []
+
+    def write_group(self, group):
+        columns = [list(column) for column in zip(*group)]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        if self.group:
+            self.write_group(self.group)
+            self.group = []
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_writer(path, fields, output_format=None, string_fields=()):
+    """Opens the writer for output_format, inferred from path if None"""
+    if output_format is None:
+        output_format = infer_format(path)
+    if output_format == 'parquet':
+        return ParquetWriter(path, fields, string_fields)
+    if output_format == 'gzip':
+        return TsvWriter(path, fields, compress=True)
+    if output_format == 'tsv':
+        return TsvWriter(path, fields)
+    raise ValueError('Output format {} is invalid'.format(output_format))
+
+def combine_outputs(sample_paths, out_path, fields, output_format=None, string_fields=()):
+    """Writes the outputs of several samples into one file with a leading
+    sample column
+
+    sample_paths is a list of (sample, path) pairs of outputs written with
+    fields in output_format, which is inferred from out_path if None
+    """
+    if output_format is None:
+        output_format = infer_format(out_path)
+    if output_format == 'parquet':
+        combine_parquet(sample_paths, out_path, fields, string_fields)
+        return
+    with open_writer(out_path, ['sample'] + list(fields), output_format) as writer:
+        for sample, path in sample_paths:
+            opener = gzip.open if output_format == 'gzip' else open
+            with opener(path, 'rt') as sample_file:
+                writer.write(sample + writer.delimiter + line.rstrip('\n')
+                             for line in sample_file)
+
+def combine_parquet(sample_paths, out_path, fields, string_fields=()):
+    """Concatenates Parquet outputs, adding a sample column"""
+    writer = ParquetWriter(out_path, ['sample'] + list(fields),
+                           set(string_fields) | {'sample'})
+    pyarrow = writer.pyarrow
+    import pyarrow.parquet
+    with writer:
+        for sample, path in sample_paths:
+            table = pyarrow.parquet.read_table(path)
+            table = table.add_column(0, 'sample', pyarrow.array([sample] * table.num_rows,
+                                                                pyarrow.string()))
+            writer.writer.write_table(table.cast(writer.schema))
+            writer.lines_written += table.num_rows
+
+def concatenate_outputs(paths, out_path, fields, output_format=None, string_fields=()):
+    """Writes the rows of several outputs written with fields in
+    output_format into one file, in order
+    Returns the number of rows written
+    """
+    if output_format is None:
+        output_format = infer_format(out_path)
+    with open_writer(out_path, fields, output_format, string_fields) as writer:
+        if output_format == 'parquet':
+            import pyarrow.parquet
+            for path in paths:
+                table = pyarrow.parquet.read_table(path)
+                writer.writer.write_table(table.cast(writer.schema))
+                writer.lines_written += table.num_rows
+        else:
+            opener = gzip.open if output_format == 'gzip' else open
+            for path in paths:
+                with opener(path, 'rt') as part:
+                    writer.write(line.rstrip('\n') for line in part)
+    return writer.lines_written
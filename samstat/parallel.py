@@ -0,0 +1,166 @@
+""" Parallel
+This file contains the code for running the qstat/truedir calculators on a
+pool of worker processes
+"""
+import collections
+import multiprocessing
+import warnings
+
+import pysam
+
+from samstat.maps import AlignmentMap
+from samstat.maps import reference_blocks
+
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_WINDOW_SIZE = 10000000
+
+# Set in the parent before the pool is forked so every worker shares the
+# RegionMap pages copy-on-write instead of receiving a pickled copy
+_worker_state = {}
+
+class QnameBatch(list):
+    """List of (qname, qdata) pairs with the items() interface of AlignmentMap"""
+    def items(self):
+        return iter(self)
+
+def batch_qnames(qname_data, batch_size):
+    """Groups QNAME data into lists of plain (qname, tuple) pairs"""
+    batch = []
+    for qname, qdata in qname_data.items():
+        batch.append((qname, tuple(qdata)))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def process_batch(batch):
+    """Runs the calculator on one batch and returns it's formatted lines"""
+    qname_batch = QnameBatch((qname, AlignmentMap.SamIn(*qdata))
+                             for qname, qdata in batch)
+    run_function = _worker_state['run_function']
+    format_line = _worker_state['format_line']
+    return [format_line(oline)
+            for oline in run_function(qname_batch, _worker_state['region_map'])]
+
+def imap_qname_batches(qname_data, region_map, run_function, format_line,
+                       workers, batch_size=DEFAULT_BATCH_SIZE):
+    """Yields formatted output lines computed by a pool of forked workers
+
+    Batches are submitted in input order and results are yielded in the same
+    order, so the output is identical to running run_function serially.
+    At most 2 batches per worker are in flight at once
+    """
+    _worker_state.update(region_map=region_map,
+                         run_function=run_function,
+                         format_line=format_line)
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            for lines in imap_batches(pool, batch_qnames(qname_data, batch_size), workers):
+                yield from lines
+    finally:
+        _worker_state.clear()
+
+def imap_batches(pool, batches, workers):
+    """Yields the lists of formatted lines of batches processed on pool, in
+    batch order, with at most 2 batches per worker in flight
+    """
+    pending = collections.deque()
+    for batch in batches:
+        pending.append(pool.apply_async(process_batch, (batch,)))
+        if len(pending) >= 2*workers:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def reference_windows(samfile, region_map, window_size, alignment_filter=None):
+    """Splits the references of an alignment file into windows
+    References missing from the region map are skipped with a warning, as
+    are windows outside the regions of alignment_filter
+    """
+    for reference, length in zip(samfile.references, samfile.lengths):
+        if alignment_filter is not None and alignment_filter.regions is not None:
+            if reference not in alignment_filter.regions:
+                continue
+        if reference not in region_map.rmap:
+            warnings.warn('Region name {} not found in the region map'.format(reference))
+            region_map.unmatched_regions[reference] += 1
+            continue
+        for start in range(0, length, window_size):
+            stop = min(start+window_size, length)
+            # Records starting in a window may reach the regions after it,
+            # only the windows after the last region are skipped
+            if (alignment_filter is not None and alignment_filter.regions is not None and
+                    not alignment_filter.overlaps(reference, start, length)):
+                break
+            yield reference, start, stop
+
+def process_window(window):
+    """Sums true directions per QNAME for the alignments starting in a window"""
+    reference, start, stop = window
+    region_map = _worker_state['region_map']
+    alignment_filter = _worker_state['alignment_filter']
+    with pysam.AlignmentFile(_worker_state['path'], 'rb') as samfile:
+        alignments = ((read.query_name,
+                       reference_blocks(read.reference_start, read.cigartuples),
+                       read.flag)
+                      for read in samfile.fetch(reference, start, stop)
+                      if read.reference_start >= start and
+                      (alignment_filter is None or alignment_filter.accepts(read)))
+        alignments = (alignment for alignment in alignments if alignment[1])
+        qnames = collections.OrderedDict()
+        for qname, directions in region_map.sweep_true_directions(reference, alignments):
+            counts = qnames.setdefault(qname, [0, 0])
+            counts[0] += directions.forwards
+            counts[1] += directions.reverses
+    return reference, qnames
+
+def imap_reference_truedirs(path, region_map, workers, window_size=DEFAULT_WINDOW_SIZE,
+                            alignment_filter=None):
+    """Yields (qname, rname, forward, reverse) from an indexed BAM file,
+    only for the records accepted by alignment_filter if it is set
+
+    References are split into windows that are processed on a pool of forked
+    workers. Partial counts of windows on the same reference are reduced in
+    window order, so rows are ordered by reference (header order) then by
+    the first alignment of each QNAME on that reference
+    """
+    with pysam.AlignmentFile(path, 'rb') as samfile:
+        samfile.check_index()
+        windows = list(reference_windows(samfile, region_map, window_size, alignment_filter))
+    _worker_state.update(region_map=region_map, path=path, alignment_filter=alignment_filter)
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            reference, qnames = None, collections.OrderedDict()
+            for window_reference, window_qnames in pool.imap(process_window, windows):
+                if window_reference != reference:
+                    for qname, counts in qnames.items():
+                        yield qname, reference, counts[0], counts[1]
+                    reference, qnames = window_reference, collections.OrderedDict()
+                for qname, counts in window_qnames.items():
+                    total = qnames.setdefault(qname, [0, 0])
+                    total[0] += counts[0]
+                    total[1] += counts[1]
+            for qname, counts in qnames.items():
+                yield qname, reference, counts[0], counts[1]
+    finally:
+        _worker_state.clear()
+
+def process_sample(sample):
+    """Runs the sample function on one sample"""
+    return _worker_state['process_function'](_worker_state['region_map'], *sample)
+
+def imap_samples(samples, region_map, process_function, workers):
+    """Yields process_function(region_map, *sample) for every sample
+
+    Samples are processed on a pool of forked workers, one sample per worker
+    at a time, so at most workers samples are in memory at once. Each worker
+    is replaced after it's sample to return it's memory. Results are yielded
+    in sample order
+    """
+    _worker_state.update(region_map=region_map, process_function=process_function)
+    try:
+        with multiprocessing.get_context('fork').Pool(workers, maxtasksperchild=1) as pool:
+            yield from pool.imap(process_sample, samples, chunksize=1)
+    finally:
+        _worker_state.clear()
@@ -0,0 +1,141 @@
+""" Pipeline
+This file contains the pipelined executor, which overlaps reading the
+alignment file, computing rows and writing them. A reader thread groups
+QNAMEs into batches, the calling thread (or a pool of forked workers)
+computes the lines of each batch and a writer thread writes them. The
+stages are connected by bounded queues, so a slow stage blocks the stages
+before it and at most queue_size batches wait between two stages
+"""
+import itertools
+import multiprocessing
+import queue
+import threading
+
+from samstat import parallel
+
+DEFAULT_QUEUE_SIZE = 4
+# Smaller than parallel.DEFAULT_BATCH_SIZE so the queues hold less
+DEFAULT_BATCH_SIZE = 1000
+PUT_TIMEOUT = 0.1
+
+# Put on a queue after the last item
+_DONE = object()
+
+class PipelineError(Exception):
+    """Raised in the calling thread when the reader or writer thread failed"""
+
+def put(items, item, stop):
+    """Puts item on the bounded queue items unless stop is set while waiting
+    Returns False if stopped
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def drain(items):
+    """Yields the items of a queue until _DONE, failures are re-raised"""
+    while True:
+        item = items.get()
+        if item is _DONE:
+            return
+        if isinstance(item, BaseException):
+            raise PipelineError('Pipeline reader failed') from item
+        yield item
+
+def batch_items(qname_data, batch_size):
+    """Groups the (qname, qdata) pairs of qname_data into lists"""
+    iterator = iter(qname_data.items())
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def read_batches(batches, out_queue, stop):
+    """Reader thread, puts batches on out_queue followed by _DONE"""
+    try:
+        for batch in batches:
+            if not put(out_queue, batch, stop):
+                return
+    except BaseException as error:
+        put(out_queue, error, stop)
+    finally:
+        put(out_queue, _DONE, stop)
+
+def write_blocks(writer, in_queue, errors):
+    """Writer thread, writes the line blocks of in_queue until _DONE
+
+    After a failure the rest of the queue is still consumed, so the compute
+    stage never blocks on a full queue
+    """
+    for block in drain(in_queue):
+        if errors:
+            continue
+        try:
+            writer.write(block)
+        except BaseException as error:
+            errors.append(error)
+
+def compute_blocks(batches, region_map, run_function, format_line):
+    """Yields the formatted lines of each batch computed in this thread"""
+    for batch in batches:
+        yield [format_line(oline)
+               for oline in run_function(parallel.QnameBatch(batch), region_map)]
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+def run_pipeline(qname_data, region_map, run_function, writer, workers=1,
+                 batch_size=DEFAULT_BATCH_SIZE, queue_size=DEFAULT_QUEUE_SIZE):
+    """Computes the rows of qname_data and writes them with writer, reading,
+    computing and writing at the same time
+
+    With more than 1 worker batches are computed on a pool of forked workers,
+    which is forked before the reader and writer threads start. Lines are
+    written in input order, so the output is identical to running
+    run_function serially. Reading (pysam decompression) and writing (gzip
+    and Parquet encoding) release the GIL, the compute stage is only
+    parallel with workers.
+    Returns the number of rows written
+    """
+    stop = threading.Event()
+    read_queue = queue.Queue(queue_size)
+    write_queue = queue.Queue(queue_size)
+    write_errors = []
+    pool = None
+    if workers > 1:
+        parallel._worker_state.update(region_map=region_map,
+                                      run_function=run_function,
+                                      format_line=writer.format)
+        pool = multiprocessing.get_context('fork').Pool(workers)
+        reader = start_thread(read_batches, parallel.batch_qnames(qname_data, batch_size),
+                              read_queue, stop)
+        blocks = parallel.imap_batches(pool, drain(read_queue), workers)
+    else:
+        reader = start_thread(read_batches, batch_items(qname_data, batch_size),
+                              read_queue, stop)
+        blocks = compute_blocks(drain(read_queue), region_map, run_function, writer.format)
+    writer_thread = start_thread(write_blocks, writer, write_queue, write_errors)
+    try:
+        for block in blocks:
+            if write_errors:
+                break
+            write_queue.put(block)
+    finally:
+        stop.set()
+        write_queue.put(_DONE)
+        writer_thread.join()
+        reader.join()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            parallel._worker_state.clear()
+    if write_errors:
+        raise PipelineError('Pipeline writer failed') from write_errors[0]
+    return writer.lines_written
@@ -1,38 +1,70 @@
 import argparse
+import cProfile
+import keyword
 import os
 import pysam
+import re
 import warnings
-import timeit
+from array import array
 from collections import namedtuple
 from operator import itemgetter
 
 import sys
 sys.path.append('..')
 
+from samstat.maps import Region
 from samstat.maps import RegionMap
-from samstat.maps import AlignmentMap
+from samstat.maps import AlignmentStream
+from samstat.maps import CompactAlignmentMap
+from samstat import checkpoint
+from samstat import coverage
+from samstat import filters
+from samstat import index
+from samstat import output
+from samstat.cache import ClassificationCache
+from samstat.cache import DEFAULT_CACHE_SIZE
+from samstat.stats import RunStats
+from samstat.stats import count_genes
+from samstat import parallel
+from samstat import pipeline
+from samstat import server
+from samstat.collapse import COLLAPSE_MODES
+from samstat.collapse import CollapsedQnames
+from samstat.collapse import count_rows
+from samstat.collapse import expand_rows
 
 
 true_dir_out_values = ['qname', 'rname', 'forward', 'reverse']
+TrueDirOutValues = namedtuple('TrueDirOutValues', true_dir_out_values)
 
 def calculate_truedirs(alignment_map, region_map):
-    """ """
-    TrueDirOutValues = namedtuple('TrueDirOutValues', out_values)
+    """Calculates the true directions of each QNAME per RNAME
+    Directions are summed over the reference blocks of every alignment
+    """
     for qname, qdata in alignment_map.items():
         rnames = dict()
-        for rname, location, direction in qdata.reference_names:
-            rnames.setdefault(rname, [0, 0])
+        for (rname, _, flag), blocks in zip(qdata.reference_names, qdata.blocks):
+            if not blocks:
+                continue
             try:
-                direction_count = region_map.get_true_directions(rname, (location, location+qdata.cigar[0][1]-1), direction)
-            except TypeError as e:
-                warnings.warn('Invalid direction type')
-                print(e)
+                forwards, reverses = region_map.count_true_directions(rname, blocks, flag)
+            except KeyError:
+                warnings.warn('Region name {} not found in the region map'.format(rname))
+                region_map.unmatched_regions[rname] += 1
                 continue
-            rnames[rname][0] += direction_count.forwards
-            rnames[rname][1] += direction_count.reverses
+            counts = rnames.setdefault(rname, [0, 0])
+            counts[0] += forwards
+            counts[1] += reverses
         for rname, directions in rnames.items():
             yield TrueDirOutValues(qname, rname, directions[0], directions[1])
 
+def calculate_reference_truedirs(in_bam, region_map, workers=1, alignment_filter=None):
+    """Calculates true directions per reference of a coordinate sorted,
+    indexed BAM file"""
+    for oline in parallel.imap_reference_truedirs(in_bam, region_map, workers,
+                                                  alignment_filter=alignment_filter):
+        yield TrueDirOutValues(*oline)
+
 
 qstat_out_values = ['qname',
                     'alignment_number',
@@ -43,93 +75,618 @@ qstat_out_values = ['qname',
                     'introns',
                     'intergenes',
                     'combos']
+QstatOutValues = namedtuple('QstatOutValues', qstat_out_values)
+
+string_out_values = {'qname', 'rname', 'unique_rnames_low', 'unique_rnames_high'}
+
+def feature_type_column(feature_type):
+    """Names the qstat count column of a feature type"""
+    column = re.sub(r'\W', '_', feature_type)
+    if (not column.isidentifier() or column.startswith('_') or keyword.iskeyword(column)
+            or column in qstat_out_values):
+        column = 'feature_' + column
+    return column
+
+def feature_type_columns(feature_types):
+    """Returns the per feature type qstat columns, which are only added when
+    there is more than one feature type
+    """
+    if len(feature_types) < 2:
+        return []
+    return [feature_type_column(feature_type) for feature_type in feature_types]
+
+_qstat_row_types = {(): QstatOutValues}
 
-def calculate_qstats(qname_data, region_map):
-    """Calculates statistics using SAM and GFF data"""
-    for qname, qdata in qname_data.items():
-        alignment_number = qdata.alignment_number[0]
-        try:
-            raw_rnames = [x[0] for x in qdata.reference_names]
-            unique_rnames = sorted({(x, raw_rnames.count(x)) for x in raw_rnames},
-                                   key=itemgetter(1))
-            unique_rnames_low = {x[0] for x in unique_rnames if x[1] == unique_rnames[0][1]}
-            unique_rnames_high = {x[0] for x in unique_rnames[::-1] if x[1] == unique_rnames[-1][1]}
-            unique_rnames_number = len(unique_rnames)
-            if unique_rnames_low == unique_rnames_high:
-                unique_rnames_low = unique_rnames_high = 'All{}'.format(unique_rnames[0][1])
-            else:
-                unique_rnames_low = len(unique_rnames_low)
-                unique_rnames_high = len(unique_rnames_high)
-
-            gff_classes = [region_map.get_location_clasification(rname, location, location+qdata.cigar[0][1]-1) for rname, location, _ in qdata.reference_names]
-
-            total_exons, total_introns, total_combos, total_intergenes = 0, 0, 0, 0
-            for classification in gff_classes:
-                total_exons += classification.exons
-                total_introns += classification.introns
-                total_intergenes += classification.intergene
-                total_combos += classification.combos
-
-            yield QstatOutValues(qname,
-                          alignment_number,
-                          unique_rnames_low,
-                          unique_rnames_high,
-                          unique_rnames_number,
-                          total_exons,
-                          total_introns,
-                          total_intergenes,
-                          total_combos)
-
-        except IndexError:
-            warnings.warn('QNAME data cannot be read, Skipping: {}'.format(qname))
+def qstat_row_type(feature_types):
+    """Returns the qstat row namedtuple of a set of feature types"""
+    columns = tuple(feature_type_columns(feature_types))
+    if columns not in _qstat_row_types:
+        _qstat_row_types[columns] = namedtuple('QstatOutValues',
+                                               qstat_out_values + list(columns))
+    return _qstat_row_types[columns]
+
+def parse_feature_types(value):
+    """Splits a comma separated list of feature types"""
+    feature_types = tuple(feature_type.strip() for feature_type in value.split(','))
+    if not all(feature_types):
+        raise argparse.ArgumentTypeError('feature types can not be empty')
+    return feature_types
+
+CLASSIFY_CHUNK_SIZE = 100000
+
+def chunk_qnames(qname_items, chunk_size):
+    """Groups (qname, qdata) pairs into chunks of about chunk_size alignments"""
+    chunk, alignments = [], 0
+    for qname, qdata in qname_items:
+        chunk.append((qname, qdata))
+        alignments += len(qdata.reference_names)
+        if alignments >= chunk_size:
+            yield chunk
+            chunk, alignments = [], 0
+    if chunk:
+        yield chunk
+
+def calculate_qstats(qname_data, region_map, chunk_size=CLASSIFY_CHUNK_SIZE):
+    """Calculates statistics using SAM and GFF data
+
+    The reference blocks of alignments are classified in chunks with
+    RegionMap.classify_batch, each block counts as one classification.
+    With more than one feature type the rows also count the blocks that
+    overlap each type, from the same batch query
+    """
+    feature_types = region_map.feature_types
+    QstatRow = qstat_row_type(feature_types)
+    type_bits = [1 << type_id for type_id in range(len(feature_types))]
+    for chunk in chunk_qnames(qname_data.items(), chunk_size):
+        rnames, starts, stops = [], [], []
+        block_counts = []
+        for qname, qdata in chunk:
+            for (rname, _, _), blocks in zip(qdata.reference_names, qdata.blocks):
+                for start, stop in blocks:
+                    rnames.append(rname)
+                    starts.append(start)
+                    stops.append(stop)
+            block_counts.append(len(rnames))
+        type_masks = array('l', [0])*len(starts) if len(type_bits) > 1 else None
+        intergenes, exons, introns, combos = region_map.classify_batch(rnames, starts, stops,
+                                                                       type_masks)
+
+        offset = 0
+        for (qname, qdata), block_count in zip(chunk, block_counts):
+            alignment_number = qdata.alignment_number[0]
+            first, offset = offset, block_count
+            raw_rnames = [x[0] for x in qdata.reference_names if x[0] is not None]
+            if not raw_rnames:
+                warnings.warn('QNAME has no mapped alignments, Skipping: {}'.format(qname))
+                continue
+            try:
+                unique_rnames = sorted({(x, raw_rnames.count(x)) for x in raw_rnames},
+                                       key=itemgetter(1))
+                unique_rnames_low = {x[0] for x in unique_rnames if x[1] == unique_rnames[0][1]}
+                unique_rnames_high = {x[0] for x in unique_rnames[::-1] if x[1] == unique_rnames[-1][1]}
+                unique_rnames_number = len(unique_rnames)
+                if unique_rnames_low == unique_rnames_high:
+                    unique_rnames_low = unique_rnames_high = 'All{}'.format(unique_rnames[0][1])
+                else:
+                    unique_rnames_low = len(unique_rnames_low)
+                    unique_rnames_high = len(unique_rnames_high)
+
+                type_counts = ()
+                if type_masks is not None:
+                    masks = type_masks[first:offset]
+                    type_counts = [sum(1 for mask in masks if mask & bit) for bit in type_bits]
+
+                yield QstatRow(qname,
+                              alignment_number,
+                              unique_rnames_low,
+                              unique_rnames_high,
+                              unique_rnames_number,
+                              sum(exons[first:offset]),
+                              sum(introns[first:offset]),
+                              sum(intergenes[first:offset]),
+                              sum(combos[first:offset]),
+                              *type_counts)
+
+            except IndexError:
+                warnings.warn('QNAME data cannot be read, Skipping: {}'.format(qname))
 
 def format_line_obj(line_obj, ordered_attributes, delimiter):
     """Formats an object into delimited string
 
-    If attribute not found, a ':(' will be inserted instead
+    Raises AttributeError if an attribute is not found
+    """
+    return output.format_row(line_obj, ordered_attributes, str(delimiter))
+
+
+def run(in_sam, in_gff, outpath, out_values, run_function, stream=False, workers=1,
+        by_reference=False, cache_size=DEFAULT_CACHE_SIZE, cache_file=None,
+        output_format=None, stats_path=None, profile_path=None, collapse=None,
+        pipelined=False, io_threads=1, feature_types=None, checkpoint_dir=None,
+        checkpoint_size=checkpoint.DEFAULT_CHECKPOINT_SIZE, alignment_filter=None):
+    """Runs SamStat functions
+
+    If stream is True the SAM/BAM file is read one QNAME group at a time,
+    which requires queryname sorted or collated input.
+    If workers is more than 1 QNAME batches are processed on a process pool.
+    If by_reference is True truedir is run per reference of a coordinate
+    sorted, indexed BAM file.
+    cache_size bounds the classification cache, if cache_file exists and
+    was saved for the same annotation file the cache is warmed from it before
+    any work (and before workers fork), it is saved to it at the end.
+    output_format is one of output.OUTPUT_FORMATS, inferred from outpath if None.
+    If stats_path is set per-stage statistics are written to it as JSON, if
+    profile_path is set the compute and output loop is profiled with cProfile
+    and the stats are dumped to it.
+    If collapse is one of collapse.COLLAPSE_MODES QNAMEs with identical
+    alignments are computed once. 'expand' writes the rows of every QNAME,
+    grouped by alignment signature instead of in input order, 'count' writes
+    the rows of the first QNAME of each signature with a count column.
+    If pipelined is True the SAM/BAM file is streamed and read, computed and
+    written at the same time (see pipeline.run_pipeline), io_threads is the
+    number of BAM decompression threads.
+    feature_types are the GFF feature types genes are made of (default exon),
+    qstat counts each of them when there is more than one. Exons, introns,
+    combos and true directions only count the first type.
+    If checkpoint_dir is set rows are computed in chunks of checkpoint_size
+    QNAME groups that are saved in it, a run restarted with the same inputs
+    and options resumes after the last saved chunk (see checkpoint).
+    If alignment_filter is set only the records it accepts are read (see
+    filters.AlignmentFilter)
+    """
+    run_stats = RunStats()
+    with run_stats.count_warnings():
+        region_map = load_region_map(in_gff, cache_size, cache_file, run_stats, feature_types)
+        process_sample(in_sam, region_map, outpath, out_values, run_function, stream=stream,
+                       workers=workers, by_reference=by_reference,
+                       output_format=output_format, profile_path=profile_path,
+                       collapse=collapse, pipelined=pipelined, io_threads=io_threads,
+                       run_stats=run_stats, checkpoint_dir=checkpoint_dir,
+                       checkpoint_size=checkpoint_size,
+                       checkpoint_key=cache_tag(in_gff, region_map),
+                       alignment_filter=alignment_filter)
+        if cache_file is not None:
+            region_map.classification_cache.save(cache_file, cache_tag(in_gff, region_map))
+    if stats_path is not None:
+        run_stats.save(stats_path, region_map)
+
+def cache_tag(in_gff, region_map):
+    """Identifies the annotation and feature types cached classifications
+    were computed from
+    """
+    return dict(index.source_key(in_gff, with_hash=False),
+                feature_types=list(region_map.feature_types),
+                # Earlier caches counted exons of every type
+                counted_types='primary')
+
+def load_region_map(in_gff, cache_size=DEFAULT_CACHE_SIZE, cache_file=None, run_stats=None,
+                    feature_types=None):
+    """Loads the region map of a GFF3 file or region index with an empty
+    classification cache, warmed from cache_file if it exists
+    """
+    if run_stats is None:
+        run_stats = RunStats()
+    with run_stats.stage('gff_parse') as stage:
+        region_map = index.load_region_map(in_gff, feature_types)
+    stage.records = count_genes(region_map)
+    region_map.classification_cache = ClassificationCache(cache_size)
+    if cache_file is not None and os.path.exists(cache_file):
+        region_map.classification_cache.load(cache_file, Region.Classification,
+                                             cache_tag(in_gff, region_map))
+    return region_map
+
+def process_sample(in_sam, region_map, outpath, out_values, run_function, stream=False,
+                   workers=1, by_reference=False, output_format=None, profile_path=None,
+                   collapse=None, pipelined=False, io_threads=1, run_stats=None,
+                   checkpoint_dir=None, checkpoint_size=checkpoint.DEFAULT_CHECKPOINT_SIZE,
+                   checkpoint_key=None, alignment_filter=None):
+    """Runs a SamStat function on one SAM/BAM file with a loaded region map
+    and writes it's rows to outpath, see run for the options. checkpoint_key
+    identifies the region map of checkpointed runs
+    Returns the number of rows written
+    """
+    if run_stats is None:
+        run_stats = RunStats()
+    pipelined = pipelined and not by_reference
+    if checkpoint_dir is not None and (pipelined or by_reference):
+        raise ValueError('Checkpoints can not be used with pipelined or by_reference runs')
+    if collapse is not None and (stream or pipelined):
+        # Collapsing keeps every QNAME in memory, streaming promises not to
+        raise ValueError('Collapse can not be used with streamed or pipelined runs')
+    if run_function is calculate_qstats:
+        out_values = list(out_values) + feature_type_columns(region_map.feature_types)
+    if by_reference:
+        olines = calculate_reference_truedirs(in_sam, region_map, workers, alignment_filter)
+    elif stream or pipelined:
+        sam_data = AlignmentStream(in_sam, io_threads, alignment_filter)
+    else:
+        with run_stats.stage('sam_parse') as stage:
+            sam_data = CompactAlignmentMap(in_sam, io_threads, alignment_filter)
+        stage.records = len(sam_data.flags)
+
+    compute_stage = STAGE_NAMES.get(run_function, run_function.__name__)
+    if collapse is not None and not by_reference:
+        with run_stats.stage('collapse') as stage:
+            sam_data = CollapsedQnames(sam_data)
+        stage.records = len(sam_data)
+        if collapse == 'count':
+            run_function = count_rows(run_function, sam_data, out_values)
+            out_values = list(out_values) + ['count']
+        else:
+            run_function = expand_rows(run_function, sam_data)
+    if checkpoint_dir is not None:
+        key = {'sam': index.source_key(in_sam, with_hash=False),
+               'region_map': checkpoint_key,
+               'operation': compute_stage,
+               'fields': list(out_values),
+               'output_format': output_format or output.infer_format(outpath),
+               'stream': bool(stream),
+               'collapse': collapse,
+               'checkpoint_size': checkpoint_size,
+               'filter': alignment_filter.key() if alignment_filter is not None else None}
+        with run_stats.stage(compute_stage) as stage:
+            stage.records = checkpoint.run_checkpointed(
+                sam_data, region_map, run_function, outpath, out_values, checkpoint_dir, key,
+                checkpoint_size, output_format, string_out_values, workers)
+        return stage.records
+    run_stats.get_stage(compute_stage)
+    profiler = cProfile.Profile() if profile_path is not None else None
+    with output.open_writer(outpath, out_values, output_format, string_out_values) as writer:
+        if by_reference:
+            lines = (writer.format(oline)
+                     for oline in run_stats.timed_iter(compute_stage, olines))
+        elif workers > 1:
+            lines = run_stats.timed_iter(compute_stage, parallel.imap_qname_batches(
+                sam_data, region_map, run_function, writer.format, workers))
+        else:
+            lines = (writer.format(oline) for oline in run_stats.timed_iter(
+                compute_stage, run_function(sam_data, region_map)))
+        if profiler is not None:
+            profiler.enable()
+        if pipelined:
+            # Reading, computing and writing overlap so they are one stage
+            with run_stats.stage(compute_stage) as stage:
+                pipeline.run_pipeline(sam_data, region_map, run_function, writer, workers)
+        else:
+            with run_stats.stage('output') as stage:
+                writer.write(lines)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+    stage.records = writer.lines_written
+    if not pipelined:
+        # The write loop also ran the compute stage, only keep the writing time
+        stage.seconds -= run_stats.get_stage(compute_stage).seconds
+        stage.cpu_seconds -= run_stats.get_stage(compute_stage).cpu_seconds
+    return writer.lines_written
+
+Sample = namedtuple('Sample', ['name', 'path'])
+SAMPLE_EXTENSIONS = ('.sam', '.bam', '.cram')
+
+def sample_name(path):
+    """Names a sample after it's alignment file"""
+    name = os.path.basename(path)
+    for extension in SAMPLE_EXTENSIONS:
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+def read_manifest(manifest_path):
+    """Reads a manifest of samples, one "<name><tab><path>" or "<path>" per line
+
+    Samples without a name are named after their file, relative paths are
+    relative to the manifest. Blank lines and lines starting with # are skipped
     """
-    return str(delimiter).join((str(line_obj.__dict__.get(attr, ':(')) for attr in ordered_attributes))
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    samples = []
+    with open(manifest_path, 'r') as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, _, path = line.rpartition('\t')
+            path = os.path.join(directory, path)
+            samples.append(Sample(name or sample_name(path), path))
+    return samples
+
+def run_batch(samples, in_gff, out_dir, out_values, run_function, workers=1, stream=False,
+              cache_size=DEFAULT_CACHE_SIZE, output_format=None, collapse=None,
+              combined_path=None, feature_types=None, alignment_filter=None):
+    """Runs a SamStat function on many SAM/BAM files with one region map
+
+    The region map is loaded and fully built once, before workers fork, so
+    each sample only costs it's alignment processing. Samples are processed
+    concurrently, one per worker, and written to out_dir/<name><extension>.
+    If combined_path is set the rows of every sample are also written to it
+    with a leading sample column.
+    Returns a dict of sample names to the number of rows written
+    """
+    if output_format is None:
+        output_format = 'tsv'
+    region_map = load_region_map(in_gff, cache_size, feature_types=feature_types)
+    region_map.build_indices()
+    os.makedirs(out_dir, exist_ok=True)
+    outpaths = [os.path.join(out_dir, sample.name + output.OUTPUT_EXTENSIONS[output_format])
+                for sample in samples]
+
+    def process(region_map, in_sam, outpath):
+        return process_sample(in_sam, region_map, outpath, out_values, run_function,
+                              stream=stream, output_format=output_format, collapse=collapse,
+                              alignment_filter=alignment_filter)
+
+    tasks = [(sample.path, outpath) for sample, outpath in zip(samples, outpaths)]
+    if workers > 1:
+        rows = list(parallel.imap_samples(tasks, region_map, process, workers))
+    else:
+        rows = [process(region_map, *task) for task in tasks]
 
+    if combined_path is not None:
+        fields = list(out_values)
+        if run_function is calculate_qstats:
+            fields += feature_type_columns(region_map.feature_types)
+        fields += ['count'] if collapse == 'count' else []
+        output.combine_outputs([(sample.name, outpath)
+                                for sample, outpath in zip(samples, outpaths)],
+                               combined_path, fields, output_format, string_out_values)
+    return {sample.name: sample_rows for sample, sample_rows in zip(samples, rows)}
 
-def run(in_sam, in_gff, outpath, out_values, run_function):
-    """Runs SamStat functions"""
-    sam_data = AlignmentMap(in_sam)
-    region_map = RegionMap(in_gff)
-    with open(outpath, 'w') as ofile:
-        ofile.write('\n'.join([format_line_obj(oline, out_values, '\t') for oline in run_function(sam_data, region_map)]))
+def run_index(in_gff, outpath=None, feature_types='exon'):
+    """Compiles a GFF3 file into a region index"""
+    if outpath is None:
+        outpath = in_gff + index.INDEX_SUFFIX
+    region_map = RegionMap(in_gff, feature_types)
+    index.write_region_index(region_map, in_gff, outpath)
+
+def run_coverage(in_sam, in_gff, outpath, output_format=None,
+                 chunk_size=coverage.DEFAULT_CHUNK_SIZE, io_threads=1, stats_path=None,
+                 feature_types=None, alignment_filter=None):
+    """Writes the coverage of every contig and gene of a SAM/BAM file,
+    see coverage.calculate_coverage
+    """
+    run_stats = RunStats()
+    with run_stats.count_warnings():
+        region_map = load_region_map(in_gff, run_stats=run_stats, feature_types=feature_types)
+        rows = coverage.calculate_coverage(in_sam, region_map, chunk_size, io_threads,
+                                           alignment_filter)
+        with output.open_writer(outpath, coverage.coverage_out_values, output_format,
+                                coverage.string_out_values) as writer:
+            with run_stats.stage('coverage') as stage:
+                writer.write(writer.format(row) for row in rows)
+        stage.records = writer.lines_written
+    if stats_path is not None:
+        run_stats.save(stats_path, region_map)
+
+def run_server(in_gff, address, cache_size=DEFAULT_CACHE_SIZE, cache_file=None,
+               max_batch=server.DEFAULT_MAX_BATCH, feature_types=None):
+    """Serves classification and true direction queries of a GFF3 file or
+    region index until interrupted, see server
+    """
+    region_map = load_region_map(in_gff, cache_size, cache_file, feature_types=feature_types)
+    server.serve(region_map, address, max_batch)
+    if cache_file is not None:
+        region_map.classification_cache.save(cache_file, cache_tag(in_gff, region_map))
+
+STAGE_NAMES = {calculate_qstats: 'classification',
+               calculate_truedirs: 'truedir'}
+
+OPERATIONS = {'qstat': (qstat_out_values, calculate_qstats),
+              'truedir': (true_dir_out_values, calculate_truedirs)}
 
 def main():
     """Command line interface for samstat"""
     parser = argparse.ArgumentParser(description="TODO")
-    parser.add_argument('operation', type=str, help='Operation to preform on data (qstat, truedir)')
-    parser.add_argument('sam_file', type=str, help='Path To SAM input file')
-    parser.add_argument('gff_file', type=str, help='Path to GFF input file')
-    parser.add_argument('out_path', type=str, help='Path of output file')
+    subparsers = parser.add_subparsers(dest='operation',
+                                       help='Operation to preform on data')
+    for operation in sorted(OPERATIONS):
+        op_parser = subparsers.add_parser(operation)
+        op_parser.add_argument('sam_file', type=str, help='Path To SAM input file')
+        op_parser.add_argument('gff_file', type=str,
+                               help='Path to GFF input file or region index')
+        op_parser.add_argument('out_path', type=str, help='Path of output file')
+        op_parser.add_argument('--stream', action='store_true',
+                               help=('Stream QNAME groups instead of loading the whole '
+                                     'SAM file (requires queryname sorted or collated input)'))
+        op_parser.add_argument('--workers', type=int, default=1,
+                               help='Number of worker processes (default: 1)')
+        op_parser.add_argument('--pipeline', action='store_true',
+                               help=('Stream QNAME groups and read, compute and write at the '
+                                     'same time on threads connected by bounded queues '
+                                     '(requires queryname sorted or collated input)'))
+        op_parser.add_argument('--io-threads', type=int, default=1,
+                               help='Number of BAM decompression threads (default: 1)')
+        op_parser.add_argument('--output-format', choices=output.OUTPUT_FORMATS, default=None,
+                               help=('Output format (default: parquet for .parquet, gzip '
+                                     'for .gz, otherwise tsv)'))
+        op_parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                               help=('Maximum number of cached classifications, 0 '
+                                     'disables the cache (default: {})').format(DEFAULT_CACHE_SIZE))
+        op_parser.add_argument('--cache-file', type=str, default=None,
+                               help='Warm the classification cache from and save it to this file')
+        op_parser.add_argument('--collapse', choices=COLLAPSE_MODES, default=None,
+                               help=('Compute QNAMEs with identical alignments once, '
+                                     'expand writes every QNAME grouped by alignments, '
+                                     'count writes the first QNAME with a count column. '
+                                     'Every QNAME is held in memory, so it can not be '
+                                     'used with --stream or --pipeline'))
+        op_parser.add_argument('--stats-json', type=str, default=None,
+                               help=('Write per-stage time, CPU, peak RSS and throughput, '
+                                     'cache counters and warning counts to this file'))
+        op_parser.add_argument('--checkpoint-dir', type=str, default=None,
+                               help=('Save the output in chunks in this directory and resume '
+                                     'after the last saved chunk when restarted'))
+        op_parser.add_argument('--checkpoint-size', type=int,
+                               default=checkpoint.DEFAULT_CHECKPOINT_SIZE,
+                               help=('QNAME groups per checkpoint (default: {})'.format(
+                                   checkpoint.DEFAULT_CHECKPOINT_SIZE)))
+        op_parser.add_argument('--profile', type=str, default=None,
+                               help=('Profile the compute and output loop with cProfile and '
+                                     'dump the stats to this file (read with pstats)'))
+    subparsers.choices['truedir'].add_argument(
+        '--by-reference', action='store_true',
+        help=('Process each reference of a coordinate sorted, indexed BAM file '
+              'separately (rows are grouped by reference)'))
+    batch_parser = subparsers.add_parser(
+        'batch', help='Run qstat or truedir on many SAM/BAM files with one region map')
+    batch_parser.add_argument('batch_operation', choices=sorted(OPERATIONS),
+                              help='Operation to preform on every sample')
+    batch_parser.add_argument('gff_file', type=str,
+                              help='Path to GFF input file or region index')
+    batch_parser.add_argument('out_dir', type=str,
+                              help='Directory of the per-sample output files')
+    batch_parser.add_argument('sam_files', type=str, nargs='*',
+                              help='Paths to SAM/BAM input files, named after the file')
+    batch_parser.add_argument('--manifest', type=str, default=None,
+                              help='File of samples, one "<name><tab><path>" or "<path>" per line')
+    batch_parser.add_argument('--workers', type=int, default=1,
+                              help='Number of samples processed at once (default: 1)')
+    batch_parser.add_argument('--combined', type=str, default=None,
+                              help='Also write the rows of every sample to this file with a sample column')
+    batch_parser.add_argument('--stream', action='store_true',
+                              help='Stream QNAME groups (requires queryname sorted or collated input)')
+    batch_parser.add_argument('--output-format', choices=output.OUTPUT_FORMATS, default='tsv',
+                              help='Output format of every file (default: tsv)')
+    batch_parser.add_argument('--collapse', choices=COLLAPSE_MODES, default=None,
+                              help='Compute QNAMEs with identical alignments once, see qstat --help')
+    batch_parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                              help='Maximum number of cached classifications per worker')
+    coverage_parser = subparsers.add_parser(
+        'coverage', help='Coverage and exon/intron/intergenic bases of every contig and gene')
+    coverage_parser.add_argument('sam_file', type=str, help='Path To SAM input file')
+    coverage_parser.add_argument('gff_file', type=str,
+                                 help='Path to GFF input file or region index')
+    coverage_parser.add_argument('out_path', type=str, help='Path of output file')
+    coverage_parser.add_argument('--output-format', choices=output.OUTPUT_FORMATS, default=None,
+                                 help='Output format (default: inferred from out_path)')
+    coverage_parser.add_argument('--chunk-size', type=int, default=coverage.DEFAULT_CHUNK_SIZE,
+                                 help=('Positions counted at once in coordinate sorted input '
+                                       '(default: {})').format(coverage.DEFAULT_CHUNK_SIZE))
+    coverage_parser.add_argument('--io-threads', type=int, default=1,
+                                 help='Number of BAM decompression threads (default: 1)')
+    coverage_parser.add_argument('--stats-json', type=str, default=None,
+                                 help='Write per-stage statistics to this file')
+    index_parser = subparsers.add_parser('index',
+                                         help='Compile a GFF file into a region index')
+    index_parser.add_argument('gff_file', type=str, help='Path to GFF input file')
+    index_parser.add_argument('-o', '--out-path', type=str, default=None,
+                              help='Path of index file (default: <gff_file>.ssidx)')
+    serve_parser = subparsers.add_parser(
+        'serve', help='Keep a region map in memory and answer queries on a socket')
+    serve_parser.add_argument('gff_file', type=str,
+                              help='Path to GFF input file or region index')
+    serve_address = serve_parser.add_mutually_exclusive_group(required=True)
+    serve_address.add_argument('--socket', type=str, default=None,
+                               help='Path of the Unix socket to listen on')
+    serve_address.add_argument('--port', type=int, default=None,
+                               help='Localhost TCP port to listen on')
+    serve_parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                              help='Most classifications kept in memory (0 disables the cache)')
+    serve_parser.add_argument('--cache-file', type=str, default=None,
+                              help='Load and save cached classifications to this file')
+    serve_parser.add_argument('--max-batch', type=int, default=server.DEFAULT_MAX_BATCH,
+                              help='Most queued requests computed together')
+    for name in sorted(OPERATIONS) + ['batch', 'coverage']:
+        op_parser = subparsers.choices[name]
+        op_parser.add_argument('--min-mapq', type=int, default=0,
+                               help='Skip records with a lower MAPQ')
+        op_parser.add_argument('--exclude-flags', type=filters.parse_flags, default=0,
+                               help=('Skip records with any of these flags, a number or '
+                                     'samtools flag names (e.g. UNMAP,SECONDARY,SUPPLEMENTARY)'))
+        op_parser.add_argument('--regions', type=str, default=None,
+                               help=('Only read records overlapping the regions of this BED '
+                                     'file, indexed BAM files are read with region fetches'))
+    for op_parser in subparsers.choices.values():
+        op_parser.add_argument('--feature-types', type=parse_feature_types, default=None,
+                               help=('Comma separated GFF feature types of genes, qstat '
+                                     'counts each when there is more than one, exons and '
+                                     'true directions use the first (default: exon, '
+                                     'or the types a region index was compiled with)'))
     args = parser.parse_args()
 
-    if not os.path.isfile(args.sam_file):
-        raise argparse.ArgumentTypeError('sam_file is not a valid file path')
+    if args.operation is None:
+        parser.error('an operation is required')
     if not os.path.isfile(args.gff_file):
         raise argparse.ArgumentTypeError('gff_file is not a valid file path')
+    if args.operation == 'index':
+        run_index(args.gff_file, args.out_path, args.feature_types or 'exon')
+        return
+    if args.operation == 'serve':
+        if args.max_batch < 1:
+            raise argparse.ArgumentTypeError('max-batch must be at least 1')
+        address = args.socket if args.socket is not None else ('127.0.0.1', args.port)
+        run_server(args.gff_file, address, args.cache_size, args.cache_file, args.max_batch,
+                   args.feature_types)
+        return
+    if args.min_mapq < 0:
+        raise argparse.ArgumentTypeError('min-mapq can not be negative')
+    if args.regions is not None and not os.path.isfile(args.regions):
+        raise argparse.ArgumentTypeError('regions is not a valid file path')
+    alignment_filter = filters.AlignmentFilter.from_options(args.min_mapq, args.exclude_flags,
+                                                            args.regions)
+    if args.operation == 'coverage':
+        if not os.path.isfile(args.sam_file):
+            raise argparse.ArgumentTypeError('sam_file is not a valid file path')
+        if args.chunk_size < 1 or args.io_threads < 1:
+            raise argparse.ArgumentTypeError('chunk-size and io-threads must be at least 1')
+        run_coverage(args.sam_file, args.gff_file, args.out_path, args.output_format,
+                     args.chunk_size, args.io_threads, args.stats_json, args.feature_types,
+                     alignment_filter)
+        return
+    if args.operation == 'batch':
+        samples = [Sample(sample_name(path), path) for path in args.sam_files]
+        if args.manifest is not None:
+            samples += read_manifest(args.manifest)
+        if not samples:
+            raise argparse.ArgumentTypeError('batch requires sam_files or a manifest')
+        for sample in samples:
+            if not os.path.isfile(sample.path):
+                raise argparse.ArgumentTypeError(
+                    'sam_file of sample {} is not a valid file path'.format(sample.name))
+        if len({sample.name for sample in samples}) != len(samples):
+            raise argparse.ArgumentTypeError('sample names must be unique')
+        if args.workers < 1:
+            raise argparse.ArgumentTypeError('workers must be at least 1')
+        if args.collapse is not None and args.stream:
+            raise argparse.ArgumentTypeError('--collapse can not be used with --stream')
+        out_values, run_function = OPERATIONS[args.batch_operation]
+        run_batch(samples, args.gff_file, args.out_dir, out_values, run_function,
+                  workers=args.workers, stream=args.stream, cache_size=args.cache_size,
+                  output_format=args.output_format, collapse=args.collapse,
+                  combined_path=args.combined, feature_types=args.feature_types,
+                  alignment_filter=alignment_filter)
+        return
+
+    if not os.path.isfile(args.sam_file):
+        raise argparse.ArgumentTypeError('sam_file is not a valid file path')
+    if args.workers < 1:
+        raise argparse.ArgumentTypeError('workers must be at least 1')
+    if args.collapse is not None and getattr(args, 'by_reference', False):
+        raise argparse.ArgumentTypeError('--collapse can not be used with --by-reference')
+    if args.collapse is not None and (args.stream or args.pipeline):
+        raise argparse.ArgumentTypeError(('--collapse holds every QNAME in memory and can '
+                                          'not be used with --stream or --pipeline'))
+    if args.pipeline and getattr(args, 'by_reference', False):
+        raise argparse.ArgumentTypeError('--pipeline can not be used with --by-reference')
+    if args.io_threads < 1:
+        raise argparse.ArgumentTypeError('io-threads must be at least 1')
+    if args.checkpoint_dir is not None:
+        if args.pipeline or getattr(args, 'by_reference', False):
+            raise argparse.ArgumentTypeError(
+                '--checkpoint-dir can not be used with --pipeline or --by-reference')
+        if args.checkpoint_size < 1:
+            raise argparse.ArgumentTypeError('checkpoint-size must be at least 1')
     if os.path.exists(args.out_path):
         warnings.warn(('Warning output path already exists, data will be '
                        'overwritten. Path {}').format(args.out_path))
 
-    if args.operation == 'qstat':
-        run(args.sam_file, args.gff_file, args.out_path, qstat_out_values, calculate_qstats)
-    elif args.operation == 'truedir':
-        run(args.sam_file, args.gff_file, args.out_path, true_dir_out_values, calculate_truedirs)
-    else:
-        raise argparse.ArgumentTypeError('Operation type {} is invalid'.format(args.operation))
-
-IN_GFF = '/disk/bioscratch/Will/Drop_Box/GCF_001266775.1_Austrofundulus_limnaeus-1.0_genomic_andMITO.gff'
-IN_SAM = '/disk/bioscratch/Will/Drop_Box/HPF_small_RNA_022216.sam'
-OUT_TRUEDIR = '/disk/bioscratch/Will/Drop_Box/truedir_output.v1-0.csv'
-OUT_QSTAT = '/disk/bioscratch/Will/Drop_Box/qstat_output.v1-0.csv'
-
+    out_values, run_function = OPERATIONS[args.operation]
+    run(args.sam_file, args.gff_file, args.out_path, out_values, run_function,
+        stream=args.stream, workers=args.workers,
+        by_reference=getattr(args, 'by_reference', False),
+        cache_size=args.cache_size, cache_file=args.cache_file,
+        output_format=args.output_format, stats_path=args.stats_json,
+        profile_path=args.profile, collapse=args.collapse,
+        pipelined=args.pipeline, io_threads=args.io_threads,
+        feature_types=args.feature_types, checkpoint_dir=args.checkpoint_dir,
+        checkpoint_size=args.checkpoint_size, alignment_filter=alignment_filter)
 
 if __name__ == '__main__':
-    start = timeit.default_timer()
-    run(IN_SAM, IN_GFF, OUT_CSV)
-    end = timeit.default_timer()
-    print('Total Program Time: {}'.format(end-start))
+    main()
@@ -0,0 +1,315 @@
+""" Query Server
+This file contains the code for serving classification and true direction
+queries from a RegionMap kept in memory, so repeated queries don't pay for
+reading the annotation
+
+Requests and responses are JSON objects, one per line, over a Unix socket or
+a localhost TCP port. Every connection is handled on it's own thread and may
+send any number of requests, answered in order:
+    {"op": "classify", "regions": [...], "starts": [...], "stops": [...]}
+        -> {"intergenes": [...], "exons": [...], "introns": [...],
+            "combos": [...], "missing": [regions not in the map]}
+    {"op": "truedir", "regions": [...], "starts": [...], "stops": [...],
+     "flags": [...]}
+        -> {"forwards": [...], "reverses": [...], "missing": [...]}
+    {"op": "stats"} -> request, latency and throughput counters
+Failed requests are answered with {"error": message}. Requests of every
+connection are queued and computed together by a single thread, which owns
+the RegionMap and it's classification cache
+"""
+import collections
+import json
+import os
+import queue
+import socketserver
+import stat
+import threading
+import time
+import warnings
+
+OPERATIONS = ('classify', 'truedir', 'stats')
+# Most queued requests computed at once
+DEFAULT_MAX_BATCH = 64
+
+class QueryError(Exception):
+    """Raised for requests that can't be answered, sent back as an error"""
+
+class Query(object):
+    """A queued request, it's response is set by the batcher"""
+    def __init__(self, request):
+        self.request = request
+        self.response = None
+        self.done = threading.Event()
+        self.received = time.perf_counter()
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def query_columns(request, names):
+    """Returns the equally long lists names of a request, regions must be
+    strings and every other column integers. Checked before a query joins a
+    batch, so one bad request can't fail the others
+    """
+    try:
+        columns = [request[name] for name in names]
+    except KeyError as error:
+        raise QueryError('Missing field {}'.format(error.args[0]))
+    if any(not isinstance(column, list) for column in columns):
+        raise QueryError('Fields {} must be lists'.format(', '.join(names)))
+    if len({len(column) for column in columns}) > 1:
+        raise QueryError('Fields {} must have the same length'.format(', '.join(names)))
+    for name, column in zip(names, columns):
+        check = (lambda value: isinstance(value, str)) if name == 'regions' else is_integer
+        if not all(check(value) for value in column):
+            raise QueryError('Field {} must only hold {}'.format(
+                name, 'strings' if name == 'regions' else 'integers'))
+    return columns
+
+class ServerStats(object):
+    """Request, latency and throughput counters of a server
+
+    Latency is measured from when a request is queued until it's response
+    is ready, intervals counts the locations of every query
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.requests = collections.Counter()
+        self.intervals = collections.Counter()
+        self.latency = collections.Counter()
+        self.max_latency = collections.Counter()
+        self.errors = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.connections = 0
+
+    def add(self, op, intervals, latency):
+        self.requests[op] += 1
+        self.intervals[op] += intervals
+        self.latency[op] += latency
+        self.max_latency[op] = max(self.max_latency[op], latency)
+
+    def as_dict(self, region_map):
+        uptime = time.perf_counter() - self.start
+        return {'uptime_seconds': uptime,
+                'connections': self.connections,
+                'errors': self.errors,
+                'batches': self.batches,
+                'mean_batch_size': (self.batched_requests / self.batches
+                                    if self.batches else None),
+                'operations': {op: {'requests': self.requests[op],
+                                    'intervals': self.intervals[op],
+                                    'mean_latency_seconds': (self.latency[op] / self.requests[op]
+                                                             if self.requests[op] else None),
+                                    'max_latency_seconds': self.max_latency[op],
+                                    'intervals_per_second': self.intervals[op] / uptime}
+                               for op in OPERATIONS},
+                'cache': region_map.classification_cache.stats(),
+                'unmatched_regions': dict(region_map.unmatched_regions)}
+
+class Batcher(object):
+    """Computes queued queries on one thread
+
+    Every pass takes all waiting queries (up to max_batch), classify queries
+    are answered by a single RegionMap.classify_batch call
+    """
+    def __init__(self, region_map, max_batch=DEFAULT_MAX_BATCH):
+        self.region_map = region_map
+        self.max_batch = max_batch
+        self.queries = queue.Queue()
+        self.stats = ServerStats()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        """Queues a request and waits for it's response"""
+        query = Query(request)
+        self.queries.put(query)
+        query.done.wait()
+        return query.response
+
+    def close(self):
+        self.queries.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            batch = [self.queries.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queries.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [query for query in batch if query is not None]
+            if batch:
+                self.stats.batches += 1
+                self.stats.batched_requests += len(batch)
+                try:
+                    self.compute(batch)
+                except Exception as error:
+                    # Answer the rest so no client waits forever
+                    for query in batch:
+                        if not query.done.is_set():
+                            self.fail(query, error)
+            if stop:
+                return
+
+    def compute(self, batch):
+        classify, others = [], []
+        for query in batch:
+            try:
+                if not isinstance(query.request, dict):
+                    raise QueryError('Requests must be JSON objects')
+                op = query.request.get('op')
+                if op == 'classify':
+                    classify.append((query, query_columns(query.request,
+                                                          ('regions', 'starts', 'stops'))))
+                elif op == 'truedir':
+                    query_columns(query.request, ('regions', 'starts', 'stops', 'flags'))
+                    others.append(query)
+                elif op in OPERATIONS:
+                    others.append(query)
+                else:
+                    raise QueryError('Unknown operation {}'.format(op))
+            except QueryError as error:
+                self.fail(query, error)
+        if classify:
+            self.classify(classify)
+        for query in others:
+            try:
+                if query.request['op'] == 'truedir':
+                    self.finish(query, 'truedir', *self.true_directions(query.request))
+                else:
+                    self.finish(query, 'stats', self.stats.as_dict(self.region_map), 0)
+            except QueryError as error:
+                self.fail(query, error)
+
+    def classify(self, queries):
+        """Classifies the locations of every query with one batch"""
+        regions, starts, stops = [], [], []
+        for _, (query_regions, query_starts, query_stops) in queries:
+            regions.extend(query_regions)
+            starts.extend(query_starts)
+            stops.extend(query_stops)
+        try:
+            with warnings.catch_warnings():
+                # Missing regions are reported to the client instead
+                warnings.simplefilter('ignore')
+                intergenes, exons, introns, combos = self.region_map.classify_batch(
+                    regions, starts, stops)
+        except (TypeError, ValueError, OverflowError) as error:
+            if len(queries) > 1:
+                # Only fail the queries that can't be classified on their own
+                for query in queries:
+                    self.classify([query])
+            else:
+                self.fail(queries[0][0], QueryError('Invalid locations: {}'.format(error)))
+            return
+        offset = 0
+        for query, (query_regions, _, _) in queries:
+            first, offset = offset, offset + len(query_regions)
+            response = {'intergenes': list(intergenes[first:offset]),
+                        'exons': list(exons[first:offset]),
+                        'introns': list(introns[first:offset]),
+                        'combos': list(combos[first:offset]),
+                        'missing': self.missing(query_regions)}
+            self.finish(query, 'classify', response, len(query_regions))
+
+    def true_directions(self, request):
+        """Returns the truedir response of a request and it's number of locations"""
+        regions, starts, stops, flags = query_columns(request,
+                                                      ('regions', 'starts', 'stops', 'flags'))
+        missing = self.missing(regions)
+        forwards, reverses = [], []
+        try:
+            for region, start, stop, flag in zip(regions, starts, stops, flags):
+                if region in missing:
+                    forward, reverse = 0, 0
+                else:
+                    forward, reverse = self.region_map.count_true_directions(
+                        region, ((start, stop),), flag)
+                forwards.append(forward)
+                reverses.append(reverse)
+        except (TypeError, ValueError) as error:
+            raise QueryError('Invalid locations: {}'.format(error))
+        return {'forwards': forwards, 'reverses': reverses, 'missing': missing}, len(regions)
+
+    def missing(self, regions):
+        return sorted({region for region in regions if region not in self.region_map.rmap},
+                      key=str)
+
+    def finish(self, query, op, response, intervals):
+        query.response = response
+        self.stats.add(op, intervals, time.perf_counter() - query.received)
+        query.done.set()
+
+    def fail(self, query, error):
+        query.response = {'error': str(error)}
+        self.stats.errors += 1
+        query.done.set()
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """Answers the JSON line requests of one connection in order"""
+    def handle(self):
+        self.server.batcher.stats.connections += 1
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as error:
+                self.server.batcher.stats.errors += 1
+                response = {'error': 'Invalid JSON: {}'.format(error)}
+            else:
+                response = self.server.batcher.submit(request)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class QueryServerMixin(socketserver.ThreadingMixIn):
+    daemon_threads = True
+
+    batcher = None
+
+    def server_close(self):
+        super().server_close()
+        # Also called when binding fails, before the batcher is set
+        if self.batcher is not None:
+            self.batcher.close()
+
+class UnixQueryServer(QueryServerMixin, socketserver.UnixStreamServer):
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+class TcpQueryServer(QueryServerMixin, socketserver.TCPServer):
+    allow_reuse_address = True
+
+def make_server(region_map, address, max_batch=DEFAULT_MAX_BATCH):
+    """Binds a query server for region_map without serving yet
+
+    address is the path of a Unix socket, an existing socket file is
+    replaced, or a (host, port) pair. Call serve_forever() to serve and
+    server_close() to stop
+    """
+    if isinstance(address, str):
+        if os.path.exists(address):
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                raise ValueError('{} exists and is not a socket'.format(address))
+            os.remove(address)
+        server = UnixQueryServer(address, QueryHandler)
+    else:
+        server = TcpQueryServer(tuple(address), QueryHandler)
+    server.batcher = Batcher(region_map, max_batch)
+    return server
+
+def serve(region_map, address, max_batch=DEFAULT_MAX_BATCH):
+    """Serves queries for region_map until interrupted"""
+    region_map.build_indices()
+    server = make_server(region_map, address, max_batch)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
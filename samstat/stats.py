@@ -0,0 +1,127 @@
+""" Run Statistics
+This file contains the per-stage instrumentation written by samstat
+--stats-json: wall time, CPU time, peak RSS and records per second of each
+stage, classification cache counters, warnings by category and unmatched
+regions
+"""
+import collections
+import contextlib
+import json
+import resource
+import time
+import warnings
+
+from samstat.index import IndexedRegions
+
+def peak_rss_kb():
+    """Returns the peak resident set size of this process in KB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def count_genes(region_map):
+    """Counts the genes of a region map without building indexed regions"""
+    if isinstance(region_map.rmap, IndexedRegions):
+        return sum(len(header['gene_ids'])
+                   for header in region_map.rmap.region_headers.values())
+    return sum(len(region.genes) for region in region_map.rmap.values())
+
+class StageStats(object):
+    """Accumulated wall time, CPU time and records of one stage
+
+    peak_rss_kb is the peak RSS of the process when the stage last ended,
+    so it includes everything loaded by earlier stages
+    """
+    def __init__(self):
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.records = 0
+        self.peak_rss_kb = 0
+
+    def as_dict(self):
+        return {'seconds': self.seconds,
+                'cpu_seconds': self.cpu_seconds,
+                'records': self.records,
+                'records_per_second': self.records / self.seconds if self.seconds else None,
+                'peak_rss_kb': self.peak_rss_kb}
+
+class RunStats(object):
+    """Statistics of one samstat run, collected stage by stage"""
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.warnings = collections.Counter()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def get_stage(self, name):
+        return self.stages.setdefault(name, StageStats())
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the body of a with block as stage name, yields it's StageStats"""
+        stage = self.get_stage(name)
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.perf_counter() - start
+            stage.cpu_seconds += time.process_time() - cpu_start
+            stage.peak_rss_kb = peak_rss_kb()
+
+    def timed_iter(self, name, iterable):
+        """Yields the items of iterable, timing only the work of producing
+        them as stage name and counting each item as a record
+        """
+        stage = self.get_stage(name)
+        iterator = iter(iterable)
+        while True:
+            start, cpu_start = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                stage.seconds += time.perf_counter() - start
+                stage.cpu_seconds += time.process_time() - cpu_start
+            stage.records += 1
+            yield item
+        stage.peak_rss_kb = peak_rss_kb()
+
+    @contextlib.contextmanager
+    def count_warnings(self):
+        """Counts every warning raised in a with block by category
+
+        Each distinct message is still shown once, repeats are only counted
+        """
+        shown = set()
+        with warnings.catch_warnings():
+            warnings.simplefilter('always')
+            showwarning = warnings.showwarning
+            def count_warning(message, category, *args, **kwargs):
+                self.warnings[category.__name__] += 1
+                if (category, str(message)) not in shown:
+                    shown.add((category, str(message)))
+                    showwarning(message, category, *args, **kwargs)
+            warnings.showwarning = count_warning
+            yield
+
+    def as_dict(self, region_map=None):
+        """Returns the statistics as JSON types
+
+        Cache counters and unmatched regions are read from region_map. With
+        worker processes they only cover the work done in this process
+        """
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stats = {'total': {'seconds': time.perf_counter() - self.start,
+                           'cpu_seconds': time.process_time() - self.cpu_start,
+                           'children_cpu_seconds': children.ru_utime + children.ru_stime,
+                           'peak_rss_kb': peak_rss_kb(),
+                           'children_peak_rss_kb': children.ru_maxrss},
+                 'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+                 'warnings': dict(self.warnings)}
+        if region_map is not None:
+            stats['classification_cache'] = region_map.classification_cache.stats()
+            stats['unmatched_regions'] = dict(region_map.unmatched_regions)
+        return stats
+
+    def save(self, path, region_map=None):
+        with open(path, 'w') as stats_file:
+            json.dump(self.as_dict(region_map), stats_file, indent=2)
@@ -0,0 +1,99 @@
+""" Synthetic Data
+This file contains generators for synthetic GFF3 annotations and SAM/BAM
+alignment files used by the benchmarks and tests
+"""
+import os
+import random
+
+import pysam
+
+def write_gff(path, contigs=10, genes_per_contig=1000, overlap=0.1, exons_per_gene=4,
+              gene_length=5000, seed=0):
+    """Writes a synthetic NCBI style GFF3 annotation
+
+    Genes are laid out along each contig with gaps between them. A fraction
+    overlap of genes is placed inside the previous gene instead. Every gene
+    has one mRNA with exons_per_gene exons.
+    Returns a dict of contig names to contig lengths
+    """
+    rng = random.Random(seed)
+    contig_length = genes_per_contig * gene_length * 2
+    contig_lengths = {'contig{}'.format(i): contig_length for i in range(contigs)}
+    gene_number = 0
+    with open(path, 'w') as gff:
+        gff.write('##gff-version 3\n')
+        for contig in contig_lengths:
+            gff.write('##sequence-region {} 1 {}\n'.format(contig, contig_length))
+        for contig in contig_lengths:
+            gff.write('{}\tRefSeq\tregion\t1\t{}\t.\t+\t.\tID={};Dbxref=taxon:0\n'.format(
+                contig, contig_length, contig))
+            position, previous = 1, None
+            for _ in range(genes_per_contig):
+                length = rng.randint(gene_length//2, gene_length*3//2)
+                if previous is not None and rng.random() < overlap:
+                    start = rng.randint(previous[0], previous[1])
+                    stop = min(start + length//4, contig_length)
+                else:
+                    start = position + rng.randint(1, gene_length)
+                    stop = min(start + length, contig_length)
+                    position = stop
+                previous = (start, stop)
+                gene_number += 1
+                strand = rng.choice('+-')
+                gff.write(('{0}\tGnomon\tgene\t{1}\t{2}\t.\t{3}\t.\tID=gene{4};'
+                           'Dbxref=GeneID:{4};Name=G{4};gene=G{4}\n').format(
+                               contig, start, stop, strand, gene_number))
+                gff.write(('{0}\tGnomon\tmRNA\t{1}\t{2}\t.\t{3}\t.\tID=rna{4};Parent=gene{4};'
+                           'Dbxref=GeneID:{4};gene=G{4}\n').format(
+                               contig, start, stop, strand, gene_number))
+                step = max((stop - start) // max(exons_per_gene, 1), 1)
+                for exon in range(exons_per_gene):
+                    exon_start = start + exon*step
+                    exon_stop = min(exon_start + step//2, stop)
+                    gff.write(('{0}\tGnomon\texon\t{1}\t{2}\t.\t{3}\t.\tID=exon{4}-{5};'
+                               'Parent=rna{4};Dbxref=GeneID:{4};gene=G{4}\n').format(
+                                   contig, exon_start, exon_stop, strand, gene_number, exon+1))
+    return contig_lengths
+
+def write_sam(path, contig_lengths, reads=10000, multimap=2, read_length=22, spliced=0.0,
+              seed=0):
+    """Writes a synthetic queryname grouped SAM file
+
+    Each read has between 1 and 2*multimap-1 alignments (multimap on average)
+    at random positions, all but the first flagged secondary. A fraction
+    spliced of alignments is split by a 100-1000 base skipped region.
+    Returns the number of records written
+    """
+    rng = random.Random(seed)
+    contigs = sorted(contig_lengths)
+    records = 0
+    with open(path, 'w') as sam:
+        sam.write('@HD\tVN:1.0\tSO:queryname\n')
+        for contig in contigs:
+            sam.write('@SQ\tSN:{}\tLN:{}\n'.format(contig, contig_lengths[contig]))
+        for read in range(reads):
+            qname = 'read{:09d}'.format(read)
+            for alignment in range(rng.randint(1, 2*multimap-1)):
+                contig = rng.choice(contigs)
+                reverse = rng.random() < 0.5
+                flag = (16 if reverse else 0) | (256 if alignment else 0)
+                if rng.random() < spliced:
+                    first = read_length // 2
+                    cigar = '{}M{}N{}M'.format(first, rng.randint(100, 1000), read_length-first)
+                    span = read_length + 1000
+                else:
+                    cigar = '{}M'.format(read_length)
+                    span = read_length
+                position = rng.randint(1, contig_lengths[contig]-span)
+                sam.write('{}\t{}\t{}\t{}\t255\t{}\t*\t0\t0\t*\t*\n'.format(
+                    qname, flag, contig, position, cigar))
+                records += 1
+    return records
+
+def write_sorted_bam(sam_path, bam_path):
+    """Converts a SAM file into a coordinate sorted, indexed BAM file"""
+    unsorted_path = bam_path + '.unsorted'
+    pysam.view('-b', '-o', unsorted_path, sam_path, catch_stdout=False)
+    pysam.sort('-o', bam_path, unsorted_path)
+    pysam.index(bam_path)
+    os.remove(unsorted_path)
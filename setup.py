@@ -6,6 +6,8 @@ setup(name='SamLink',
       license='MIT',
       author='William Patterson, Amie Romney',
       packages=find_packages(),
-      install_requires=['pysam'],
+      python_requires='>=3.7',
+      install_requires=['pysam>=0.15.0'],
+      extras_require={'parquet': ['pyarrow']},
       entry_points={"console_scripts": ["samstat=samstat.samstat:main"],})
 
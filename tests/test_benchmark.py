@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from samstat import benchmark
+from samstat import synthetic
+from samstat.maps import CompactAlignmentMap
+from samstat.maps import RegionMap
+
+class TestSynthetic(unittest.TestCase):
+    """Tests for the synthetic GFF3 and SAM generators"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gff_path = os.path.join(self.directory, 'synthetic.gff')
+        self.sam_path = os.path.join(self.directory, 'synthetic.sam')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_gff(self):
+        lengths = synthetic.write_gff(self.gff_path, contigs=3, genes_per_contig=20,
+                                      overlap=0.5, exons_per_gene=3)
+        region_map = RegionMap(self.gff_path)
+        self.assertEqual(sorted(lengths), sorted(region_map.rmap))
+        for region in region_map.rmap.values():
+            self.assertEqual(20, len(region.genes))
+            for gene in region.genes.values():
+                self.assertEqual(3, len(gene.features))
+
+    def test_write_sam(self):
+        lengths = synthetic.write_gff(self.gff_path, contigs=2, genes_per_contig=5)
+        records = synthetic.write_sam(self.sam_path, lengths, reads=50, multimap=3)
+        alignment_map = CompactAlignmentMap(self.sam_path)
+        self.assertEqual(50, len(alignment_map))
+        self.assertEqual(records, sum(len(qdata.reference_names)
+                                      for _, qdata in alignment_map.items()))
+
+    def test_generators_are_reproducible(self):
+        lengths = synthetic.write_gff(self.gff_path, contigs=1, genes_per_contig=10, seed=7)
+        synthetic.write_sam(self.sam_path, lengths, reads=10, seed=7)
+        with open(self.sam_path) as sam:
+            first = sam.read()
+        synthetic.write_sam(self.sam_path, lengths, reads=10, seed=7)
+        with open(self.sam_path) as sam:
+            self.assertEqual(first, sam.read())
+
+class TestBenchmark(unittest.TestCase):
+    """Tests for measuring benchmark stages"""
+    def test_measure_stage(self):
+        directory = tempfile.mkdtemp()
+        try:
+            gff_path = os.path.join(directory, 'synthetic.gff')
+            synthetic.write_gff(gff_path, contigs=1, genes_per_contig=10)
+            result = benchmark.measure_stage('gff_load', {'gff': gff_path, 'gff_records': 42})
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(42, result['records'])
+        self.assertGreater(result['seconds'], 0)
+        self.assertGreater(result['peak_rss_kb'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+from samstat.cache import ClassificationCache
+from samstat.maps import Region
+
+Classification = Region.Classification
+
+class TestClassificationCache(unittest.TestCase):
+    """Tests for the bounded classification cache"""
+    def test_counters(self):
+        cache = ClassificationCache(2)
+        self.assertIsNone(cache.get(('chr1', 0, 1)))
+        cache.put(('chr1', 0, 1), Classification(False, 1, 0, 0))
+        self.assertEqual((False, 1, 0, 0), cache.get(('chr1', 0, 1)))
+        self.assertEqual({'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 0},
+                         cache.stats())
+
+    def test_least_recently_used_eviction(self):
+        cache = ClassificationCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(1, cache.evictions)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_disabled(self):
+        cache = ClassificationCache(0)
+        cache.put('a', 1)
+        self.assertEqual(0, len(cache))
+
+    def test_save_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'cache.json')
+            cache = ClassificationCache(10)
+            cache.put(('chr1', 3, 5), Classification(False, 0, 1, 1))
+            cache.put(('chr2', -1, 0), Classification(False, 0, 0, 1))
+            cache.save(path, {'size': 10})
+
+            warm = ClassificationCache(1)
+            warm.load(path, Classification, {'size': 10})
+            self.assertEqual(1, len(warm))
+            self.assertEqual(Classification(False, 0, 0, 1), warm.get(('chr2', -1, 0)))
+
+            other = ClassificationCache(10)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                other.load(path, Classification, {'size': 11})
+            self.assertEqual(0, len(other))
+            self.assertEqual(1, len(caught))
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+from samstat import checkpoint
+from samstat import output
+from samstat import synthetic
+from samstat.maps import AlignmentStream
+from samstat.maps import RegionMap
+from samstat.samstat import calculate_qstats
+from samstat.samstat import qstat_out_values
+from samstat.samstat import string_out_values
+
+class Interrupted(Exception):
+    pass
+
+def interrupt_after(groups):
+    """Wraps calculate_qstats to fail after computing groups QNAME groups"""
+    computed = []
+    def run_interrupted(qname_data, region_map):
+        for row in calculate_qstats(qname_data, region_map):
+            if len(computed) == groups:
+                raise Interrupted()
+            computed.append(row.qname)
+            yield row
+    return run_interrupted
+
+class TestCheckpoint(unittest.TestCase):
+    """Tests for checkpointed and resumed runs"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint_dir = os.path.join(self.directory, 'checkpoint')
+        gff_path = os.path.join(self.directory, 'in.gff')
+        lengths = synthetic.write_gff(gff_path, contigs=2, genes_per_contig=20)
+        self.sam_path = os.path.join(self.directory, 'in.sam')
+        synthetic.write_sam(self.sam_path, lengths, reads=50)
+        self.region_map = RegionMap(gff_path)
+        self.expected = os.path.join(self.directory, 'expected.tsv')
+        with output.TsvWriter(self.expected, qstat_out_values) as writer:
+            writer.write(writer.format(row) for row in
+                         calculate_qstats(AlignmentStream(self.sam_path), self.region_map))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_checkpointed(self, run_function, key='run', outpath='out.tsv'):
+        outpath = os.path.join(self.directory, outpath)
+        rows = checkpoint.run_checkpointed(AlignmentStream(self.sam_path), self.region_map,
+                                           run_function, outpath, qstat_out_values,
+                                           self.checkpoint_dir, key, checkpoint_size=20,
+                                           string_fields=string_out_values)
+        with open(outpath) as out_file, open(self.expected) as expected_file:
+            self.assertEqual(expected_file.read(), out_file.read())
+        return rows
+
+    def manifest(self):
+        with open(os.path.join(self.checkpoint_dir, checkpoint.MANIFEST_NAME)) as manifest:
+            return json.load(manifest)
+
+    def test_uninterrupted(self):
+        self.assertEqual(50, self.run_checkpointed(calculate_qstats))
+        self.assertEqual([], os.listdir(self.checkpoint_dir))
+
+    def test_resume(self):
+        with self.assertRaises(Interrupted):
+            self.run_checkpointed(interrupt_after(45))
+        saved = self.manifest()
+        self.assertEqual((2, 40, False), (len(saved['parts']), saved['groups'], saved['finished']))
+        self.assertIsNotNone(saved['offset'])
+        resumed = interrupt_after(10)
+        self.assertEqual(50, self.run_checkpointed(resumed))
+
+    def test_different_run(self):
+        with self.assertRaises(Interrupted):
+            self.run_checkpointed(interrupt_after(30))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(50, self.run_checkpointed(calculate_qstats, key='other'))
+        self.assertEqual(1, len(caught))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from samstat.collapse import CollapsedQnames
+from samstat.collapse import alignment_signature
+from samstat.collapse import count_rows
+from samstat.collapse import expand_rows
+from samstat.maps import AlignmentMap
+from samstat.maps import CompactAlignmentMap
+from samstat.samstat import calculate_qstats
+from samstat.samstat import calculate_truedirs
+from samstat.samstat import process_sample
+from samstat.samstat import qstat_out_values
+
+from tests.test_samstat import QNAME_DATA
+from tests.test_samstat import build_region_map
+
+# d1 and d2 repeat q1 with a different reference_start and secondary flags
+DUPLICATED_DATA = dict(QNAME_DATA,
+                       d1=AlignmentMap.SamIn([2], 0, [(0, 20)],
+                                             [('chr1', 110, 256), ('chr1', 610, 272)],
+                                             [((111, 130),), ((611, 630),)]),
+                       d2=QNAME_DATA['q1'])
+
+SAM_LINES = ['@HD\tVN:1.0\tSO:queryname',
+             '@SQ\tSN:chr1\tLN:1000',
+             'a\t0\tchr1\t111\t255\t20M\t*\t0\t0\t*\t*',
+             'b\t0\tchr1\t201\t255\t20M\t*\t0\t0\t*\t*',
+             'c\t0\tchr1\t111\t255\t20M\t*\t0\t0\t*\t*',
+             'd\t16\tchr1\t111\t255\t20M\t*\t0\t0\t*\t*',
+             'e\t0\tchr1\t111\t255\t10M100N10M\t*\t0\t0\t*\t*']
+
+class TestCollapse(unittest.TestCase):
+    """Tests for collapsing QNAMEs by alignment signature"""
+    def test_signature(self):
+        self.assertEqual(alignment_signature(QNAME_DATA['q1']),
+                         alignment_signature(DUPLICATED_DATA['d1']))
+        self.assertNotEqual(alignment_signature(QNAME_DATA['q1']),
+                            alignment_signature(QNAME_DATA['q2']))
+
+    def test_collapsed_qnames(self):
+        collapsed = CollapsedQnames(DUPLICATED_DATA)
+        self.assertEqual(4, len(collapsed))
+        self.assertEqual(['q1', 'q2', 'q3', 'q4'], [qname for qname, _ in collapsed.items()])
+        self.assertEqual(['q1', 'd1', 'd2'], collapsed.members['q1'])
+
+    def test_compact_signatures(self):
+        directory = tempfile.mkdtemp()
+        try:
+            sam_path = os.path.join(directory, 'in.sam')
+            with open(sam_path, 'w') as sam:
+                sam.write('\n'.join(SAM_LINES) + '\n')
+            collapsed = CollapsedQnames(CompactAlignmentMap(sam_path))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual({'a': ['a', 'c'], 'b': ['b'], 'd': ['d'], 'e': ['e']},
+                         collapsed.members)
+        self.assertEqual([((111, 130),)], dict(collapsed.items())['a'].blocks)
+
+    def test_expand_rows(self):
+        region_map = build_region_map()
+        for run_function in (calculate_qstats, calculate_truedirs):
+            collapsed = CollapsedQnames(DUPLICATED_DATA)
+            expanded = list(expand_rows(run_function, collapsed)(collapsed, region_map))
+            self.assertEqual(sorted(run_function(DUPLICATED_DATA, region_map)), sorted(expanded))
+
+    def test_count_rows(self):
+        collapsed = CollapsedQnames(DUPLICATED_DATA)
+        rows = list(count_rows(calculate_qstats, collapsed, qstat_out_values)(
+            collapsed, build_region_map()))
+        self.assertEqual([3, 1, 1, 1], [row.count for row in rows])
+        self.assertEqual(qstat_out_values + ['count'], list(rows[0]._fields))
+
+    def test_stream_rejected(self):
+        # Collapsing would hold the whole streamed input in memory
+        for options in ({'stream': True}, {'pipelined': True}):
+            with self.assertRaises(ValueError):
+                process_sample('in.sam', build_region_map(), 'out.tsv', qstat_out_values,
+                               calculate_qstats, collapse='count', **options)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import pysam
+
+from samstat.coverage import calculate_coverage
+from samstat.coverage import ContigCoverage
+
+from tests.test_samstat import build_region_map
+
+# chr1 genes: 1001 100-400 (exons 100-150, 300-400), 1002 600-900 (exon 600-700)
+SAM_LINES = ['@HD\tVN:1.0\tSO:{}',
+             '@SQ\tSN:chr1\tLN:1000',
+             '@SQ\tSN:chr2\tLN:50',
+             'a\t0\tchr1\t141\t255\t20M\t*\t0\t0\t*\t*',
+             'b\t0\tchr1\t141\t255\t10M200N10M\t*\t0\t0\t*\t*',
+             'c\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*',
+             'd\t16\tchr1\t981\t255\t30M\t*\t0\t0\t*\t*',
+             'e\t0\tchr2\t1\t255\t10M\t*\t0\t0\t*\t*']
+
+class TestCoverage(unittest.TestCase):
+    """Tests for per contig and gene coverage"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def coverage(self, sort_order, chunk_size=10):
+        sam_path = os.path.join(self.directory, 'in.sam')
+        with open(sam_path, 'w') as sam:
+            sam.write('\n'.join(SAM_LINES).format(sort_order) + '\n')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            rows = list(calculate_coverage(sam_path, build_region_map(), chunk_size))
+        return rows, caught
+
+    def test_rows(self):
+        rows, caught = self.coverage('coordinate')
+        contig, gene_1001, gene_1002, chr2 = rows
+        # a 141-160, b 141-150 and 351-360, d 981-1010 clipped to 981-1000
+        self.assertEqual(('chr1', '.', 1, 1000, 1000), contig[:5])
+        self.assertEqual((50, 60, 30, 10, 20), contig[5:10])
+        self.assertEqual((253, 349, 398), contig[10:])
+        self.assertEqual(('1001', 30, 40, 30, 10, 0), (gene_1001.gene_id,) + gene_1001[5:10])
+        self.assertEqual((152, 149, 0), gene_1001[10:])
+        self.assertEqual((0, 0), gene_1002[5:7])
+        self.assertEqual(('chr2', '.', 10, 10, 10), chr2[:2] + (chr2.covered_bases,
+                                                              chr2.aligned_bases,
+                                                              chr2.intergenic_bases))
+        self.assertEqual(1, len(caught))
+
+    def test_sort_orders_and_chunks(self):
+        rows = self.coverage('coordinate')[0]
+        self.assertEqual(rows, self.coverage('coordinate', chunk_size=1000)[0])
+        self.assertEqual(rows, self.coverage('unsorted', chunk_size=1)[0])
+
+    def test_unsorted_records(self):
+        SAM_LINES.append('f\t0\tchr1\t1\t255\t10M\t*\t0\t0\t*\t*')
+        try:
+            with self.assertRaises(ValueError):
+                self.coverage('coordinate', chunk_size=1)
+        finally:
+            SAM_LINES.pop()
+
+    def test_contig_without_region(self):
+        contig = ContigCoverage('chrX', 100)
+        contig.add_blocks([(1, 10), (5, 20)])
+        contig.flush()
+        self.assertEqual((20, 26, 0, 0, 26, 0, 0, 100), tuple(next(contig.rows()))[5:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import pysam
+
+from samstat.filters import AlignmentFilter
+from samstat.filters import parse_flags
+from samstat.filters import read_bed
+from samstat.maps import AlignmentStream
+from samstat.maps import CompactAlignmentMap
+
+SAM_HEADER = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]}
+# qname, reference_id, start, flag, mapq, cigar
+SAM_RECORDS = [('a', 0, 100, 0, 60, [(0, 20)]),
+               ('b', 0, 150, 256, 60, [(0, 20)]),
+               ('c', 0, 180, 0, 5, [(0, 20)]),
+               ('d', 0, 290, 16, 60, [(0, 10), (3, 300), (0, 10)]),
+               ('e', 0, 700, 0, 60, [(0, 20)]),
+               ('f', 1, 10, 0, 60, [(0, 20)]),
+               ('g', -1, -1, 4, 0, None)]
+BED_LINES = ['track name=regions',
+             'chr1\t90\t120',
+             'chr1\t110\t200',
+             'chr1\t595\t610',
+             'chr3\t0\t10']
+
+class TestFilters(unittest.TestCase):
+    """Tests for filtering alignment records by flag, MAPQ and region"""
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.bam_path = os.path.join(cls.directory, 'alignments.bam')
+        cls.sam_path = os.path.join(cls.directory, 'alignments.sam')
+        for path, mode in ((cls.bam_path, 'wb'), (cls.sam_path, 'w')):
+            with pysam.AlignmentFile(path, mode, header=SAM_HEADER) as samfile:
+                for qname, reference_id, start, flag, mapq, cigar in SAM_RECORDS:
+                    read = pysam.AlignedSegment(samfile.header)
+                    read.query_name = qname
+                    read.reference_id = reference_id
+                    read.reference_start = start
+                    read.flag = flag
+                    read.mapping_quality = mapq
+                    read.cigartuples = cigar
+                    samfile.write(read)
+        pysam.index(cls.bam_path)
+        cls.bed_path = os.path.join(cls.directory, 'regions.bed')
+        with open(cls.bed_path, 'w') as bed:
+            bed.write('\n'.join(BED_LINES) + '\n')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_parse_flags(self):
+        self.assertEqual(0x904, parse_flags('0x904'))
+        self.assertEqual(2308, parse_flags('2308'))
+        self.assertEqual(0x904, parse_flags('UNMAP,secondary,SUPPLEMENTARY'))
+        with self.assertRaises(ValueError):
+            parse_flags('UNMAPPED')
+
+    def test_read_bed(self):
+        self.assertEqual({'chr1': [(90, 200), (595, 610)], 'chr3': [(0, 10)]},
+                         read_bed(self.bed_path))
+
+    def test_from_options(self):
+        self.assertIsNone(AlignmentFilter.from_options())
+        self.assertEqual({'min_mapq': 10, 'exclude_flags': 4, 'regions': None},
+                         AlignmentFilter.from_options(10, 4).key())
+
+    def test_flags_and_mapq(self):
+        alignment_filter = AlignmentFilter(min_mapq=10, exclude_flags=parse_flags('SECONDARY'))
+        for path in (self.sam_path, self.bam_path):
+            self.assertEqual(['a', 'd', 'e', 'f'],
+                             list(CompactAlignmentMap(path, alignment_filter=alignment_filter)))
+
+    def test_regions(self):
+        # d spans 290-610 so it overlaps the second region through it's intron
+        alignment_filter = AlignmentFilter(min_mapq=10,
+                                           regions=read_bed(self.bed_path))
+        for path in (self.sam_path, self.bam_path):
+            with pysam.AlignmentFile(path) as samfile:
+                self.assertEqual(path == self.bam_path, samfile.has_index())
+                with self.assertWarns(UserWarning):
+                    records = list(alignment_filter.records(samfile))
+            self.assertEqual(['a', 'b', 'd'], [record.query_name for record in records])
+
+    def test_stream(self):
+        alignment_filter = AlignmentFilter(exclude_flags=parse_flags('UNMAP,REVERSE'))
+        stream = AlignmentStream(self.sam_path, alignment_filter=alignment_filter)
+        with warnings.catch_warnings():
+            # The test file is coordinate sorted
+            warnings.simplefilter('ignore')
+            self.assertEqual(['a', 'b', 'c', 'e', 'f'],
+                             [qname for qname, _, _ in stream.offset_items()])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import pysam
+
+from samstat.gff import get_attribute
+from samstat.gff import get_dbxref
+from samstat.gff import read_records
+from samstat.maps import RegionMap
+
+NCBI_ATTRIBUTES = 'ID=id1;Parent=rna0;Dbxref=GeneID:1001,Genbank:XM_1;gbkey=mRNA;gene=g1'
+
+ENSEMBL_LINES = ['##gff-version 3',
+                 'chr1\tensembl\tgene\t100\t400\t.\t+\t.\tID=gene:G1;Name=g1',
+                 'chr1\tensembl\tmRNA\t100\t400\t.\t+\t.\tID=transcript:T1;Parent=gene:G1',
+                 'chr1\tensembl\texon\t100\t150\t.\t+\t.\tParent=transcript:T1;Name=E1',
+                 'chr1\tensembl\texon\t300\t400\t.\t+\t.\tParent=transcript:T1;Name=E2',
+                 '',
+                 'chr1\tensembl\tbroken line',
+                 '##FASTA',
+                 '>chr1',
+                 'ACGT']
+
+class TestAttributes(unittest.TestCase):
+    """Tests for lazy GFF3 attribute parsing"""
+    def test_get_attribute_first(self):
+        self.assertEqual('id1', get_attribute(NCBI_ATTRIBUTES, 'ID'))
+
+    def test_get_attribute_middle(self):
+        self.assertEqual('rna0', get_attribute(NCBI_ATTRIBUTES, 'Parent'))
+
+    def test_get_attribute_last(self):
+        self.assertEqual('g1', get_attribute(NCBI_ATTRIBUTES + '\n', 'gene'))
+
+    def test_get_attribute_missing(self):
+        self.assertIsNone(get_attribute(NCBI_ATTRIBUTES, 'Name'))
+        self.assertIsNone(get_attribute(NCBI_ATTRIBUTES, 'D'))
+
+    def test_get_dbxref(self):
+        self.assertEqual('1001', get_dbxref(NCBI_ATTRIBUTES, 'GeneID'))
+        self.assertEqual('XM_1', get_dbxref(NCBI_ATTRIBUTES, 'Genbank'))
+        self.assertIsNone(get_dbxref(NCBI_ATTRIBUTES, 'taxon'))
+        self.assertIsNone(get_dbxref('ID=gene0', 'GeneID'))
+
+class TestReadRecords(unittest.TestCase):
+    """Tests for reading plain and compressed GFF3 files"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gff_path = os.path.join(self.directory, 'annotation.gff')
+        with open(self.gff_path, 'w') as gff:
+            gff.write('\n'.join(ENSEMBL_LINES) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            records = list(read_records(path))
+        return records, caught
+
+    def test_read_records(self):
+        records, caught = self.read(self.gff_path)
+        self.assertEqual(['gene', 'mRNA', 'exon', 'exon'], [record.type for record in records])
+        self.assertEqual((100, 150), (records[2].start, records[2].end))
+        self.assertEqual(1, len(caught))
+
+    def test_read_records_gzip(self):
+        gzip_path = self.gff_path + '.gz'
+        with open(self.gff_path, 'rb') as gff, gzip.open(gzip_path, 'wb') as compressed:
+            compressed.write(gff.read())
+        self.assertEqual(self.read(self.gff_path)[0], self.read(gzip_path)[0])
+
+    def test_read_records_bgzip(self):
+        bgzip_path = self.gff_path + '.bgz'
+        pysam.tabix_compress(self.gff_path, bgzip_path)
+        self.assertEqual(self.read(self.gff_path)[0], self.read(bgzip_path)[0])
+
+    def test_region_map_parent_genes(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            region_map = RegionMap(self.gff_path)
+        gene = region_map.rmap['chr1'].genes['gene:G1']
+        self.assertEqual([(100, 150), (300, 400)], [feature.location for feature in gene.features])
+
+    def test_region_lengths(self):
+        with open(self.gff_path, 'w') as gff:
+            gff.write('\n'.join(['##gff-version 3',
+                                 '##sequence-region chr1 1 5000',
+                                 '##sequence-region broken',
+                                 'chr2\tRefSeq\tregion\t1\t3000\t.\t+\t.\tID=chr2:1..3000']
+                                + ENSEMBL_LINES[1:5]
+                                + [line.replace('chr1', line_contig) for line in ENSEMBL_LINES[1:5]
+                                   for line_contig in ('chr2', 'chr3')]) + '\n')
+        sequence_regions = {}
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            list(read_records(self.gff_path, sequence_regions))
+            region_map = RegionMap(self.gff_path)
+        self.assertEqual({'chr1': (1, 5000)}, sequence_regions)
+        self.assertEqual(2, len(caught))
+        self.assertEqual({'chr1': 5000, 'chr2': 3000, 'chr3': 400},
+                         {name: region.length for name, region in region_map.rmap.items()})
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+
+from samstat.index import INDEX_SUFFIX
+from samstat.index import index_is_current
+from samstat.index import is_index
+from samstat.index import load_region_index
+from samstat.index import load_region_map
+from samstat.index import write_region_index
+from samstat.maps import RegionMap
+
+GFF_LINES = ['##gff-version 3',
+             'chr1\tRefSeq\tregion\t1\t1000\t.\t+\t.\tID=id0;Dbxref=taxon:52670',
+             'chr1\tGnomon\tgene\t100\t400\t.\t+\t.\tID=gene0;Dbxref=GeneID:1001;gene=g1',
+             'chr1\tGnomon\texon\t100\t150\t.\t+\t.\tID=id1;Parent=rna0;Dbxref=GeneID:1001,Genbank:XM_1',
+             'chr1\tGnomon\texon\t300\t400\t.\t+\t.\tID=id2;Parent=rna0;Dbxref=GeneID:1001,Genbank:XM_1',
+             'chr2\tRefSeq\tregion\t1\t500\t.\t-\t.\tID=id3;Dbxref=taxon:52670',
+             'chr2\tGnomon\tgene\t50\t300\t.\t-\t.\tID=gene1;Dbxref=GeneID:1002;gene=g2',
+             'chr2\tGnomon\texon\t50\t90\t.\t-\t.\tID=id4;Parent=rna1;Dbxref=GeneID:1002,Genbank:XM_2']
+
+LOCATIONS = [('chr1', 10, 30), ('chr1', 110, 130), ('chr1', 140, 160),
+             ('chr1', 200, 220), ('chr2', 60, 70), ('chr2', 250, 350)]
+
+class TestRegionIndex(unittest.TestCase):
+    """Tests for compiling and loading region index files"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gff_path = os.path.join(self.directory, 'annotation.gff')
+        with open(self.gff_path, 'w') as gff:
+            gff.write('\n'.join(GFF_LINES) + '\n')
+        self.index_path = self.gff_path + INDEX_SUFFIX
+        self.region_map = RegionMap(self.gff_path)
+        write_region_index(self.region_map, self.gff_path, self.index_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_is_index(self):
+        self.assertTrue(is_index(self.index_path))
+        self.assertFalse(is_index(self.gff_path))
+
+    def test_round_trip_classification(self):
+        indexed = load_region_index(self.index_path)
+        columns = list(zip(*LOCATIONS))
+        self.assertEqual([list(column) for column in self.region_map.classify_batch(*columns)],
+                         [list(column) for column in indexed.classify_batch(*columns)])
+        for rname, start, stop in LOCATIONS:
+            self.assertEqual(self.region_map.rmap[rname].classify_sequence((start, stop)),
+                             indexed.rmap[rname].classify_sequence((start, stop)))
+
+    def test_round_trip_directions(self):
+        indexed = load_region_index(self.index_path)
+        for rname, start, stop in LOCATIONS:
+            self.assertEqual(self.region_map.get_true_directions(rname, (start, stop), 16),
+                             indexed.get_true_directions(rname, (start, stop), 16))
+
+    def test_round_trip_feature_types(self):
+        lines = GFF_LINES + ['chr1\tGnomon\tCDS\t120\t150\t.\t+\t.\tID=cds1;Parent=rna0;'
+                             'Dbxref=GeneID:1001,Genbank:XM_1']
+        with open(self.gff_path, 'w') as gff:
+            gff.write('\n'.join(lines) + '\n')
+        region_map = RegionMap(self.gff_path, ('exon', 'CDS'))
+        write_region_index(region_map, self.gff_path, self.index_path)
+        indexed = load_region_map(self.gff_path, ('exon', 'CDS'))
+        self.assertEqual(('exon', 'CDS'), indexed.feature_types)
+        columns = list(zip(*LOCATIONS))
+        expected, masks = array('l', [0])*len(LOCATIONS), array('l', [0])*len(LOCATIONS)
+        region_map.classify_batch(*columns, expected)
+        indexed.classify_batch(*columns, masks)
+        self.assertEqual(list(expected), list(masks))
+        self.assertEqual(3, masks[1])
+
+    def test_index_is_current_touched(self):
+        os.utime(self.gff_path, ns=(0, 0))
+        self.assertTrue(index_is_current(self.index_path, self.gff_path, ('exon',)))
+
+    def test_index_is_current_changed(self):
+        with open(self.gff_path, 'a') as gff:
+            gff.write('chr3\tGnomon\tgene\t1\t10\t.\t+\t.\tID=gene2;Dbxref=GeneID:1003\n')
+        self.assertFalse(index_is_current(self.index_path, self.gff_path, ('exon',)))
+
+    def test_index_is_current_feature_types(self):
+        self.assertFalse(index_is_current(self.index_path, self.gff_path, ('CDS',)))
+
+    def test_load_region_map_uses_sibling_index(self):
+        region_map = load_region_map(self.gff_path)
+        self.assertFalse(isinstance(region_map.rmap, dict))
+        self.assertEqual(['chr1', 'chr2'], sorted(region_map.rmap))
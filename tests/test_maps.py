@@ -1,10 +1,20 @@
 import unittest
 import os
+import shutil
+import tempfile
 import warnings
+from array import array
+from collections import namedtuple
 
 from samstat.maps import RegionMap
 from samstat.maps import Region
+from samstat.maps import IntervalIndex
+from samstat.maps import AlignmentMap
+from samstat.maps import AlignmentStream
+from samstat.maps import CompactAlignmentMap
+from samstat.maps import Genes
 from samstat.maps import eqiv
+from samstat.maps import reference_blocks
 
 IN_GFF = '/disk/bioscratch/Will/Drop_Box/GCF_001266775.1_Austrofundulus_limnaeus-1.0_genomic_andMITO.gff'
 class TestRegionMap(unittest.TestCase):
@@ -54,14 +64,6 @@ class TestEqiv(unittest.TestCase):
         self.assertFalse(eqiv(SINGLE_BOOLEAN_FALSE))
 
 Gene = Region.Gene
-COORDS = {'asedf':Gene((1,10),1,1),
-          'ade':Gene((20, 30),1,1),
-          '4d':Gene((40, 50),1,1),
-          '34d':Gene((60, 70),1,1),
-          'w3':Gene((80, 100),1,1)}
-
-FULL_MATCH_BINARY = (20, 30)
-
 COORD = (5, 15)
 FULL_MATCH = (5, 15)
 LOWER_MATCH = (10, 20)
@@ -85,16 +87,383 @@ class TestRegion(unittest.TestCase):
         self.assertFalse(lower)
         self.assertTrue(upper)
 
-    def test_binary_coordinate_match_full(self):
-        sorted_coords = sorted(COORDS.values())
-        match = Region.binary_coordinate_match(sorted_coords, FULL_MATCH_BINARY)
-        self.assertTrue(match.lower)
-        self.assertTrue(match.upper)
-        self.assertEqual(FULL_MATCH_BINARY, match.value.location)
-        self.assertEqual(1, match.index)
+Feature = Region.Feature
+NESTED_COORDS = [Feature((1, 100), '+'),
+                 Feature((10, 20), '+'),
+                 Feature((15, 18), '+'),
+                 Feature((30, 40), '+'),
+                 Feature((90, 120), '+'),
+                 Feature((200, 210), '+')]
+
+class TestIntervalIndex(unittest.TestCase):
+    """Tests for the IntervalIndex overlap queries"""
+    def setUp(self):
+        self.index = IntervalIndex(NESTED_COORDS)
+
+    def locations(self, coordinate_pair):
+        return [self.index.items[i].location for i in self.index.overlapping(coordinate_pair)]
+
+    def test_overlapping_nested(self):
+        self.assertEqual([(1, 100), (10, 20), (15, 18)], self.locations((16, 17)))
+
+    def test_overlapping_contains(self):
+        self.assertEqual([(1, 100), (10, 20), (15, 18), (30, 40)], self.locations((12, 35)))
+
+    def test_overlapping_edges(self):
+        self.assertEqual([(1, 100), (90, 120)], self.locations((100, 100)))
+        self.assertEqual([(90, 120)], self.locations((120, 150)))
+
+    def test_overlapping_none(self):
+        self.assertEqual([], self.locations((130, 150)))
+        self.assertEqual([], IntervalIndex([]).overlapping((1, 10)))
+
+class TestGenes(unittest.TestCase):
+    """Tests for the columnar gene and feature table"""
+    def setUp(self):
+        self.genes = Genes()
+        first = self.genes.add_gene(''.join(['gene', '1']), (100, 400), '+')
+        self.genes.add_gene('gene2', (600, 900), '-')
+        for location, direction in (((300, 400), '+'), ((100, 150), '-'), ((100, 150), '+')):
+            self.genes.add_feature(first, location, direction)
+
+    def test_sorted_features(self):
+        gene = self.genes['gene1']
+        self.assertEqual(((100, 400), '+'), (gene.location, gene.direction))
+        self.assertEqual([((100, 150), '+', 0), ((100, 150), '-', 0), ((300, 400), '+', 0)],
+                         [tuple(feature) for feature in gene.features])
+        self.assertEqual([], self.genes['gene2'].features)
+        self.assertEqual([(151, 299)], list(self.genes.introns(0)))
+
+    def test_interned_ids(self):
+        self.assertIs('gene1', self.genes['gene1'].gene_id)
+        self.assertEqual(0, self.genes.add_gene('gene1', (1, 10), '-'))
+        self.assertEqual(['gene1', 'gene2'], list(self.genes))
+
+    def test_set_gene(self):
+        self.genes['gene1'] = Region.Gene((90, 200), '-', [Feature((90, 100), '-')])
+        self.genes['gene3'] = Region.Gene((950, 990), '+', [Feature((950, 960), '+')])
+        self.assertEqual([(90, 100)], [feature.location for feature in self.genes['gene1'].features])
+        self.assertEqual('-', self.genes['gene1'].direction)
+        self.assertEqual([(950, 960)], [feature.location for feature in self.genes['gene3'].features])
+
+    def test_from_arrays(self):
+        self.genes.sort_features()
+        genes = Genes.from_arrays(self.genes.gene_ids,
+                                  *[memoryview(getattr(self.genes, name)) for name in (
+                                      'gene_starts', 'gene_stops', 'gene_strands',
+                                      'feature_offsets', 'feature_starts', 'feature_stops',
+                                      'feature_strands')])
+        self.assertEqual(list(self.genes.feature_genes), list(genes.feature_slots()))
+        genes.add_feature(genes.slots['gene2'], (600, 650), '-')
+        self.assertEqual([(600, 650)], [feature.location for feature in genes['gene2'].features])
+        self.assertEqual(3, len(genes['gene1'].features))
+
+class TestRegionClassification(unittest.TestCase):
+    """Tests Region.classify_sequence with overlapping genes"""
+    def setUp(self):
+        self.region = Region(1000, '+')
+        self.region.genes['outer'] = Gene((100, 900), '+', [Feature((100, 200), '+')])
+        self.region.genes['inner'] = Gene((300, 400), '-', [Feature((300, 350), '-')])
+        self.region.build_index()
+
+    def test_classify_intergene(self):
+        self.assertEqual((1, 0, 0, 0), self.region.classify_sequence((10, 30)))
+
+    def test_classify_contained_gene(self):
+        self.assertEqual((False, 1, 1, 0), self.region.classify_sequence((310, 330)))
+
+    def test_classify_combo(self):
+        self.assertEqual((False, 0, 0, 1), self.region.classify_sequence((190, 210)))
+
+    def test_classify_spanning_exon(self):
+        self.assertEqual((False, 0, 1, 1), self.region.classify_sequence((290, 360)))
+
+    def test_segment_members(self):
+        region = self.region
+        genes = [[region.genes.gene_ids[slot] for slot in
+                  region.segment_gene_slots[region.segment_gene_offsets[i]:
+                                            region.segment_gene_offsets[i+1]]]
+                 for i in range(len(region.boundaries))]
+        self.assertEqual([100, 201, 300, 351, 401, 901], list(region.boundaries))
+        self.assertEqual([['outer'], ['outer'], ['outer', 'inner'], ['outer', 'inner'],
+                          ['outer'], []], genes)
+        self.assertEqual([1, 0, 1, 0, 0, 0], [region.segment_feature_offsets[i+1] -
+                                              region.segment_feature_offsets[i]
+                                              for i in range(len(region.boundaries))])
+
+    def test_classify_before_first_boundary(self):
+        self.assertEqual((False, 0, 0, 1), self.region.classify_sequence((90, 110)))
+
+    def test_classify_batch_matches_sequence(self):
+        region_map = RegionMap()
+        region_map.rmap['chr1'] = self.region
+        locations = [(10, 30), (310, 330), (190, 210), (290, 360), (120, 130), (950, 999)]
+        batch = region_map.classify_batch(['chr1']*len(locations),
+                                          [start for start, _ in locations],
+                                          [stop for _, stop in locations])
+        for i, location in enumerate(locations):
+            self.assertEqual(tuple(self.region.classify_sequence(location)),
+                             tuple(column[i] for column in batch))
+
+    def test_classify_batch_missing_region(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            batch = RegionMap().classify_batch(['chrX', 'chrX'], [1, 5], [10, 15])
+        self.assertEqual(1, len(caught))
+        self.assertEqual([(0, 0), (0, 0), (0, 0), (0, 0)], [tuple(column) for column in batch])
+
+class TestFeatureTypes(unittest.TestCase):
+    """Tests for regions with more than one feature type"""
+    def setUp(self):
+        self.region = Region(1000, '+', ('exon', 'CDS', 'five_prime_UTR'))
+        self.region.add_feature('gene', (100, 400), '+', 'g1')
+        self.region.add_feature('exon', (100, 200), '+', 'g1')
+        self.region.add_feature('CDS', (120, 200), '+', 'g1')
+        self.region.add_feature('five_prime_UTR', (100, 119), '+', 'g1')
+        self.region.add_feature('mRNA', (100, 400), '+', 'g1')
+        self.region.build_segments()
+        self.region_map = RegionMap(accepted_features=self.region.feature_types)
+        self.region_map.rmap['chr1'] = self.region
+
+    def test_feature_types(self):
+        self.assertEqual([2, 0, 1], [feature.type for feature in self.region.genes['g1'].features])
+
+    def test_type_masks(self):
+        locations = [(10, 30), (105, 110), (130, 140), (110, 130), (300, 310), (190, 250)]
+        type_masks = array('l', [0])*len(locations)
+        batch = self.region_map.classify_batch(['chr1']*len(locations),
+                                               [start for start, _ in locations],
+                                               [stop for _, stop in locations],
+                                               type_masks)
+        self.assertEqual([0, 0b101, 0b011, 0b111, 0, 0b011], list(type_masks))
+        self.assertEqual([0, 1, 1, 1, 0, 0], list(batch.exons))
+
+    def test_primary_type_counts(self):
+        # Exons, introns, combos and true directions only count the first type
+        exon_region = Region(1000, '+')
+        exon_region.add_feature('gene', (100, 400), '+', 'g1')
+        exon_region.add_feature('exon', (100, 200), '+', 'g1')
+        exon_region.build_segments()
+        exon_map = RegionMap()
+        exon_map.rmap['chr1'] = exon_region
+        locations = [(10, 30), (105, 110), (130, 140), (110, 130), (150, 250), (300, 310)]
+        starts, stops = zip(*locations)
+        self.assertEqual([list(column) for column in
+                          exon_map.classify_batch(['chr1']*len(locations), starts, stops)],
+                         [list(column) for column in
+                          self.region_map.classify_batch(['chr1']*len(locations), starts, stops)])
+        for location in locations:
+            self.assertEqual(tuple(exon_region.classify_sequence(location)),
+                             tuple(self.region.classify_sequence(location)))
+            for flag in (0, 16):
+                self.assertEqual(exon_map.get_true_directions('chr1', location, flag),
+                                 self.region_map.get_true_directions('chr1', location, flag))
+        self.assertEqual((1, 0), self.region.count_directions((130, 140), 1))
+
+    def test_too_many_types(self):
+        with self.assertRaises(ValueError):
+            RegionMap(accepted_features=['type{}'.format(i) for i in range(64)])
+
+class TestSweepTrueDirections(unittest.TestCase):
+    """Tests for the arithmetic truedir and it's segment fast path"""
+    def setUp(self):
+        self.region_map = RegionMap()
+        region = Region(1000, '+')
+        region.genes['outer'] = Gene((100, 900), '+', [Feature((100, 200), '+'),
+                                                       Feature((150, 250), '-')])
+        region.genes['inner'] = Gene((300, 400), '-', [Feature((300, 350), '-')])
+        region.genes['late'] = Gene((850, 990), '-', [])
+        region.build_index()
+        self.region_map.rmap['chr1'] = region
+
+    def test_sweep_matches_get_true_directions(self):
+        alignments = [('q{}'.format(start), ((start, start+length),), flag)
+                      for start in range(0, 1000, 7)
+                      for length, flag in ((19, 0), (3, 16), (120, 0))]
+        alignments.sort(key=lambda alignment: alignment[1][0][0])
+        swept = list(self.region_map.sweep_true_directions('chr1', alignments))
+        self.assertEqual([qname for qname, _, _ in alignments], [qname for qname, _ in swept])
+        for (qname, blocks, flag), (_, directions) in zip(alignments, swept):
+            self.assertEqual(self.region_map.get_true_directions('chr1', blocks[0], flag),
+                             directions)
+
+    def test_sweep_spliced(self):
+        blocks = ((120, 130), (320, 330))
+        swept = list(self.region_map.sweep_true_directions('chr1', [('s1', blocks, 0)]))
+        first = self.region_map.get_true_directions('chr1', blocks[0], 0)
+        second = self.region_map.get_true_directions('chr1', blocks[1], 0)
+        self.assertEqual((first.forwards+second.forwards, first.reverses+second.reverses),
+                         tuple(swept[0][1]))
+
+    def test_sweep_unsorted(self):
+        # Spliced and out of order alignments match the searched counts
+        alignments = [('s1', ((120, 130), (320, 330), (860, 870)), 0),
+                      ('s2', ((140, 160),), 16),
+                      ('s3', ((10, 20), (150, 160)), 0),
+                      ('s4', ((950, 999),), 16)]
+        swept = list(self.region_map.sweep_true_directions('chr1', alignments))
+        for (qname, blocks, flag), (_, directions) in zip(alignments, swept):
+            self.assertEqual(self.region_map.count_true_directions('chr1', blocks, flag),
+                             tuple(directions))
+
+    def test_true_directions(self):
+        self.assertEqual((1, 0), self.region_map.get_true_directions('chr1', (120, 130), 0))
+        self.assertEqual((0, 1), self.region_map.get_true_directions('chr1', (120, 130), 16))
+        self.assertEqual((1, 1), self.region_map.get_true_directions('chr1', (160, 170), 0))
+        self.assertEqual((1, 1), self.region_map.get_true_directions('chr1', (360, 370), 0))
+
+    def test_secondary_flags(self):
+        for flag, reverse_flag in ((256, 272), (2048, 2064), (99, 83)):
+            self.assertEqual(self.region_map.get_true_directions('chr1', (120, 130), 0),
+                             self.region_map.get_true_directions('chr1', (120, 130), flag))
+            self.assertEqual(self.region_map.get_true_directions('chr1', (120, 130), 16),
+                             self.region_map.get_true_directions('chr1', (120, 130), reverse_flag))
+
+    def test_outside_genes_counts_once(self):
+        self.assertEqual((1, 0), self.region_map.get_true_directions('chr1', (10, 20), 0))
+        self.assertEqual((0, 1), self.region_map.get_true_directions('chr1', (10, 20), 16))
+
+    def test_unstranded_feature(self):
+        region = Region(1000, '+')
+        region.genes['g'] = Gene((100, 500), '+', [Feature((100, 200), '.'),
+                                                   Feature((150, 250), '+')])
+        region.build_index()
+        self.region_map.rmap['chr2'] = region
+        self.assertEqual((1, 0), self.region_map.get_true_directions('chr2', (160, 170), 0))
+
+    def test_segments_match_count_directions(self):
+        region = self.region_map.rmap['chr1']
+        for start in range(0, 1000, 3):
+            for length in (0, 5, 60, 400):
+                for flag in (0, 16):
+                    strand = -1 if flag else 1
+                    self.assertEqual(region.count_directions((start, start+length), strand),
+                                     self.region_map.count_true_directions(
+                                         'chr1', ((start, start+length),), flag))
+
+    def test_convert_direction(self):
+        self.assertTrue(RegionMap.convert_direction('+'))
+        self.assertTrue(RegionMap.convert_direction(256))
+        self.assertFalse(RegionMap.convert_direction(272))
+        self.assertIsNone(RegionMap.convert_direction('.'))
+
+    def test_strand_directions(self):
+        for location in ((120, 130), (160, 170), (10, 20)):
+            self.assertEqual(self.region_map.get_true_directions('chr1', location, 0),
+                             self.region_map.get_true_directions('chr1', location, '+'))
+            self.assertEqual(self.region_map.get_true_directions('chr1', location, 16),
+                             self.region_map.get_true_directions('chr1', location, '-'))
+        with self.assertRaises(TypeError):
+            self.region_map.get_true_directions('chr1', (120, 130), '.')
+
+SeqLine = namedtuple('SeqLine', ['query_name',
+                                 'flag',
+                                 'cigar',
+                                 'cigartuples',
+                                 'reference_name',
+                                 'reference_start'])
+SEQ_LINES = [SeqLine('q1', 0, [(0, 20)], [(0, 20)], 'chr1', 10),
+             SeqLine('q1', 16, [(0, 20)], [(0, 20)], 'chr2', 50),
+             SeqLine('q2', 0, [(0, 18)], [(0, 18)], 'chr1', 90),
+             SeqLine('q3', 0, [(0, 22)], [(0, 22)], 'chr1', 5),
+             SeqLine('q3', 0, [(0, 22)], [(0, 22)], 'chr1', 500)]
+
+class TestReferenceBlocks(unittest.TestCase):
+    """Tests for CIGAR aware reference blocks"""
+    def test_reference_blocks_match(self):
+        self.assertEqual(((11, 30),), reference_blocks(10, [(0, 20)]))
+
+    def test_reference_blocks_clipped(self):
+        self.assertEqual(((11, 25),), reference_blocks(10, [(4, 5), (0, 15), (5, 3)]))
+
+    def test_reference_blocks_spliced(self):
+        self.assertEqual(((11, 20), (121, 130)),
+                         reference_blocks(10, [(0, 10), (3, 100), (0, 10)]))
+
+    def test_reference_blocks_indels(self):
+        self.assertEqual(((11, 33),), reference_blocks(10, [(0, 10), (2, 3), (0, 5), (1, 2), (0, 5)]))
+
+    def test_reference_blocks_unmapped(self):
+        self.assertEqual((), reference_blocks(-1, None))
+
+class TestAlignmentStream(unittest.TestCase):
+    """Tests for AlignmentStream QNAME grouping"""
+    def test_group_alignments_qnames(self):
+        groups = list(AlignmentStream.group_alignments(SEQ_LINES))
+        self.assertEqual(['q1', 'q2', 'q3'], [qname for qname, _ in groups])
+
+    def test_group_alignments_matches_alignment_map(self):
+        amap = {}
+        for seq_line in SEQ_LINES:
+            amap.setdefault(seq_line.query_name,
+                            AlignmentMap.SamIn([0], seq_line.flag, seq_line.cigar, [], []))
+            AlignmentMap.add_alignment(amap[seq_line.query_name], seq_line)
+        self.assertEqual(amap, dict(AlignmentStream.group_alignments(SEQ_LINES)))
+
+    def test_group_alignments_empty(self):
+        self.assertEqual([], list(AlignmentStream.group_alignments([])))
+
+    def test_check_grouping_unsorted(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            AlignmentStream.check_grouping({'HD': {'SO': 'coordinate'}})
+        self.assertEqual(1, len(caught))
+
+    def test_check_grouping_collated(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            AlignmentStream.check_grouping({'HD': {'SO': 'unsorted', 'GO': 'query'}})
+        self.assertEqual(0, len(caught))
+
+SAM_LINES = ['@HD\tVN:1.0\tSO:unsorted',
+             '@SQ\tSN:chr1\tLN:1000',
+             '@SQ\tSN:chr2\tLN:1000',
+             'q1\t0\tchr1\t11\t255\t20M\t*\t0\t0\t*\t*',
+             'q2\t16\tchr2\t51\t255\t18M\t*\t0\t0\t*\t*',
+             'q1\t256\tchr2\t91\t255\t5S15M\t*\t0\t0\t*\t*',
+             'u1\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*',
+             'q2\t272\tchr1\t6\t255\t18M\t*\t0\t0\t*\t*',
+             'q1\t272\tchr1\t501\t255\t20M\t*\t0\t0\t*\t*']
+
+class TestCompactAlignmentMap(unittest.TestCase):
+    """Tests that CompactAlignmentMap reads the same data as AlignmentMap"""
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.sam_path = os.path.join(cls.directory, 'alignments.sam')
+        with open(cls.sam_path, 'w') as sam:
+            sam.write('\n'.join(SAM_LINES) + '\n')
+        cls.amap = AlignmentMap(cls.sam_path)
+        cls.compact = CompactAlignmentMap(cls.sam_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_qname_order(self):
+        self.assertEqual(['q1', 'q2', 'u1'], list(self.compact))
+
+    def test_items_match_alignment_map(self):
+        self.assertEqual(dict(self.amap), dict(self.compact.items()))
+
+    def test_getitem(self):
+        self.assertEqual(self.amap['q2'], self.compact['q2'])
+        self.assertEqual(3, self.compact['q1'].alignment_number[0])
+        self.assertRaises(KeyError, self.compact.__getitem__, 'q3')
+
+    def test_unmapped(self):
+        self.assertEqual([], self.compact['u1'].cigar)
+        self.assertEqual([(None, -1, 4)], self.compact['u1'].reference_names)
+        self.assertEqual([()], self.compact['u1'].blocks)
+
+    def test_blocks(self):
+        self.assertEqual([((11, 30),), ((91, 105),), ((501, 520),)], self.compact['q1'].blocks)
 
 if __name__ == '__main__':
-    test_classes = (TestEqiv, TestRegionMap, TestRegion)
+    test_classes = (TestEqiv, TestReferenceBlocks, TestRegionMap, TestRegion, TestIntervalIndex,
+                    TestRegionClassification, TestSweepTrueDirections,
+                    TestAlignmentStream,
+                    TestCompactAlignmentMap)
     test_suite = unittest.TestSuite()
     for test_class in test_classes:
         test_suite.addTest(test_class())
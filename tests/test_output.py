@@ -0,0 +1,117 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+from samstat import output
+from samstat.output import combine_outputs
+from samstat.output import format_row
+from samstat.output import infer_format
+from samstat.output import open_writer
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+Row = namedtuple('Row', ['qname', 'rname', 'forward', 'reverse'])
+ROWS = [Row('q{}'.format(i), 'chr1', i, i % 2) for i in range(5)]
+FIELDS = list(Row._fields)
+
+class TestFormatRow(unittest.TestCase):
+    """Tests for typed row formatting"""
+    def test_format_row(self):
+        self.assertEqual('q1\tchr1\t1\t1', format_row(ROWS[1], FIELDS))
+
+    def test_format_row_types(self):
+        self.assertEqual('All2,0,,3', format_row(Row('All2', False, None, 3), FIELDS, ','))
+
+    def test_format_row_missing_field(self):
+        self.assertRaises(AttributeError, format_row, ROWS[0], FIELDS + ['exons'])
+
+    def test_infer_format(self):
+        self.assertEqual('tsv', infer_format('out.tsv'))
+        self.assertEqual('gzip', infer_format('out.tsv.gz'))
+        self.assertEqual('parquet', infer_format('out.parquet'))
+
+class TestWriters(unittest.TestCase):
+    """Tests for the buffered output writers"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lines_per_write = output.LINES_PER_WRITE
+        output.LINES_PER_WRITE = 2
+
+    def tearDown(self):
+        output.LINES_PER_WRITE = self.lines_per_write
+        shutil.rmtree(self.directory)
+
+    def write(self, path, output_format=None):
+        with open_writer(path, FIELDS, output_format, {'qname', 'rname'}) as writer:
+            writer.write(writer.format(row) for row in ROWS)
+
+    def test_tsv_writer(self):
+        path = os.path.join(self.directory, 'out.tsv')
+        self.write(path)
+        with open(path) as ofile:
+            self.assertEqual('\n'.join(format_row(row, FIELDS) for row in ROWS), ofile.read())
+
+    def test_gzip_writer(self):
+        path = os.path.join(self.directory, 'out.tsv.gz')
+        self.write(path)
+        with gzip.open(path, 'rt') as ofile:
+            self.assertEqual('\n'.join(format_row(row, FIELDS) for row in ROWS), ofile.read())
+
+    def test_empty_output(self):
+        path = os.path.join(self.directory, 'out.txt')
+        with open_writer(path, FIELDS, 'tsv') as writer:
+            writer.write([])
+        self.assertEqual(0, os.path.getsize(path))
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_writer(self):
+        path = os.path.join(self.directory, 'out.parquet')
+        self.write(path)
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual([tuple(row) for row in ROWS],
+                         list(zip(*[table.column(field).to_pylist() for field in FIELDS])))
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_row_groups(self):
+        # Rows of many small write() calls share row groups
+        path = os.path.join(self.directory, 'groups.parquet')
+        rows_per_group = output.ROWS_PER_GROUP
+        output.ROWS_PER_GROUP = 3
+        try:
+            with open_writer(path, FIELDS, None, {'qname', 'rname'}) as writer:
+                for row in ROWS:
+                    writer.write([writer.format(row)])
+                self.assertEqual(len(ROWS), writer.lines_written)
+        finally:
+            output.ROWS_PER_GROUP = rows_per_group
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        self.assertEqual(2, parquet_file.metadata.num_row_groups)
+        self.assertEqual([row.qname for row in ROWS],
+                         parquet_file.read().column('qname').to_pylist())
+
+    def test_combine_gzip(self):
+        paths = [(sample, os.path.join(self.directory, sample + '.tsv.gz')) for sample in 'ab']
+        for _, path in paths:
+            self.write(path)
+        combine_outputs(paths, os.path.join(self.directory, 'all.tsv.gz'), FIELDS)
+        with gzip.open(os.path.join(self.directory, 'all.tsv.gz'), 'rt') as combined:
+            lines = combined.read().split('\n')
+        self.assertEqual(['{}\t{}'.format(sample, format_row(row, FIELDS))
+                          for sample in 'ab' for row in ROWS], lines)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_combine_parquet(self):
+        paths = [(sample, os.path.join(self.directory, sample + '.parquet')) for sample in 'ab']
+        for _, path in paths:
+            self.write(path)
+        combine_outputs(paths, os.path.join(self.directory, 'all.parquet'), FIELDS,
+                        string_fields={'qname', 'rname'})
+        table = pyarrow.parquet.read_table(os.path.join(self.directory, 'all.parquet'))
+        self.assertEqual(['sample'] + FIELDS, table.column_names)
+        self.assertEqual(['a'] * len(ROWS) + ['b'] * len(ROWS), table.column('sample').to_pylist())
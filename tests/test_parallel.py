@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import pysam
+
+from samstat.maps import AlignmentMap
+from samstat.maps import Region
+from samstat.maps import RegionMap
+from samstat.parallel import batch_qnames
+from samstat.parallel import imap_qname_batches
+from samstat.parallel import imap_reference_truedirs
+
+QNAME_DATA = {'q{}'.format(i): AlignmentMap.SamIn([i % 3 + 1], 0, [(0, 20)],
+                                                  [('chr1', i, 0)], [((i+1, i+20),)])
+              for i in range(25)}
+
+def count_alignments(qname_data, region_map):
+    for qname, qdata in qname_data.items():
+        yield qname, qdata.alignment_number[0] + region_map
+
+def format_line(oline):
+    return '{}\t{}'.format(*oline)
+
+class TestParallel(unittest.TestCase):
+    """Tests for the QNAME batch process pool"""
+    def test_batch_qnames_sizes(self):
+        batches = list(batch_qnames(QNAME_DATA, 10))
+        self.assertEqual([10, 10, 5], [len(batch) for batch in batches])
+
+    def test_imap_qname_batches_matches_serial(self):
+        serial = [format_line(oline) for oline in count_alignments(QNAME_DATA, 100)]
+        pooled = list(imap_qname_batches(QNAME_DATA, 100, count_alignments,
+                                         format_line, workers=3, batch_size=4))
+        self.assertEqual(serial, pooled)
+
+BAM_HEADER = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000},
+                     {'SN': 'chrM', 'LN': 100}]}
+BAM_RECORDS = [('q1', 0, 105, 0), ('q2', 0, 120, 16), ('q1', 0, 610, 16),
+               ('q3', 0, 640, 0), ('q2', 1, 10, 0), ('q4', 2, 5, 0)]
+
+class TestReferenceTruedirs(unittest.TestCase):
+    """Tests for region parallel truedir over an indexed BAM file"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bam_path = os.path.join(self.directory, 'alignments.bam')
+        with pysam.AlignmentFile(self.bam_path, 'wb', header=BAM_HEADER) as bam:
+            for qname, reference_id, start, flag in BAM_RECORDS:
+                read = pysam.AlignedSegment(bam.header)
+                read.query_name = qname
+                read.reference_id = reference_id
+                read.reference_start = start
+                read.flag = flag
+                read.cigartuples = [(0, 20)]
+                bam.write(read)
+        pysam.index(self.bam_path)
+
+        self.region_map = RegionMap()
+        for name in ('chr1', 'chr2'):
+            region = Region(1000, '+')
+            region.genes['g1'] = Region.Gene((100, 400), '+', [Region.Feature((100, 150), '+')])
+            region.genes['g2'] = Region.Gene((600, 900), '-', [Region.Feature((600, 700), '-')])
+            region.build_index()
+            self.region_map.rmap[name] = region
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reference_truedirs(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            rows = list(imap_reference_truedirs(self.bam_path, self.region_map,
+                                                workers=2, window_size=300))
+        self.assertEqual(['chrM'], [str(warning.message).split()[2] for warning in caught])
+
+        expected = {}
+        for qname, reference_id, start, flag in BAM_RECORDS[:5]:
+            rname = BAM_HEADER['SQ'][reference_id]['SN']
+            directions = self.region_map.get_true_directions(rname, (start+1, start+20), flag)
+            counts = expected.setdefault((qname, rname), [0, 0])
+            counts[0] += directions.forwards
+            counts[1] += directions.reverses
+        self.assertEqual(sorted((qname, rname, forward, reverse) for (qname, rname), (forward, reverse)
+                                in expected.items()),
+                         sorted(rows))
+        self.assertEqual(['chr1']*3 + ['chr2'], [row[1] for row in rows])
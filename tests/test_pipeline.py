@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from samstat import output
+from samstat import pipeline
+from samstat.samstat import calculate_qstats
+from samstat.samstat import qstat_out_values
+
+from tests.test_samstat import QNAME_DATA
+from tests.test_samstat import build_region_map
+
+class FailingWriter(object):
+    """Writer that fails on it's first block"""
+    lines_written = 0
+
+    def format(self, row):
+        return row
+
+    def write(self, lines):
+        raise IOError('disk full')
+
+class FailingQnames(object):
+    def items(self):
+        yield 'q1', QNAME_DATA['q1']
+        raise ValueError('truncated file')
+
+class TestPipeline(unittest.TestCase):
+    """Tests for the pipelined read, compute and write executor"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.region_map = build_region_map()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_pipeline(self, name, **kwargs):
+        path = os.path.join(self.directory, name)
+        with output.TsvWriter(path, qstat_out_values) as writer:
+            rows = pipeline.run_pipeline(QNAME_DATA, self.region_map, calculate_qstats,
+                                         writer, **kwargs)
+        with open(path) as ofile:
+            return rows, ofile.read()
+
+    def test_matches_serial(self):
+        expected = '\n'.join(output.format_row(row, qstat_out_values)
+                             for row in calculate_qstats(QNAME_DATA, self.region_map))
+        self.assertEqual((len(QNAME_DATA), expected),
+                         self.run_pipeline('serial.tsv', batch_size=1, queue_size=1))
+        self.assertEqual((len(QNAME_DATA), expected),
+                         self.run_pipeline('workers.tsv', workers=2, batch_size=1))
+
+    def test_writer_failure(self):
+        with self.assertRaises(pipeline.PipelineError):
+            pipeline.run_pipeline(QNAME_DATA, self.region_map, calculate_qstats,
+                                  FailingWriter(), batch_size=1, queue_size=1)
+
+    def test_reader_failure(self):
+        path = os.path.join(self.directory, 'failed.tsv')
+        with output.TsvWriter(path, qstat_out_values) as writer:
+            with self.assertRaises(pipeline.PipelineError):
+                pipeline.run_pipeline(FailingQnames(), self.region_map, calculate_qstats,
+                                      writer, batch_size=1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+from samstat import synthetic
+from samstat.maps import AlignmentMap
+from samstat.maps import Region
+from samstat.maps import RegionMap
+from samstat.samstat import calculate_qstats
+from samstat.samstat import chunk_qnames
+from samstat.samstat import feature_type_column
+from samstat.samstat import qstat_out_values
+from samstat.samstat import read_manifest
+from samstat.samstat import run
+from samstat.samstat import run_batch
+from samstat.samstat import Sample
+
+Gene = Region.Gene
+Feature = Region.Feature
+
+QNAME_DATA = {'q1': AlignmentMap.SamIn([2], 0, [(0, 20)], [('chr1', 110, 0), ('chr1', 610, 16)],
+                                       [((111, 130),), ((611, 630),)]),
+              'q2': AlignmentMap.SamIn([1], 0, [(0, 20)], [('chr1', 200, 0)], [((201, 220),)]),
+              'q3': AlignmentMap.SamIn([1], 16, [(0, 20)], [('chr1', 20, 16)], [((21, 40),)]),
+              'q4': AlignmentMap.SamIn([1], 0, [(0, 20)], [('chr1', 140, 0)], [((141, 160),)])}
+
+def build_region_map():
+    region_map = RegionMap()
+    region = Region(1000, '+')
+    region.genes['1001'] = Gene((100, 400), '+', [Feature((100, 150), '+'),
+                                                  Feature((300, 400), '+')])
+    region.genes['1002'] = Gene((600, 900), '-', [Feature((600, 700), '-')])
+    region.build_index()
+    region_map.rmap['chr1'] = region
+    return region_map
+
+class TestQstats(unittest.TestCase):
+    """Tests for the qstat calculator"""
+    def test_chunk_qnames(self):
+        chunks = list(chunk_qnames(QNAME_DATA.items(), 2))
+        self.assertEqual([['q1'], ['q2', 'q3'], ['q4']],
+                         [[qname for qname, _ in chunk] for chunk in chunks])
+
+    def test_calculate_qstats_classes(self):
+        qstats = {row.qname: row for row in calculate_qstats(QNAME_DATA, build_region_map())}
+        self.assertEqual((2, 0, 0, 0), qstats['q1'][5:])
+        self.assertEqual((0, 1, 0, 0), qstats['q2'][5:])
+        self.assertEqual((0, 0, 1, 0), qstats['q3'][5:])
+        self.assertEqual((0, 0, 0, 1), qstats['q4'][5:])
+
+    def test_calculate_qstats_unmapped(self):
+        qname_data = dict(QNAME_DATA, u1=AlignmentMap.SamIn([1], 4, [], [(None, -1, 4)], [()]))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            qstats = list(calculate_qstats(qname_data, build_region_map()))
+        self.assertEqual(['q1', 'q2', 'q3', 'q4'], [row.qname for row in qstats])
+        self.assertEqual(1, len(caught))
+
+    def test_calculate_qstats_partly_unmapped(self):
+        qname_data = {'m2': AlignmentMap.SamIn([3], 0, [(0, 20)],
+                                               [('chr1', 110, 0), (None, -1, 4), (None, -1, 4)],
+                                               [((111, 130),), (), ()])}
+        qstats = list(calculate_qstats(qname_data, build_region_map()))
+        self.assertEqual(('m2', 3, 'All1', 'All1', 1), qstats[0][:5])
+        self.assertEqual((1, 0, 0, 0), qstats[0][5:])
+
+    def test_calculate_qstats_spliced(self):
+        qname_data = {'s1': AlignmentMap.SamIn([1], 0, [(0, 10)], [('chr1', 140, 0)],
+                                               [((141, 150), (301, 310))])}
+        qstats = list(calculate_qstats(qname_data, build_region_map()))
+        self.assertEqual((2, 0, 0, 0), qstats[0][5:])
+
+    def test_calculate_qstats_feature_types(self):
+        region_map = RegionMap(accepted_features=('exon', 'CDS'))
+        region = Region(1000, '+', region_map.feature_types)
+        region.genes['1001'] = Gene((100, 400), '+', [Feature((100, 150), '+', 0),
+                                                      Feature((125, 150), '+', 1),
+                                                      Feature((300, 400), '+', 0)])
+        region.build_index()
+        region_map.rmap['chr1'] = region
+        qstats = {row.qname: row for row in calculate_qstats(QNAME_DATA, region_map)}
+        self.assertEqual(qstat_out_values + ['exon', 'CDS'], list(qstats['q1']._fields))
+        self.assertEqual((1, 1), (qstats['q1'].exon, qstats['q1'].CDS))
+        self.assertEqual((1, 1), (qstats['q4'].exon, qstats['q4'].CDS))
+        self.assertEqual((0, 0), (qstats['q2'].exon, qstats['q2'].CDS))
+
+    def test_feature_type_column(self):
+        self.assertEqual('five_prime_UTR', feature_type_column('five_prime_UTR'))
+        self.assertEqual('feature_exons', feature_type_column('exons'))
+        self.assertEqual('feature_3_UTR', feature_type_column("3'UTR"))
+
+    def test_calculate_qstats_chunk_size(self):
+        region_map = build_region_map()
+        self.assertEqual(list(calculate_qstats(QNAME_DATA, region_map)),
+                         list(calculate_qstats(QNAME_DATA, region_map, chunk_size=1)))
+
+class TestBatch(unittest.TestCase):
+    """Tests for running many samples with one region map"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gff_path = os.path.join(self.directory, 'in.gff')
+        lengths = synthetic.write_gff(self.gff_path, contigs=2, genes_per_contig=20)
+        self.samples = []
+        for seed in range(3):
+            path = os.path.join(self.directory, 's{}.sam'.format(seed))
+            synthetic.write_sam(path, lengths, reads=50, seed=seed)
+            self.samples.append(Sample('s{}'.format(seed), path))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, *path):
+        with open(os.path.join(self.directory, *path)) as out_file:
+            return out_file.read().split('\n')
+
+    def test_read_manifest(self):
+        manifest_path = os.path.join(self.directory, 'manifest.tsv')
+        with open(manifest_path, 'w') as manifest:
+            manifest.write('# samples\nfirst\ts0.sam\n\n/data/s1.bam\n')
+        self.assertEqual([Sample('first', os.path.join(self.directory, 's0.sam')),
+                          Sample('s1', '/data/s1.bam')],
+                         read_manifest(manifest_path))
+
+    def test_run_batch(self):
+        for workers in (1, 2):
+            out_dir = os.path.join(self.directory, 'out{}'.format(workers))
+            rows = run_batch(self.samples, self.gff_path, out_dir, qstat_out_values,
+                             calculate_qstats, workers=workers,
+                             combined_path=os.path.join(out_dir, 'all.tsv'))
+            self.assertEqual({'s0': 50, 's1': 50, 's2': 50}, rows)
+            combined = []
+            for sample in self.samples:
+                single_path = os.path.join(self.directory, sample.name + '.tsv')
+                run(sample.path, self.gff_path, single_path, qstat_out_values, calculate_qstats)
+                self.assertEqual(self.read(sample.name + '.tsv'),
+                                 self.read(out_dir, sample.name + '.tsv'))
+                combined += [sample.name + '\t' + line for line in self.read(single_path)]
+            self.assertEqual(combined, self.read(out_dir, 'all.tsv'))
@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import warnings
+
+from samstat import server
+from samstat.cache import ClassificationCache
+from samstat.client import RegionMapClient
+from samstat.client import ServerError
+
+from tests.test_samstat import build_region_map
+
+LOCATIONS = [(50, 60), (110, 120), (200, 250), (140, 320), (650, 660), (950, 990)]
+
+class TestServer(unittest.TestCase):
+    """Tests for the query server and it's client"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, 'samstat.sock')
+        self.region_map = build_region_map()
+        self.region_map.classification_cache = ClassificationCache(100)
+        self.server = server.make_server(self.region_map, self.address)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def test_classify(self):
+        expected = build_region_map()
+        with RegionMapClient(self.address) as client:
+            for start, stop in LOCATIONS:
+                self.assertEqual(tuple(expected.get_location_clasification('chr1', start, stop)),
+                                 tuple(client.get_location_clasification('chr1', start, stop)))
+            starts, stops = zip(*LOCATIONS)
+            self.assertEqual([list(column) for column in
+                              expected.classify_batch(['chr1']*len(LOCATIONS), starts, stops)],
+                             list(client.classify_batch(['chr1']*len(LOCATIONS), starts, stops)))
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                self.assertEqual(0, client.get_location_clasification('chr2', 1, 10))
+            self.assertEqual(1, len(caught))
+
+    def test_true_directions(self):
+        expected = build_region_map()
+        with RegionMapClient(self.address) as client:
+            for location in LOCATIONS:
+                for flag in (0, 16):
+                    self.assertEqual(expected.get_true_directions('chr1', location, flag),
+                                     tuple(client.get_true_directions('chr1', location, flag)))
+                self.assertEqual(expected.get_true_directions('chr1', location, '-'),
+                                 tuple(client.get_true_directions('chr1', location, '-')))
+            with self.assertRaises(KeyError):
+                client.get_true_directions('chr2', (1, 10), 0)
+
+    def test_concurrent_clients(self):
+        expected = [tuple(build_region_map().get_location_clasification('chr1', start, stop))
+                    for start, stop in LOCATIONS]
+        results = [None]*4
+
+        def query(number):
+            with RegionMapClient(self.address) as client:
+                results[number] = [tuple(client.get_location_clasification('chr1', start, stop))
+                                   for _ in range(20) for start, stop in LOCATIONS]
+
+        threads = [threading.Thread(target=query, args=(number,)) for number in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([expected*20]*4, results)
+        with RegionMapClient(self.address) as client:
+            stats = client.stats()
+        self.assertEqual(5, stats['connections'])
+        self.assertEqual(4*20*len(LOCATIONS), stats['operations']['classify']['requests'])
+        self.assertEqual(4*20*len(LOCATIONS), stats['operations']['classify']['intervals'])
+        self.assertLessEqual(stats['batches'], 4*20*len(LOCATIONS))
+
+    def test_bad_request_in_batch(self):
+        # Queued together, the bad query must not fail the good one
+        batcher = server.Batcher(build_region_map())
+        try:
+            good = server.Query({'op': 'classify', 'regions': ['chr1'],
+                                 'starts': [110], 'stops': [120]})
+            bad = server.Query({'op': 'classify', 'regions': [['chr1']],
+                                'starts': [None], 'stops': [120]})
+            batcher.compute([good, bad])
+        finally:
+            batcher.close()
+        self.assertEqual([1], good.response['exons'])
+        self.assertIn('error', bad.response)
+
+    def test_concurrent_bad_client(self):
+        results = {}
+
+        def query(name, start):
+            with RegionMapClient(self.address) as client:
+                try:
+                    results[name] = [tuple(client.classify_batch(['chr1'], [start], [120]))
+                                     for _ in range(50)]
+                except ServerError as error:
+                    results[name] = str(error)
+
+        threads = [threading.Thread(target=query, args=('good', 110)),
+                   threading.Thread(target=query, args=('bad', 'a'))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([([0], [1], [0], [0])]*50, results['good'])
+        self.assertIn('integers', results['bad'])
+
+    def test_errors(self):
+        with RegionMapClient(self.address) as client:
+            with self.assertRaises(ServerError):
+                client.request({'op': 'unknown'})
+            with self.assertRaises(ServerError):
+                client.request({'op': 'classify', 'regions': ['chr1'], 'starts': [1]})
+            with self.assertRaises(ServerError):
+                client.classify_batch(['chr1'], ['a'], [10])
+            self.assertEqual(3, client.stats()['errors'])
+            self.assertEqual(1, client.get_location_clasification('chr1', 50, 60).intergene)
+
+if __name__ == '__main__':
+    unittest.main()
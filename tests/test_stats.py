@@ -0,0 +1,45 @@
+import unittest
+import warnings
+
+from samstat.maps import RegionMap
+from samstat.stats import RunStats
+from samstat.stats import count_genes
+
+class TestRunStats(unittest.TestCase):
+    """Tests for the per-stage run statistics"""
+    def test_stage(self):
+        stats = RunStats()
+        with stats.stage('gff_parse') as stage:
+            stage.records = 10
+        result = stats.as_dict()['stages']['gff_parse']
+        self.assertEqual(10, result['records'])
+        self.assertGreater(result['peak_rss_kb'], 0)
+
+    def test_timed_iter(self):
+        stats = RunStats()
+        self.assertEqual([0, 1, 2], list(stats.timed_iter('truedir', range(3))))
+        self.assertEqual(3, stats.get_stage('truedir').records)
+
+    def test_count_warnings(self):
+        stats = RunStats()
+        with warnings.catch_warnings(record=True) as shown:
+            with stats.count_warnings():
+                for _ in range(3):
+                    warnings.warn('Region name chrX not found in the region map')
+                warnings.warn('Invalid line', RuntimeWarning)
+        self.assertEqual({'UserWarning': 3, 'RuntimeWarning': 1}, stats.warnings)
+        self.assertEqual(2, len(shown))
+
+    def test_region_map_counters(self):
+        region_map = RegionMap()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            region_map.classify_batch(['chrX', 'chrX'], [1, 5], [4, 8])
+            region_map.get_location_clasification('chrY', 1, 4)
+        result = RunStats().as_dict(region_map)
+        self.assertEqual({'chrX': 2, 'chrY': 1}, result['unmatched_regions'])
+        self.assertIn('hits', result['classification_cache'])
+        self.assertEqual(0, count_genes(region_map))
+
+if __name__ == '__main__':
+    unittest.main()